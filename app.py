@@ -1,10 +1,10 @@
-import json
-from pathlib import Path
 import sys
 import os
+import importlib
+import threading
 import time
 from dotenv import load_dotenv
-from flask import Flask, jsonify, request, Response, stream_with_context
+from flask import Flask, jsonify, request, Response
 from flask_cors import CORS, cross_origin
 from werkzeug.middleware.proxy_fix import ProxyFix
 import logging
@@ -12,7 +12,14 @@ import logging
 from services.romaji_annotator import RomajiAnnotator
 from services.appwrite_service import AppwriteService
 from services.openai_service import OpenAIService
-from utils import utils
+from services.transcription_scheduler import TranscriptionScheduler
+from services.pipeline import Pipeline
+from services.result_store import ResultStore
+from services.stage_limiter import StageBusy, StageLimits
+from services.job_store import MemoryJobStore, SQLiteJobStore
+from services.job_runner import JobRunner
+from services.batch_runner import BatchRunner
+from utils.utils import log_handlers
 
 load_dotenv(override=True)
 sys.path.append("../")
@@ -29,9 +36,9 @@ MEDIA_DIR = "media"
 OUTPUT_TRACK_DIR = os.path.join("output", "track")
 
 logging.basicConfig(
-    level=logging.DEBUG,
+    level=os.getenv("LOG_LEVEL", "DEBUG").upper(),
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    handlers=[logging.StreamHandler(), logging.FileHandler("app.log")],
+    handlers=log_handlers(),
 )
 logger = logging.getLogger(__name__)
 
@@ -42,17 +49,86 @@ if not os.path.exists(OUTPUT_TRACK_DIR):
     os.makedirs(OUTPUT_TRACK_DIR)
 
 appwrite_service = AppwriteService()
+# Concurrency caps and wait queue sizes per stage, see StageLimits.DEFAULTS
+stage_limits = StageLimits.from_env()
 openai_service = OpenAIService(
     api_key=os.getenv("OPENAI_KEY"),
     organization=os.getenv("OPENAI_ORG"),
     project=os.getenv("OPENAI_PROJ"),
     appwrite_service=appwrite_service,
+    stage_limits=stage_limits,
 )
 romaji_annotator = RomajiAnnotator(
     api_key=os.getenv("OPENAI_KEY"),
     organization=os.getenv("OPENAI_ORG"),
     project=os.getenv("OPENAI_PROJ"),
 )
+transcription_scheduler = TranscriptionScheduler(
+    max_concurrent=int(os.getenv("WHISPER_MAX_CONCURRENCY", 2)),
+    max_queue=int(os.getenv("WHISPER_MAX_QUEUE", 16)),
+)
+stage_limits.add("transcription", transcription_scheduler)
+result_store = ResultStore(appwrite_service)
+pipeline = Pipeline(
+    appwrite_service=appwrite_service,
+    openai_service=openai_service,
+    romaji_annotator=romaji_annotator,
+    transcription_scheduler=transcription_scheduler,
+    result_store=result_store,
+    stage_limits=stage_limits,
+)
+# JOB_STORE=sqlite keeps jobs and their progress across restarts and workers
+job_lock_path = None
+if os.getenv("JOB_STORE", "memory") == "sqlite":
+    job_store_path = os.getenv("JOB_STORE_PATH", "jobs.sqlite3")
+    job_store = SQLiteJobStore(job_store_path)
+    # Lets concurrent requests in different workers join the same job
+    job_lock_path = f"{job_store_path}.lock"
+else:
+    job_store = MemoryJobStore()
+job_runner = JobRunner(
+    job_store,
+    pipeline,
+    max_workers=int(os.getenv("JOB_WORKERS", 4)),
+    # Jobs that may wait for a worker before new ones get a 503
+    max_queue=int(os.getenv("JOB_QUEUE", 16)),
+    coalesce=os.getenv("JOB_COALESCE", "true") == "true",
+    lock_path=job_lock_path,
+    # How long streams wait to send events arriving close together in one write
+    linger=float(os.getenv("STREAM_LINGER_MS", 5)) / 1000,
+)
+batch_runner = BatchRunner(
+    job_runner,
+    result_store,
+    max_parallel=int(os.getenv("BATCH_PARALLEL", 2)),
+)
+
+
+def warm_up():
+    """Import yt-dlp and openai and build the OpenAI client ahead of requests"""
+    started = time.monotonic()
+    importlib.import_module("yt_dlp")
+    openai_service.client
+    romaji_annotator.client
+    logger.info(f"Warmed up in {time.monotonic() - started:.2f}s")
+
+
+def start_warm_up() -> threading.Thread:
+    """
+    Warm up in the background, for STARTUP_MODE=lazy. Called once the
+    worker is serving: gunicorn preloads the app and forks, and threads
+    started before the fork don't survive it.
+    """
+    thread = threading.Thread(target=warm_up, name="warm-up", daemon=True)
+    thread.start()
+    return thread
+
+
+# STARTUP_MODE=lazy leaves the heavy imports for after the server is
+# listening, so a cold start serves its first request sooner
+lazy_startup = os.getenv("STARTUP_MODE", "eager") == "lazy"
+if not lazy_startup:
+    warm_up()
 
 
 @cross_origin(origin=["*"], headers=["Content-Type", "Authorization"])
@@ -68,74 +144,32 @@ def cors_test():
     return jsonify({"message": "CORS test successful", "status": "ok"})
 
 
-#! Step 1
-@cross_origin(origin=["*"], headers=["Content-Type", "Authorization"])
-@app.route("/validate", methods=["OPTIONS", "POST"])
-def validation_endpoint():
-    logger.info("Received validation request")
-    if request.method == "OPTIONS":
-        response = app.make_default_options_response()
-        response.headers.add("Access-Control-Allow-Origin", "*")
-        response.headers.add("Access-Control-Allow-Methods", "POST, OPTIONS")
-        response.headers.add("Access-Control-Allow-Headers", "Content-Type")
-        return response
-
-    def generate():
-        if request.method == "POST":
-
-            yield utils.stream_message("update", "Initializing...")
-            time.sleep(0.3)
-
-            try:
-                data = request.json
-                video_id = data.get("id")
-                if not video_id:
-                    raise ValueError("Invalid or missing video ID in request.")
-
-                yield utils.stream_message(
-                    "update", f"Received request for ID {video_id}"
-                )
-                time.sleep(0.3)
-
-                yield utils.stream_message("update", "Gathering video metadata...")
-                time.sleep(0.4)
-
-                # Stream validation updates (now includes upload)
-                for update in openai_service.validate_video(video_id):
-                    if isinstance(update, str) and "vid_info" in update:
-                        try:
-                            vid_info = json.loads(update)
-                            if "data" in vid_info:
-                                subtitle_info = vid_info["data"].get(
-                                    "subtitle_info", {}
-                                )
-                                logger.info("Subtitle Info Details:")
-                                logger.info(
-                                    f"Exists: {subtitle_info.get('exist', False)}"
-                                )
-                                logger.info(f"Path: {subtitle_info.get('path', 'N/A')}")
-                                logger.info(
-                                    f"Extension: {subtitle_info.get('ext', 'N/A')}"
-                                )
-                                logger.info("-" * 50)
-                        except json.JSONDecodeError:
-                            logger.error("Failed to parse vid_info JSON")
-                        except Exception as e:
-                            logger.error(f"Error processing vid_info: {str(e)}")
-                    logger.debug(f"Yielding update: {update[:200]}...")
-                    yield update
-
-            except ValueError as ve:
-                yield utils.stream_message("error", f"Validation Error: {str(ve)}")
-            except Exception as e:
-                print("VALIDATION ERROR ")
-                yield utils.stream_message(
-                    "error", f"An unexpected error occurred: {str(e)}"
-                )
-
-    response = Response(
-        stream_with_context(generate()), mimetype="application/x-ndjson"
+@app.route("/stats", methods=["GET"])
+def stats():
+    return jsonify(
+        {
+            "transcription": transcription_scheduler.stats(),
+            "media_cache": appwrite_service.media_cache.stats(),
+            "negative_cache": appwrite_service.negative_cache.stats(),
+            "manifest": appwrite_service.manifest.stats(),
+            "jobs": job_runner.stats(),
+            "results": result_store.stats(),
+            "stages": stage_limits.stats(),
+        }
     )
+
+
+@app.errorhandler(StageBusy)
+def stage_busy(e):
+    """A stage this request needs has a full queue, the client should back off"""
+    response = jsonify({"error": str(e), "stage": e.stage})
+    response.status_code = 503
+    response.headers["Retry-After"] = str(e.retry_after)
+    return response
+
+
+def stream_response(messages) -> Response:
+    response = Response(messages, mimetype="application/x-ndjson")
     # Add crucial headers for streaming
     response.headers["X-Accel-Buffering"] = "no"
     response.headers["Cache-Control"] = "no-cache"
@@ -144,143 +178,42 @@ def validation_endpoint():
     return response
 
 
+def stream_job(job_id: str, offset: int = 0) -> Response:
+    """NDJSON response following a job's event log from offset"""
+    response = stream_response(job_runner.stream(job_id, offset))
+    response.headers["X-Job-Id"] = job_id
+    return response
+
+
+def options_response(methods: str) -> Response:
+    response = app.make_default_options_response()
+    response.headers.add("Access-Control-Allow-Origin", "*")
+    response.headers.add("Access-Control-Allow-Methods", methods)
+    response.headers.add("Access-Control-Allow-Headers", "Content-Type")
+    return response
+
+
+#! Step 1
+@cross_origin(origin=["*"], headers=["Content-Type", "Authorization"])
+@app.route("/validate", methods=["OPTIONS", "POST"])
+def validation_endpoint():
+    logger.info("Received validation request")
+    if request.method == "OPTIONS":
+        return options_response("POST, OPTIONS")
+
+    job = job_runner.submit("validate", request.json or {})
+    return stream_job(job.id)
+
+
 #! Step 2
 @cross_origin(origin=["*"], headers=["Content-Type", "Authorization"])
 @app.route("/transcribev2", methods=["POST"])
 def transcription_endpoint_v2():
     if request.method == "OPTIONS":
-        response = app.make_default_options_response()
-        response.headers.add("Access-Control-Allow-Origin", "*")
-        response.headers.add("Access-Control-Allow-Methods", "GET, POST, OPTIONS")
-        response.headers.add("Access-Control-Allow-Headers", "Content-Type")
-        return response
-
-    def generate():
-        if request.method == "POST":
-            data = request.json
-            video_id = data.get("id")
-            subtitle_info = data.get("subtitle_info")
-            force_ai_transcription = data.get("force_ai_transcription", False)
-            subtitle_exist = subtitle_info["exist"] and not force_ai_transcription
-
-            try:
-                temp_dir = Path("./temp")
-                temp_dir.mkdir(exist_ok=True)
-                yield utils.stream_message("update", "Initializing transcription...")
-                time.sleep(2)
-                if subtitle_exist:
-                    yield utils.stream_message(
-                        "update", "Retrieving saved subtitles..."
-                    )
-
-                    subtitle_ext = subtitle_info["ext"]
-                    subtitle_file_path = temp_dir / f"{video_id}{subtitle_ext}"
-
-                    if appwrite_service.download_lyrics(
-                        f"{video_id}{subtitle_ext}", subtitle_file_path
-                    ):
-                        if subtitle_file_path.stat().st_size > 0:
-                            processed_srt_path = temp_dir / f"{video_id}.srt"
-                            transcription_result = utils.process_subtitle_file(
-                                str(subtitle_file_path),
-                                subtitle_ext.lstrip(".").split(".")[-1],
-                                apply_error_checks=False,
-                            )
-
-                            # Extract the filtered_srt content
-                            srt_content = transcription_result["filtered_srt"]
-
-                            # Debug logging
-                            print(f"SRT content type: {type(srt_content)}")
-                            print(
-                                f"SRT content preview: {srt_content[:200]}..."
-                            )  # First 200 chars
-
-                            with open(processed_srt_path, "w", encoding="utf-8") as f:
-                                f.write(srt_content)
-
-                            # appwrite_service.upload_srt_subtitle(video_id, temp_dir)
-
-                            ai_generated = False
-                            yield utils.stream_message(
-                                "update",
-                                "Subtitles retrieved and processed successfully.",
-                            )
-                        else:
-                            subtitle_exist = False
-                    else:
-                        subtitle_exist = False
-
-                if not subtitle_exist:
-                    yield utils.stream_message("update", "Transcription in progress...")
-                    time.sleep(1.5)
-                    audio_path = temp_dir / f"{video_id}.m4a"
-                    if not appwrite_service.download_song(
-                        f"{video_id}.m4a", audio_path
-                    ):
-                        audio_path = temp_dir / f"{video_id}.mp4"
-                        if not appwrite_service.download_song(
-                            f"{video_id}.mp4", audio_path
-                        ):
-                            raise Exception("Failed to download audio file")
-                    time.sleep(1.5)
-                    raw_transcription_path = openai_service.get_transcription(
-                        video_id, audio_path
-                    )
-
-                    if raw_transcription_path == "Failed to get transcription":
-                        raise Exception("Failed to generate transcription")
-
-                    if not os.path.exists(raw_transcription_path):
-                        raise FileNotFoundError(
-                            f"Generated SRT file not found: {raw_transcription_path}"
-                        )
-
-                    transcription_result = utils.process_subtitle_file(
-                        raw_transcription_path, "srt", apply_error_checks=True
-                    )
-
-                    # Extract the filtered_srt content
-                    srt_content = transcription_result["filtered_srt"]
-
-                    processed_srt_path = temp_dir / f"{video_id}.srt"
-                    with open(processed_srt_path, "w", encoding="utf-8") as f:
-                        f.write(srt_content)
-
-                    ai_generated = True
-                    yield utils.stream_message(
-                        "update", "Transcription generated successfully."
-                    )
-
-                for file in temp_dir.glob(f"{video_id}*"):
-                    file.unlink(missing_ok=True)
-
-                yield utils.stream_message("ai_generated", ai_generated)
-                yield utils.stream_message(
-                    "transcription",
-                    {
-                        "lyrics": transcription_result["lyrics"],
-                        "timestamped_lyrics": transcription_result[
-                            "timestamped_lyrics"
-                        ],
-                    },
-                )
-
-            except Exception as e:
-                error_message = f"An error occurred during transcription: {str(e)}"
-                print(error_message)
-                yield utils.stream_message("error", error_message)
-                return
-
-    response = Response(
-        stream_with_context(generate()), mimetype="application/x-ndjson"
-    )
-    # Add crucial headers for streaming
-    response.headers["X-Accel-Buffering"] = "no"
-    response.headers["Cache-Control"] = "no-cache"
-    response.headers["Connection"] = "keep-alive"
-    response.headers["Transfer-Encoding"] = "chunked"
-    return response
+        return options_response("GET, POST, OPTIONS")
+
+    job = job_runner.submit("transcribe", request.json or {})
+    return stream_job(job.id)
 
 
 #! Step 3
@@ -288,169 +221,116 @@ def transcription_endpoint_v2():
 @app.route("/translate-annotate", methods=["OPTIONS", "POST"])
 def translate_annotate_endpoint():
     if request.method == "OPTIONS":
-        response = app.make_default_options_response()
-        response.headers.add("Access-Control-Allow-Origin", "*")
-        response.headers.add("Access-Control-Allow-Methods", "POST, OPTIONS")
-        response.headers.add("Access-Control-Allow-Headers", "Content-Type")
-        return response
-
-    def generate():
-        if request.method == "POST":
-            yield utils.stream_message(
-                "update", "Starting translation and annotation process..."
-            )
-
-            try:
-                data = request.json
-                video_id = data.get("id")
-                lyrics_arr = data.get("lyrics")
-                timestamped_lyrics = data.get("timestamped_lyrics")
-
-                # Process lyrics while preserving timestamp relationships
-                try:
-                    cleaned_lyrics, cleaned_timestamped = (
-                        utils.process_lyrics_for_translation(
-                            lyrics_arr, timestamped_lyrics
-                        )
-                    )
-
-                    # Verify timing preservation
-                    if len(cleaned_lyrics) != len(cleaned_timestamped):
-                        raise ValueError(
-                            f"Timing mismatch after processing. Lyrics: {len(cleaned_lyrics)}, "
-                            f"Timestamps: {len(cleaned_timestamped)}"
-                        )
-
-                    # Log processing results for debugging
-                    print(f"Original lyrics count: {len(lyrics_arr)}")
-                    print(f"Processed lyrics count: {len(cleaned_lyrics)}")
-
-                    # Verify timestamp preservation
-                    for i, (orig, processed) in enumerate(
-                        zip(timestamped_lyrics, cleaned_timestamped)
-                    ):
-                        if orig["start_time"] != processed["start_time"]:
-                            print(f"Timestamp mismatch at index {i}")
-                            print(f"Original: {orig}")
-                            print(f"Processed: {processed}")
-
-                except ValueError as e:
-                    yield utils.stream_message(
-                        "error", f"Error processing lyrics: {str(e)}"
-                    )
-                    return
-
-                # Translation step
-                yield utils.stream_message("task_update", "translation")
-                yield utils.stream_message("update", "Generating translations...")
-
-                MAX_RETRIES = 3
-                retry_count = 0
-                translations_completed = False
-
-                while retry_count < MAX_RETRIES and not translations_completed:
-                    try:
-                        for (
-                            translation_type,
-                            translation,
-                        ) in openai_service.get_translations(
-                            cleaned_lyrics, video_id, retry_count
-                        ):
-                            yield utils.stream_message(translation_type, translation)
-
-                        translations_completed = True
-                        yield utils.stream_message(
-                            "update", "Lyrics translated successfully!"
-                        )
-                        time.sleep(1)
-                    except ValueError as e:
-                        print(e)
-                        retry_count += 1
-                        if retry_count == MAX_RETRIES:
-                            yield utils.stream_message(
-                                "error",
-                                "We failed to translate the given lyrics, please try again :(",
-                            )
-                            return
-                        else:
-                            match retry_count:
-                                case 1:
-                                    yield utils.stream_message(
-                                        "update",
-                                        "Retrying translations with an AI who's more creative...",
-                                    )
-                                case 2:
-                                    yield utils.stream_message(
-                                        "update",
-                                        "Retrying translations with an AI who's more serious...",
-                                    )
-                                case 3:
-                                    yield utils.stream_message(
-                                        "update",
-                                        "Final attempt: Unleashing maximum AI creativity for the task!",
-                                    )
-
-                # Romaji annotation step
-                yield utils.stream_message("task_update", "romaji")
-                yield utils.stream_message("update", "Generating romaji lyrics...")
-
-                try:
-                    for (
-                        message_type,
-                        message_content,
-                    ) in romaji_annotator.get_romaji_lyrics(cleaned_lyrics, video_id):
-                        if message_type == "romaji_lyrics":
-                            yield utils.stream_message(message_type, message_content)
-                            yield utils.stream_message(
-                                "update", "Romaji annotated successfully!"
-                            )
-                            yield utils.stream_message("task_update", "kanji")
-                        elif message_type == "error":
-                            yield utils.stream_message(
-                                "error",
-                                f"Romaji generation failed: {message_content}",
-                            )
-                except ValueError:
-                    yield utils.stream_message(
-                        "error",
-                        "We failed to generate romaji for the given lyrics, please try again :(",
-                    )
-
-                # Kanji annotation step
-                yield utils.stream_message("task_update", "kanji")
-                yield utils.stream_message("update", "Generating kanji annotations...")
-
-                try:
-                    for (
-                        kanji_type,
-                        kanji_annotations,
-                    ) in openai_service.get_kanji_annotations(cleaned_lyrics, video_id):
-                        yield utils.stream_message(kanji_type, kanji_annotations)
-                        yield utils.stream_message(
-                            "update", "Kanji annotated successfully!"
-                        )
-                except ValueError as e:
-                    yield utils.stream_message(
-                        "error", f"Kanji annotation failed: {str(e)}"
-                    )
-                    return
-
-                time.sleep(1)
-                yield utils.stream_message("task_update", "completion")
-                yield utils.stream_message("update", "All processes completed!")
-
-            except Exception as e:
-                yield utils.stream_message("error", str(e))
-
-    response = Response(
-        stream_with_context(generate()), mimetype="application/x-ndjson"
+        return options_response("POST, OPTIONS")
+
+    job = job_runner.submit("translate-annotate", request.json or {})
+    return stream_job(job.id)
+
+
+#! All steps
+@cross_origin(origin=["*"], headers=["Content-Type", "Authorization"])
+@app.route("/process", methods=["OPTIONS", "POST"])
+def process_endpoint():
+    """Validation, transcription and translation/annotation in one stream"""
+    if request.method == "OPTIONS":
+        return options_response("POST, OPTIONS")
+
+    job = job_runner.submit("process", request.json or {})
+    return stream_job(job.id)
+
+
+#! Batches
+@cross_origin(origin=["*"], headers=["Content-Type", "Authorization"])
+@app.route("/batch", methods=["OPTIONS", "POST"])
+def batch_endpoint():
+    """
+    Process many videos, given as "ids" and/or a "playlist_id". "parallel"
+    caps the videos in flight (at most BATCH_PARALLEL), "skip_processed"
+    (default true) skips videos that already have a result. The batch runs
+    as a job, a dropped stream can be resumed from /jobs/<id>/events.
+    """
+    if request.method == "OPTIONS":
+        return options_response("POST, OPTIONS")
+
+    data = request.json or {}
+    video_ids = list(data.get("ids") or [])
+    if data.get("playlist_id"):
+        try:
+            video_ids += batch_runner.playlist_video_ids(data["playlist_id"])
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+    if not video_ids:
+        return jsonify({"error": "No video IDs or playlist ID given"}), 400
+    parallel = data.get("parallel")
+    # bool is a subclass of int, true isn't a count
+    if parallel is not None and (
+        not isinstance(parallel, int) or isinstance(parallel, bool) or parallel < 1
+    ):
+        return jsonify({"error": "parallel must be a positive number"}), 400
+
+    params = {}
+    if "force_ai_transcription" in data:
+        params["force_ai_transcription"] = data["force_ai_transcription"]
+    job = batch_runner.submit(
+        video_ids,
+        params,
+        max_parallel=parallel,
+        skip_processed=data.get("skip_processed", True),
     )
-    # Add crucial headers for streaming
-    response.headers["X-Accel-Buffering"] = "no"
-    response.headers["Cache-Control"] = "no-cache"
-    response.headers["Connection"] = "keep-alive"
-    response.headers["Transfer-Encoding"] = "chunked"
-    return response
+    return stream_job(job.id)
+
+
+#! Jobs
+@cross_origin(origin=["*"], headers=["Content-Type", "Authorization"])
+@app.route("/jobs", methods=["POST"])
+def submit_job():
+    """Start a stage without streaming it, body is {"kind": ..., "params": {...}}"""
+    data = request.json or {}
+    try:
+        job = job_runner.submit(data.get("kind"), data.get("params") or {})
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify(job.to_dict()), 202
+
+
+@cross_origin(origin=["*"], headers=["Content-Type", "Authorization"])
+@app.route("/jobs/<job_id>", methods=["GET"])
+def get_job(job_id):
+    job = job_store.get(job_id)
+    if not job:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job.to_dict())
+
+
+@cross_origin(origin=["*"], headers=["Content-Type", "Authorization"])
+@app.route("/jobs/<job_id>/events", methods=["GET"])
+def get_job_events(job_id):
+    """Follow a job's progress, ?offset=N skips the first N events"""
+    if not job_store.get(job_id):
+        return jsonify({"error": "Job not found"}), 404
+    offset = request.args.get("offset", 0, type=int)
+    return stream_job(job_id, max(offset, 0))
+
+
+#! Results
+@cross_origin(origin=["*"], headers=["Content-Type", "Authorization"])
+@app.route("/results/<video_id>", methods=["GET"])
+def get_result(video_id):
+    """
+    Everything the pipeline produced for a processed video. Supports
+    If-None-Match, so clients can cache it and revalidate cheaply.
+    """
+    result = result_store.get(video_id)
+    if not result:
+        return jsonify({"error": "No result for this video"}), 404
+
+    body, etag = result
+    response = Response(body, mimetype="application/json")
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = (
+        f"public, max-age={int(os.getenv('RESULT_MAX_AGE', 3600))}"
+    )
+    return response.make_conditional(request)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,121 @@
+"""
+ASGI entry point. The NDJSON endpoints are served by Starlette with async
+generators, so an open progress stream costs a coroutine instead of one of
+gunicorn's threads; the stages themselves still run on the job worker pool.
+Every other route is the Flask app, mounted as WSGI.
+
+    uvicorn asgi:app --host 0.0.0.0 --port 8080
+"""
+
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Mount, Route
+
+from app import app as flask_app, job_runner, lazy_startup, start_warm_up
+from services.job_runner import JobRunner
+from services.stage_limiter import StageBusy
+
+STREAMING_HEADERS = {
+    "X-Accel-Buffering": "no",
+    "Cache-Control": "no-cache",
+    "Access-Control-Allow-Origin": "*",
+    "Access-Control-Expose-Headers": "X-Job-Id",
+}
+
+
+def options_response(methods: str) -> Response:
+    return Response(
+        status_code=200,
+        headers={
+            "Access-Control-Allow-Origin": "*",
+            "Access-Control-Allow-Methods": methods,
+            "Access-Control-Allow-Headers": "Content-Type",
+        },
+    )
+
+
+def create_app(job_runner: JobRunner, wsgi_app) -> Starlette:
+    """Streaming endpoints on top of job_runner, everything else from wsgi_app"""
+
+    def stream_job(job_id: str, offset: int = 0) -> StreamingResponse:
+        return StreamingResponse(
+            job_runner.astream(job_id, offset),
+            media_type="application/x-ndjson",
+            headers={**STREAMING_HEADERS, "X-Job-Id": job_id},
+        )
+
+    def stage_endpoint(kind: str, methods: str):
+        async def endpoint(request: Request) -> Response:
+            if request.method == "OPTIONS":
+                return options_response(methods)
+            try:
+                data = await request.json()
+            except ValueError:
+                data = {}
+            try:
+                # Joining an in-flight job can wait on the cross-worker file lock
+                job = await run_in_threadpool(job_runner.submit, kind, data or {})
+            except StageBusy as e:
+                return JSONResponse(
+                    {"error": str(e), "stage": e.stage},
+                    status_code=503,
+                    headers={
+                        "Access-Control-Allow-Origin": "*",
+                        "Retry-After": str(e.retry_after),
+                    },
+                )
+            return stream_job(job.id)
+
+        return endpoint
+
+    async def job_events(request: Request) -> Response:
+        job_id = request.path_params["job_id"]
+        if not job_runner.store.get(job_id):
+            return JSONResponse(
+                {"error": "Job not found"},
+                status_code=404,
+                headers={"Access-Control-Allow-Origin": "*"},
+            )
+        try:
+            offset = max(int(request.query_params.get("offset", 0)), 0)
+        except ValueError:
+            offset = 0
+        return stream_job(job_id, offset)
+
+    return Starlette(
+        routes=[
+            Route(
+                "/validate",
+                stage_endpoint("validate", "POST, OPTIONS"),
+                methods=["POST", "OPTIONS"],
+            ),
+            Route(
+                "/transcribev2",
+                stage_endpoint("transcribe", "GET, POST, OPTIONS"),
+                methods=["POST", "OPTIONS"],
+            ),
+            Route(
+                "/translate-annotate",
+                stage_endpoint("translate-annotate", "POST, OPTIONS"),
+                methods=["POST", "OPTIONS"],
+            ),
+            Route(
+                "/process",
+                stage_endpoint("process", "POST, OPTIONS"),
+                methods=["POST", "OPTIONS"],
+            ),
+            Route("/jobs/{job_id}/events", job_events, methods=["GET"]),
+            Mount("/", app=WSGIMiddleware(wsgi_app)),
+        ]
+    )
+
+
+# The services are set up by the Flask app module and shared with it
+app = create_app(job_runner, flask_app)
+
+# uvicorn doesn't fork, the warm-up can start right away
+if lazy_startup:
+    start_warm_up()
@@ -0,0 +1,75 @@
+"""
+Run the whole pipeline for many videos from the command line, e.g. to
+pre-warm a playlist overnight. Uses the same services and settings as the
+server (.env, STAGE_* limits, JOB_STORE...) and prints each item's progress.
+
+    python batch.py tLQLa6lM3Us VyvhvlYvRnc
+    python batch.py --playlist PLzJ1mqwxogpFuFCk1YfUE1c0gWtnIutfz --parallel 3
+"""
+
+import argparse
+import sys
+
+from utils import stream_encoder
+
+# Types of item events worth a line, the rest is the result data
+PRINTED_TYPES = ("update", "task_update", "error")
+
+
+def print_message(message: dict) -> None:
+    data = message["data"]
+    if message["type"] == "item_update":
+        event = data["event"]
+        if event["type"] in PRINTED_TYPES:
+            print(f"[{data['id']}] {event['type']}: {event['data']}")
+    elif message["type"] == "item_done":
+        print(f"[{data['id']}] {data['status']}")
+    elif message["type"] == "batch_done":
+        print(", ".join(f"{len(ids)} {status}" for status, ids in data.items()))
+        if data["failed"]:
+            print(f"Failed: {' '.join(data['failed'])}")
+    elif message["type"] != "heartbeat":
+        print(f"{message['type']}: {data}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("ids", nargs="*", help="YouTube video IDs")
+    parser.add_argument("--playlist", action="append", default=[], help="Playlist ID")
+    parser.add_argument("--parallel", type=int, default=None)
+    parser.add_argument("--force-ai-transcription", action="store_true")
+    parser.add_argument(
+        "--reprocess", action="store_true", help="Also run videos with a result"
+    )
+    parser.add_argument("--json", action="store_true", help="Print raw NDJSON")
+    args = parser.parse_args()
+
+    # Sets up the services the same way the server does
+    from app import batch_runner
+
+    video_ids = list(args.ids)
+    for playlist_id in args.playlist:
+        video_ids += batch_runner.playlist_video_ids(playlist_id)
+    if not video_ids:
+        parser.error("no video IDs or playlists given")
+
+    params = {}
+    if args.force_ai_transcription:
+        params["force_ai_transcription"] = True
+
+    failed = False
+    for line in batch_runner.run(
+        video_ids,
+        params,
+        max_parallel=args.parallel,
+        skip_processed=not args.reprocess,
+    ):
+        message = stream_encoder.loads(line)
+        if message["type"] == "batch_done":
+            failed = bool(message["data"]["failed"])
+        if args.json:
+            sys.stdout.buffer.write(line)
+        else:
+            print_message(message)
+        sys.stdout.flush()
+    sys.exit(1 if failed else 0)
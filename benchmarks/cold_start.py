@@ -0,0 +1,124 @@
+"""
+Cold start of the server, with STARTUP_MODE=eager and lazy.
+
+Reports the modules that take longest to import with `import app` (from
+python -X importtime), then starts the server the way the Dockerfile does
+and measures the time from launch to the first response. Fails when the
+lazy startup's first response takes longer than --target-s.
+
+    python -m benchmarks.cold_start
+    python -m benchmarks.cold_start --mode asgi --top 10
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from benchmarks.stream_capacity import free_port, wait_for_server
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# Cloud Run routes requests once the port is open, a cold start should
+# answer within this many seconds of the container starting
+COLD_START_TARGET = 2.0
+
+# The Dockerfile's gunicorn settings
+GUNICORN_CONFIG = """
+worker_class = "gthread"
+workers = 1
+threads = 8
+timeout = 300
+preload_app = True
+loglevel = "warning"
+
+def post_worker_init(worker):
+    app = __import__("app")
+    if app.lazy_startup:
+        app.start_warm_up()
+"""
+
+
+def import_times(startup_mode: str) -> tuple[float, list[tuple[str, float]]]:
+    """Seconds `import app` takes and (module, seconds) of its direct imports"""
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import app"],
+        cwd=ROOT,
+        env={**os.environ, "STARTUP_MODE": startup_mode, "LOG_FILE": ""},
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    total = 0.0
+    modules = []
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        seconds = int(cumulative) / 1e6
+        # The modules app imports itself are indented two more spaces than app
+        if name.rstrip() == " app":
+            total = seconds
+        elif name.startswith("   ") and not name.startswith("    "):
+            modules.append((name.strip(), seconds))
+    return total, sorted(modules, key=lambda module: module[1], reverse=True)
+
+
+def first_response(mode: str, startup_mode: str, port: int) -> float:
+    """Seconds from launching the server to its first response"""
+    with tempfile.NamedTemporaryFile("w", suffix=".py") as config:
+        config.write(GUNICORN_CONFIG)
+        config.flush()
+        if mode == "asgi":
+            command = [sys.executable, "-m", "uvicorn", "asgi:app"]
+            command += ["--port", str(port), "--log-level", "warning"]
+        else:
+            command = [sys.executable, "-m", "gunicorn", "--config", config.name]
+            command += ["--bind", f"127.0.0.1:{port}", "app:app"]
+
+        started = time.perf_counter()
+        server = subprocess.Popen(
+            command,
+            cwd=ROOT,
+            env={**os.environ, "STARTUP_MODE": startup_mode, "LOG_FILE": ""},
+            stdout=subprocess.DEVNULL,
+        )
+        try:
+            wait_for_server(port, server)
+            return time.perf_counter() - started
+        finally:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--mode", choices=("wsgi", "asgi"), default="wsgi")
+    parser.add_argument("--top", type=int, default=8)
+    parser.add_argument("--target-s", type=float, default=COLD_START_TARGET)
+    parser.add_argument(
+        "--imports-only", action="store_true", help="Don't start the server"
+    )
+    args = parser.parse_args()
+
+    results = {}
+    for startup_mode in ("eager", "lazy"):
+        total, modules = import_times(startup_mode)
+        print(f"{startup_mode}: import app {total:.3f}s")
+        for name, seconds in modules[: args.top]:
+            print(f"  {name:<40} {seconds:.3f}s")
+
+        if not args.imports_only:
+            results[startup_mode] = first_response(args.mode, startup_mode, free_port())
+            print(f"  first response after {results[startup_mode]:.2f}s")
+
+    if results:
+        passed = results["lazy"] <= args.target_s
+        print(
+            f"{args.mode} lazy cold start {results['lazy']:.2f}s, "
+            f"target {args.target_s:.2f}s: {'ok' if passed else 'too slow'}"
+        )
+        sys.exit(0 if passed else 1)
@@ -0,0 +1,116 @@
+"""
+Storage paths of /validate replayed offline against LocalStorage.
+
+Uploads audio and metadata for a set of fake videos, downloads them back
+cold (as /validate does for a stored video) and repeats existence checks
+for files that don't exist, reporting wall time and storage calls for
+each phase. Latency, bandwidth and fault rate are configurable and the
+run is seeded, so caching and parallelism changes can be compared
+reproducibly:
+
+    python -m benchmarks.local_storage --latency-ms 80 --bandwidth 4000000
+    python -m benchmarks.local_storage --negative-ttl 0 --manifest-interval 0
+"""
+
+import argparse
+import os
+import random
+import tempfile
+import time
+from pathlib import Path
+
+from services.appwrite_service import AppwriteService
+from services.storage_backend import LocalStorage
+
+
+def make_videos(media_dir: Path, count: int, size: int, seed: int) -> list[str]:
+    rng = random.Random(seed)
+    video_ids = []
+    for i in range(count):
+        video_id = f"bench{i:06d}"
+        (media_dir / f"{video_id}.m4a").write_bytes(rng.randbytes(size))
+        (media_dir / f"{video_id}.info.json").write_text(
+            f'{{"id": "{video_id}", "duration": {rng.randint(60, 480)}}}'
+        )
+        video_ids.append(video_id)
+    return video_ids
+
+
+def phase(label: str, storage: LocalStorage, func) -> None:
+    calls_before = storage.calls
+    started = time.perf_counter()
+    results = func()
+    elapsed = time.perf_counter() - started
+    ok = sum(1 for result in results if result)
+    print(
+        f"{label:>16}: {elapsed:7.2f}s  {storage.calls - calls_before:5d} calls"
+        f"  {ok}/{len(results)} ok"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--videos", type=int, default=20)
+    parser.add_argument("--size-kb", type=int, default=512)
+    parser.add_argument("--latency-ms", type=float, default=50)
+    parser.add_argument("--jitter-ms", type=float, default=10)
+    parser.add_argument("--bandwidth", type=float, default=None, help="bytes/s")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--negative-ttl", type=float, default=30)
+    parser.add_argument("--manifest-interval", type=float, default=0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    os.environ["NEGATIVE_CACHE_TTL"] = str(args.negative_ttl)
+    os.environ["MANIFEST_REFRESH_INTERVAL"] = str(args.manifest_interval)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        source_dir, download_dir = tmp / "source", tmp / "download"
+        source_dir.mkdir()
+        download_dir.mkdir()
+
+        storage = LocalStorage(
+            tmp / "storage",
+            latency=args.latency_ms / 1000,
+            jitter=args.jitter_ms / 1000,
+            bandwidth=args.bandwidth,
+            error_rate=args.error_rate,
+            seed=args.seed,
+        )
+        os.environ.setdefault("APPWRITE_STORAGE_SONGS_ID", "songs")
+        os.environ.setdefault("APPWRITE_STORAGE_LYRICS_ID", "lyrics")
+        service = AppwriteService(storage=storage)
+        video_ids = make_videos(
+            source_dir, args.videos, args.size_kb * 1024, args.seed
+        )
+
+        print(
+            f"{args.videos} videos of {args.size_kb}KB, {args.latency_ms}ms latency, "
+            f"error rate {args.error_rate}, seed {args.seed}"
+        )
+        phase(
+            "upload",
+            storage,
+            lambda: [
+                all(service.upload_song_with_metadata(video_id, source_dir))
+                for video_id in video_ids
+            ],
+        )
+        phase(
+            "cold download",
+            storage,
+            lambda: [
+                service.get_or_download_video_files(video_id, download_dir)[0]
+                for video_id in video_ids
+            ],
+        )
+        for attempt in (1, 2):
+            phase(
+                f"missing check #{attempt}",
+                storage,
+                lambda: [
+                    not service.file_exists_in_songs_bucket(f"missing{i:05d}", ".m4a")
+                    for i in range(len(video_ids))
+                ],
+            )
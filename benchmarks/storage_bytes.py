@@ -0,0 +1,78 @@
+"""
+Bytes transferred by the storage existence checks a /validate request makes.
+
+Counts response bytes for every Appwrite call while replaying the checks
+/validate runs for an already-stored video: audio and metadata existence
+in the songs bucket, then the lyrics existence check. "before" uses
+get_file_view (downloads the content), "after" uses get_file metadata and
+the batched list_files query. Needs the usual APPWRITE_* variables.
+
+    python -m benchmarks.storage_bytes <video_id>
+"""
+
+import argparse
+from unittest import mock
+
+import appwrite.client
+from appwrite.exception import AppwriteException
+from dotenv import load_dotenv
+
+from services.appwrite_service import AppwriteService
+
+_request = appwrite.client.requests.request
+
+
+class ByteCounter:
+    def __init__(self):
+        self.calls = 0
+        self.bytes = 0
+
+    def request(self, *args, **kwargs):
+        response = _request(*args, **kwargs)
+        self.calls += 1
+        self.bytes += len(response.content)
+        return response
+
+
+def legacy_exists(service: AppwriteService, bucket_id: str, file_id: str) -> bool:
+    """The previous implementation, which fetched the whole file"""
+    try:
+        service.storage.get_file_view(bucket_id, file_id)
+        return True
+    except AppwriteException:
+        return False
+
+
+def measure(label: str, checks) -> None:
+    counter = ByteCounter()
+    with mock.patch.object(appwrite.client.requests, "request", counter.request):
+        results = checks()
+    print(f"{label:>7}: {counter.calls} calls, {counter.bytes:,} bytes -> {results}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("video_id")
+    args = parser.parse_args()
+
+    load_dotenv(override=True)
+    service = AppwriteService()
+    appwrite_id = service.create_appwrite_id(args.video_id)
+
+    measure(
+        "before",
+        lambda: [
+            legacy_exists(service, service.songs_bucket_id, f"{appwrite_id}.m4a"),
+            legacy_exists(service, service.songs_bucket_id, f"{appwrite_id}.info.json"),
+            legacy_exists(service, service.lyrics_bucket_id, f"{appwrite_id}.srt"),
+        ],
+    )
+    measure(
+        "after",
+        lambda: [
+            service.files_exist_in_bucket(
+                service.songs_bucket_id, appwrite_id, [".m4a", ".info.json"]
+            ),
+            service.file_exists_in_lyrics_bucket(args.video_id, ".srt"),
+        ],
+    )
@@ -0,0 +1,203 @@
+"""
+Concurrent progress streams under gunicorn gthread and under the ASGI app.
+
+Starts the server in a subprocess with the pipeline stages replaced by a
+synthetic one that sends --events messages over --stage-seconds, so only
+the serving of streams is measured. Then opens --streams concurrent
+/validate streams and reports time to first event, time to the end of
+the stream and the server's resident memory per open stream. The wsgi
+mode uses the Dockerfile's gunicorn settings (1 worker, 8 threads).
+
+    python -m benchmarks.stream_capacity --mode wsgi --streams 64
+    python -m benchmarks.stream_capacity --mode asgi --streams 64
+"""
+
+import argparse
+import asyncio
+import logging
+import socket
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import httpx
+
+from utils import utils
+
+
+class SyntheticPipeline:
+    STAGES = {"validate": "validate"}
+
+    def __init__(self, stage_seconds: float, events: int):
+        self.stage_seconds = stage_seconds
+        self.events = events
+
+    def admit(self, kind: str) -> None:
+        pass
+
+    def run(self, kind: str, data: dict):
+        for i in range(self.events):
+            time.sleep(self.stage_seconds / self.events)
+            yield utils.stream_message("update", f"Step {i + 1} of {self.events}")
+
+
+def serve(mode: str, port: int, stage_seconds: float, events: int) -> None:
+    import app as flask_module
+
+    logging.getLogger().setLevel(logging.WARNING)
+    flask_module.job_runner.pipeline = SyntheticPipeline(stage_seconds, events)
+    # Enough job workers that running the stages is never the bottleneck
+    flask_module.job_runner.max_workers = 1024
+
+    if mode == "asgi":
+        import uvicorn
+        from asgi import app as asgi_app
+
+        uvicorn.run(asgi_app, host="127.0.0.1", port=port, log_level="warning")
+        return
+
+    from gunicorn.app.base import BaseApplication
+
+    class Server(BaseApplication):
+        def load_config(self):
+            settings = {
+                "bind": f"127.0.0.1:{port}",
+                "worker_class": "gthread",
+                "workers": 1,
+                "threads": 8,
+                "timeout": 300,
+                "keepalive": 65,
+                "loglevel": "warning",
+            }
+            for name, value in settings.items():
+                self.cfg.set(name, value)
+
+        def load(self):
+            return flask_module.app
+
+    Server().run()
+
+
+def tree_rss(pid: int) -> int:
+    """Resident bytes of a process and its children (gunicorn forks a worker)"""
+    total = 0
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        try:
+            status = Path(f"/proc/{current}/status").read_text()
+            children = Path(f"/proc/{current}/task/{current}/children").read_text()
+        except OSError:
+            continue
+        for line in status.splitlines():
+            if line.startswith("VmRSS:"):
+                total += int(line.split()[1]) * 1024
+        pending.extend(int(child) for child in children.split())
+    return total
+
+
+async def open_stream(client: httpx.AsyncClient, index: int) -> tuple[float, float]:
+    started = time.perf_counter()
+    first_event = None
+    async with client.stream(
+        "POST", "/validate", json={"id": f"stream{index:05d}"}
+    ) as response:
+        async for line in response.aiter_lines():
+            if line and first_event is None:
+                first_event = time.perf_counter() - started
+    return first_event or 0.0, time.perf_counter() - started
+
+
+async def run_streams(port: int, streams: int, pid: int) -> dict:
+    peak_rss = 0
+    done = asyncio.Event()
+
+    async def sample_rss():
+        nonlocal peak_rss
+        while not done.is_set():
+            peak_rss = max(peak_rss, tree_rss(pid))
+            await asyncio.sleep(0.05)
+
+    baseline_rss = tree_rss(pid)
+    sampler = asyncio.create_task(sample_rss())
+    async with httpx.AsyncClient(
+        base_url=f"http://127.0.0.1:{port}",
+        timeout=None,
+        limits=httpx.Limits(max_connections=None),
+    ) as client:
+        started = time.perf_counter()
+        results = await asyncio.gather(
+            *(open_stream(client, i) for i in range(streams))
+        )
+        elapsed = time.perf_counter() - started
+    done.set()
+    await sampler
+
+    first_events = sorted(first for first, _ in results)
+    totals = sorted(total for _, total in results)
+    return {
+        "wall_s": round(elapsed, 2),
+        "first_event_p50": round(first_events[len(first_events) // 2], 2),
+        "first_event_max": round(first_events[-1], 2),
+        "stream_p50": round(totals[len(totals) // 2], 2),
+        "stream_max": round(totals[-1], 2),
+        "rss_mb": round(baseline_rss / 2**20, 1),
+        "rss_per_stream_kb": round((peak_rss - baseline_rss) / streams / 1024, 1),
+    }
+
+
+def wait_for_server(port: int, process: subprocess.Popen, timeout: float = 60) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("Server exited during startup")
+        try:
+            if httpx.get(f"http://127.0.0.1:{port}/", timeout=1).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError("Server didn't start in time")
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--mode", choices=("wsgi", "asgi"), default="wsgi")
+    parser.add_argument("--streams", type=int, default=64)
+    parser.add_argument("--stage-seconds", type=float, default=5.0)
+    parser.add_argument("--events", type=int, default=20)
+    parser.add_argument("--port", type=int, default=None)
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.mode, args.port, args.stage_seconds, args.events)
+        sys.exit(0)
+
+    port = args.port or free_port()
+    server = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "benchmarks.stream_capacity",
+            "--serve",
+            f"--mode={args.mode}",
+            f"--port={port}",
+            f"--stage-seconds={args.stage_seconds}",
+            f"--events={args.events}",
+        ]
+    )
+    try:
+        wait_for_server(port, server)
+        result = asyncio.run(run_streams(port, args.streams, server.pid))
+        print(f"{args.mode}: {args.streams} streams of {args.stage_seconds}s: {result}")
+    finally:
+        server.terminate()
+        server.wait()
@@ -0,0 +1,129 @@
+"""
+Cost of encoding and writing progress events.
+
+Serializes typical messages (short updates, a vid_info payload and a full
+transcription) with the stdlib json module and with orjson, then streams
+a job that emits --events messages in bursts through JobRunner.stream with
+and without lingering, and reports the writes per event and the encoding
+overhead per event.
+
+    python -m benchmarks.stream_encoding
+    python -m benchmarks.stream_encoding --events 2000 --burst 20
+"""
+
+import argparse
+import json
+import time
+
+from services.job_runner import JobRunner
+from services.job_store import MemoryJobStore
+from utils import stream_encoder, utils
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def payloads() -> dict:
+    lines = [
+        {"start": i * 2.5, "end": i * 2.5 + 2.4, "text": f"歌詞の行 {i} lyric line"}
+        for i in range(400)
+    ]
+    return {
+        "update": {"type": "update", "data": "Transcribing audio (42%)"},
+        "vid_info": {
+            "type": "vid_info",
+            "data": {
+                "id": "dQw4w9WgXcQ",
+                "title": "Never Gonna Give You Up",
+                "channel": "Rick Astley",
+                "duration": 213,
+                "thumbnail": "https://i.ytimg.com/vi/dQw4w9WgXcQ/maxresdefault.jpg",
+                "language": "en",
+            },
+        },
+        "transcription": {"type": "transcription", "data": lines},
+    }
+
+
+def time_encoder(encode, obj, rounds: int) -> float:
+    started = time.perf_counter()
+    for _ in range(rounds):
+        encode(obj)
+    return (time.perf_counter() - started) / rounds
+
+
+def encoding(rounds: int) -> None:
+    encoders = {
+        "json": lambda obj: (json.dumps(obj) + "\n").encode("utf-8"),
+        "stream_encoder": lambda obj: stream_encoder.dumps(obj) + b"\n",
+    }
+    if orjson:
+        encoders["orjson"] = lambda obj: orjson.dumps(obj) + b"\n"
+
+    for name, obj in payloads().items():
+        size = len(stream_encoder.dumps(obj))
+        results = {
+            encoder: round(time_encoder(encode, obj, rounds) * 1e6, 2)
+            for encoder, encode in encoders.items()
+        }
+        print(f"encode {name} ({size} bytes), us per message: {results}")
+
+
+class BurstPipeline:
+    STAGES = {"validate": "validate"}
+
+    def __init__(self, events: int, burst: int, pause: float):
+        self.events = events
+        self.burst = burst
+        self.pause = pause
+
+    def admit(self, kind: str) -> None:
+        pass
+
+    def run(self, kind: str, data: dict):
+        for i in range(self.events):
+            if i and i % self.burst == 0:
+                time.sleep(self.pause)
+            yield utils.stream_message("update", f"Step {i + 1} of {self.events}")
+
+
+def streaming(events: int, burst: int, pause: float, linger: float) -> dict:
+    runner = JobRunner(
+        MemoryJobStore(),
+        BurstPipeline(events, burst, pause),
+        max_workers=1,
+        coalesce=False,
+        linger=linger,
+    )
+    job = runner.submit("validate", {})
+    started = time.perf_counter()
+    writes = 0
+    received = 0
+    for chunk in runner.stream(job.id):
+        writes += 1
+        received += chunk.count(b"\n")
+    elapsed = time.perf_counter() - started
+    return {
+        "events": received,
+        "writes": writes,
+        "events_per_write": round(received / writes, 1),
+        "wall_s": round(elapsed, 3),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rounds", type=int, default=2000)
+    parser.add_argument("--events", type=int, default=1000)
+    parser.add_argument("--burst", type=int, default=10)
+    parser.add_argument("--pause", type=float, default=0.002)
+    parser.add_argument("--linger-ms", type=float, default=5.0)
+    args = parser.parse_args()
+
+    print(f"JSON backend: {stream_encoder.JSON_BACKEND}")
+    encoding(args.rounds)
+    for linger in (0.0, args.linger_ms / 1000):
+        result = streaming(args.events, args.burst, args.pause, linger)
+        print(f"stream with {linger * 1000:g}ms linger: {result}")
@@ -0,0 +1,76 @@
+"""
+Simulated load test for the Whisper transcription scheduler.
+
+Replays a burst of songs with realistic durations against the scheduler,
+with each "Whisper call" sleeping in proportion to the song length, and
+compares FIFO ordering with shortest-job-first plus aging.
+
+    python -m benchmarks.transcription_scheduler --jobs 40 --concurrency 2
+"""
+
+import argparse
+import random
+import threading
+import time
+
+from services.transcription_scheduler import TranscriptionScheduler
+
+
+def run_load(
+    aging_rate: float, durations: list, concurrency: int, time_scale: float
+) -> dict:
+    scheduler = TranscriptionScheduler(
+        max_concurrent=concurrency, aging_rate=aging_rate
+    )
+    latencies = {}
+
+    def fake_whisper(duration):
+        time.sleep(duration * time_scale)
+
+    def client(index, duration):
+        started = time.monotonic()
+        scheduler.submit(duration, fake_whisper, duration).future.result()
+        latencies[index] = (duration, time.monotonic() - started)
+
+    started = time.monotonic()
+    threads = [
+        threading.Thread(target=client, args=(i, d)) for i, d in enumerate(durations)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+
+    short = sorted(lat for d, lat in latencies.values() if d < 180)
+    all_latencies = sorted(lat for _, lat in latencies.values())
+    return {
+        "throughput_per_s": round(len(durations) / elapsed, 2),
+        "p50": round(all_latencies[len(all_latencies) // 2], 2),
+        "p95": round(all_latencies[int(len(all_latencies) * 0.95) - 1], 2),
+        "short_p95": round(short[int(len(short) * 0.95) - 1], 2) if short else None,
+        "scheduler": scheduler.stats(),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--jobs", type=int, default=40)
+    parser.add_argument("--concurrency", type=int, default=2)
+    parser.add_argument(
+        "--time-scale",
+        type=float,
+        default=0.002,
+        help="Simulated seconds of Whisper time per second of audio",
+    )
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    # Songs accepted by /validate are 1-8 minutes long
+    durations = [random.uniform(60, 480) for _ in range(args.jobs)]
+
+    # A huge aging rate makes enqueue time dominate, i.e. plain FIFO
+    for name, aging_rate in (("fifo", 1e9), ("sjf+aging", 1.0)):
+        result = run_load(aging_rate, durations, args.concurrency, args.time_scale)
+        print(f"{name:>10}: {result}")
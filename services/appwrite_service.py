@@ -1,18 +1,31 @@
 from pathlib import Path
-from typing import Optional
+from typing import BinaryIO, Optional
 from dataclasses import dataclass
+import hashlib
+import io
 import os
+import tempfile
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+import requests
 from appwrite.client import Client
-from appwrite.services.storage import Storage
 from appwrite.input_file import InputFile
 from appwrite.exception import AppwriteException
 from appwrite.query import Query
 import logging
 
+from services.bucket_manifest import BucketManifest
+from services.content_store import ContentStore
+from services.media_cache import MediaCache
+from services.negative_cache import NegativeCache
+from services.storage_backend import AppwriteStorage, LocalStorage
+from services.upload_coordinator import Artifact, UploadCoordinator
+from utils.utils import log_handlers
+
 logging.basicConfig(
-    level=logging.DEBUG,
+    level=os.getenv("LOG_LEVEL", "DEBUG").upper(),
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    handlers=[logging.StreamHandler(), logging.FileHandler("app.log")],
+    handlers=log_handlers(),
 )
 logger = logging.getLogger(__name__)
 
@@ -32,38 +45,107 @@ class AppwriteService:
     SUPPORTED_SUBTITLE_FORMATS = (".ja.vtt", ".ja.srt", ".ja.ass", ".ja.ssa")
     SUPPORTED_AUDIO_FORMATS = (".m4a", ".mp4")
     APPWRITE_ID_PREFIX = "yt_"
-
-    def __init__(self):
-        # Check for required environment variables
-        required_env_vars = ["APPWRITE_PROJECT_ID", "APPWRITE_KEY"]
-        missing_vars = [var for var in required_env_vars if not os.getenv(var)]
-        if missing_vars:
-            raise ValueError(
-                f"Missing required environment variables: {', '.join(missing_vars)}"
+    APPWRITE_ENDPOINT = "https://cloud.appwrite.io/v1"
+    DOWNLOAD_CHUNK_SIZE = 256 * 1024
+    # Downloads larger than this are buffered in a temp file instead of memory
+    SPOOL_MAX_MEMORY = 16 * 1024 * 1024
+    DEFAULT_MEDIA_CACHE_MAX_BYTES = 256 * 1024 * 1024
+    # Same chunk size the SDK uses for chunked uploads
+    UPLOAD_CHUNK_SIZE = 5 * 1024 * 1024
+    # Send the chunks of large audio uploads concurrently
+    UPLOAD_PARALLEL_CHUNKS = os.getenv("UPLOAD_PARALLEL_CHUNKS", "false") == "true"
+    # Store audio and subtitles once per distinct content, see ContentStore
+    STORAGE_DEDUP = os.getenv("STORAGE_DEDUP", "false") == "true"
+    # Results alternate between two file IDs, see upload_result
+    RESULT_SLOTS = ("a", "b")
+
+    def __init__(self, storage=None):
+        """
+        storage: backend to use instead of the one chosen by STORAGE_BACKEND,
+        anything implementing the calls LocalStorage implements
+        """
+        local = os.getenv("STORAGE_BACKEND", "appwrite") == "local"
+
+        if storage is not None:
+            self.storage = storage
+        elif local:
+            # Offline stand-in, see LocalStorage for the fault injection knobs
+            self.storage = LocalStorage(
+                Path(os.getenv("STORAGE_LOCAL_ROOT", "local_storage")),
+                latency=float(os.getenv("STORAGE_LATENCY_MS", 0)) / 1000,
+                jitter=float(os.getenv("STORAGE_JITTER_MS", 0)) / 1000,
+                bandwidth=float(os.getenv("STORAGE_BANDWIDTH_BPS", 0)) or None,
+                error_rate=float(os.getenv("STORAGE_ERROR_RATE", 0)),
+                seed=(
+                    int(os.getenv("STORAGE_SEED"))
+                    if os.getenv("STORAGE_SEED")
+                    else None
+                ),
             )
+        else:
+            # Check for required environment variables
+            required_env_vars = ["APPWRITE_PROJECT_ID", "APPWRITE_KEY"]
+            missing_vars = [var for var in required_env_vars if not os.getenv(var)]
+            if missing_vars:
+                raise ValueError(
+                    f"Missing required environment variables: {', '.join(missing_vars)}"
+                )
 
-        # Initialize Appwrite client
-        self.client = Client()
-        self.client.set_endpoint("https://cloud.appwrite.io/v1")
-        self.client.set_project(os.getenv("APPWRITE_PROJECT_ID"))
-        self.client.set_key(os.getenv("APPWRITE_KEY"))
+            # Initialize Appwrite client
+            self.client = Client()
+            self.client.set_endpoint(self.APPWRITE_ENDPOINT)
+            self.client.set_project(os.getenv("APPWRITE_PROJECT_ID"))
+            self.client.set_key(os.getenv("APPWRITE_KEY"))
+
+            # Pooled HTTP session for streaming downloads the SDK can't do
+            http = requests.Session()
+            http.headers.update(
+                {
+                    "x-appwrite-project": os.getenv("APPWRITE_PROJECT_ID"),
+                    "x-appwrite-key": os.getenv("APPWRITE_KEY"),
+                }
+            )
 
-        # Initialize storage service
-        self.storage = Storage(self.client)
+            # Initialize storage service
+            self.storage = AppwriteStorage(self.client, self.APPWRITE_ENDPOINT, http)
 
-        # Get bucket IDs from environment
-        self.lyrics_bucket_id = os.getenv("APPWRITE_STORAGE_LYRICS_ID")
-        self.songs_bucket_id = os.getenv("APPWRITE_STORAGE_SONGS_ID")
+        # Get bucket IDs from environment, the local backend doesn't need them set
+        self.lyrics_bucket_id = os.getenv(
+            "APPWRITE_STORAGE_LYRICS_ID", "lyrics" if local else None
+        )
+        self.songs_bucket_id = os.getenv(
+            "APPWRITE_STORAGE_SONGS_ID", "songs" if local else None
+        )
 
         # Get the directory where the application code is running
         self.PROJECT_ROOT = Path(__file__).parent.parent
         # Create media directory relative to the application root
         self.media_dir = self.PROJECT_ROOT / "media"
         self.media_dir.mkdir(exist_ok=True, parents=True)
+        self.media_cache = MediaCache(
+            self.media_dir,
+            max_bytes=int(
+                os.getenv("MEDIA_CACHE_MAX_BYTES", self.DEFAULT_MEDIA_CACHE_MAX_BYTES)
+            ),
+            diagnostics=os.getenv("MEDIA_DIAGNOSTICS", "false") == "true",
+        )
+        self.negative_cache = NegativeCache(
+            ttl=float(os.getenv("NEGATIVE_CACHE_TTL", 30))
+        )
+        self.upload_coordinator = UploadCoordinator(
+            self, max_parallel=int(os.getenv("UPLOAD_MAX_PARALLEL", 3))
+        )
 
         if not all([self.lyrics_bucket_id, self.songs_bucket_id]):
             raise ValueError("Missing required bucket IDs")
 
+        self.manifest = BucketManifest(
+            self.storage,
+            [self.songs_bucket_id, self.lyrics_bucket_id],
+            refresh_interval=float(os.getenv("MANIFEST_REFRESH_INTERVAL", 300)),
+        )
+        self.content_store = ContentStore(self)
+
     @staticmethod
     def validate_youtube_id_for_appwrite(id: str) -> bool:
         """
@@ -115,17 +197,114 @@ class AppwriteService:
     def file_exists_in_bucket(
         self, bucket_id: str, youtube_id: str, extension: str = ""
     ) -> bool:
-        """Check if a file exists in the specified bucket using encoded ID if necessary"""
+        """
+        Check if a file exists in the specified bucket using encoded ID if necessary.
+        Only fetches the file's metadata, never its content.
+        """
         file_id = self.get_file_id_with_extension(youtube_id, extension)
+        if self.manifest.contains(bucket_id, file_id):
+            return True
+
+        # Not listed yet doesn't mean missing, it may have been stored elsewhere
         try:
-            self.storage.get_file_view(bucket_id, file_id)
+            metadata = self.get_file_metadata(bucket_id, file_id)
+            self.manifest.add(
+                bucket_id,
+                file_id,
+                target=ContentStore.pointer_target(metadata.get("name")),
+            )
             return True
         except AppwriteException as e:
-            if "404" in str(e):
+            if self._is_not_found(e):
                 return False
             print(f"Error checking file existence: {str(e)}")
             raise
 
+    def stored_formats(self, bucket_id: str, youtube_id: str) -> set[str]:
+        """
+        Extensions the manifest lists for a video, e.g. {".m4a", ".info.json"}.
+        May be incomplete until the manifest's first refresh.
+        """
+        return self.manifest.formats(bucket_id, self.create_appwrite_id(youtube_id))
+
+    def resolve_file_id(self, bucket_id: str, file_id: str) -> str:
+        """ID of the file holding the content, the blob for deduplicated files"""
+        if not self.manifest.contains(bucket_id, file_id):
+            metadata = self.get_file_metadata(bucket_id, file_id)
+            self.manifest.add(
+                bucket_id,
+                file_id,
+                target=ContentStore.pointer_target(metadata.get("name")),
+            )
+        return self.manifest.target(bucket_id, file_id) or file_id
+
+    def get_file_metadata(self, bucket_id: str, file_id: str) -> dict:
+        """
+        Fetch a file's metadata, answering from the negative cache if storage
+        recently said the file doesn't exist. Raises AppwriteException (404)
+        for missing files.
+        """
+        self._raise_if_known_missing(bucket_id, file_id)
+        try:
+            return self.storage.get_file(bucket_id, file_id)
+        except AppwriteException as e:
+            if self._is_not_found(e):
+                self.negative_cache.record_miss(bucket_id, file_id)
+            raise
+
+    def _raise_if_known_missing(self, bucket_id: str, file_id: str) -> None:
+        if self.negative_cache.is_missing(bucket_id, file_id):
+            raise AppwriteException(f"File not found (cached): {file_id}", 404)
+
+    @staticmethod
+    def _is_not_found(e: AppwriteException) -> bool:
+        return e.code == 404 or "404" in str(e)
+
+    def files_exist_in_bucket(
+        self, bucket_id: str, youtube_id: str, extensions: list[str]
+    ) -> dict[str, bool]:
+        """
+        Check several extensions of the same video with a single list_files query.
+        Returns {extension: exists}.
+        """
+        file_ids = {
+            self.get_file_id_with_extension(youtube_id, ext): ext for ext in extensions
+        }
+        found = {
+            file_id
+            for file_id in file_ids
+            if self.manifest.contains(bucket_id, file_id)
+        }
+        unknown = [
+            file_id
+            for file_id in file_ids
+            if file_id not in found
+            and not self.negative_cache.is_missing(bucket_id, file_id)
+        ]
+
+        if unknown:
+            response = self.storage.list_files(
+                bucket_id,
+                queries=[
+                    Query.equal("$id", unknown),
+                    Query.limit(len(unknown)),
+                ],
+            )
+            listed = {
+                file.get("$id"): file.get("name") for file in response.get("files", [])
+            }
+            for file_id in unknown:
+                if file_id in listed:
+                    self.manifest.add(
+                        bucket_id,
+                        file_id,
+                        target=ContentStore.pointer_target(listed[file_id]),
+                    )
+                else:
+                    self.negative_cache.record_miss(bucket_id, file_id)
+            found |= set(listed)
+        return {ext: file_id in found for file_id, ext in file_ids.items()}
+
     def file_exists_in_lyrics_bucket(
         self, youtube_id: str, extension: str = ""
     ) -> bool:
@@ -164,10 +343,7 @@ class AppwriteService:
             return True
 
         try:
-            input_file = InputFile.from_path(str(subtitle.path))
-            self.storage.create_file(
-                bucket_id=self.lyrics_bucket_id, file_id=file_id, file=input_file
-            )
+            self._store(self.lyrics_bucket_id, file_id, subtitle.path)
             print(f"Successfully uploaded lyrics: {file_id}")
             return True
         except Exception as e:
@@ -179,15 +355,7 @@ class AppwriteService:
     ) -> bool:
         """Download a lyrics file from storage and save it to the specified path"""
         try:
-            save_path.parent.mkdir(parents=True, exist_ok=True)
-
-            # Get file from storage
-            response = self.storage.get_file_download(bucket_id, file_name)
-
-            # Write bytes response to file
-            with open(save_path, "wb") as f:
-                f.write(response)
-
+            self.stream_download_to_path(bucket_id, file_name, save_path)
             logger.debug(f"Successfully downloaded lyrics file to: {save_path}")
             return True
 
@@ -201,31 +369,125 @@ class AppwriteService:
         """Download a file using encoded ID if necessary"""
         try:
             file_id = self.get_file_id_with_extension(youtube_id, extension)
-            save_path.parent.mkdir(parents=True, exist_ok=True)
+            self.stream_download_to_path(bucket_id, file_id, save_path)
+            return True
+        except Exception as e:
+            print(f"Error downloading file: {str(e)}")
+            return False
 
-            response = self.storage.get_file_download(bucket_id, file_id)
+    def stream_download_to_path(
+        self, bucket_id: str, file_id: str, save_path: Path, max_attempts: int = 3
+    ) -> None:
+        """
+        Download a file to disk in DOWNLOAD_CHUNK_SIZE chunks so memory stays flat
+        regardless of file size. Data goes to a part file of this call's own
+        next to save_path first, so concurrent downloads of the same file
+        don't write into each other's. An interrupted transfer resumes from
+        where it stopped with a Range request, and the result is checked
+        against the size and MD5 signature in the file's storage metadata
+        before being moved into place in one rename.
+        Raises on failure.
+        """
+        save_path.parent.mkdir(parents=True, exist_ok=True)
+        part_path = save_path.with_name(
+            f".{save_path.name}.{uuid.uuid4().hex[:8]}.part"
+        )
+        try:
+            self._download_part(bucket_id, file_id, part_path, max_attempts)
+            os.replace(part_path, save_path)
+        finally:
+            part_path.unlink(missing_ok=True)
+
+    def _download_part(
+        self, bucket_id: str, file_id: str, part_path: Path, max_attempts: int
+    ) -> None:
+        """Fetch a file into part_path, resuming between attempts, and verify it"""
+        metadata = self.get_file_metadata(bucket_id, file_id)
+        blob_id = ContentStore.pointer_target(metadata.get("name"))
+        if blob_id:
+            # Deduplicated file, the content lives in its blob
+            file_id = blob_id
+            metadata = self.get_file_metadata(bucket_id, file_id)
+        expected_size = metadata.get("sizeOriginal")
+        expected_md5 = metadata.get("signature")
+
+        for attempt in range(1, max_attempts + 1):
+            offset = part_path.stat().st_size if part_path.exists() else 0
+            if expected_size is not None and offset >= expected_size:
+                break
 
-            if isinstance(response, bytes):
-                file_content = response
-                write_mode = "wb"
-            elif isinstance(response, dict):
-                import json
+            try:
+                with self._open_download(bucket_id, file_id, offset) as response:
+                    # 200 means the range was ignored and the body starts at zero
+                    mode = "ab" if response.status_code == 206 else "wb"
+                    with open(part_path, mode) as f:
+                        for chunk in response.iter_content(self.DOWNLOAD_CHUNK_SIZE):
+                            f.write(chunk)
+                break
+            except requests.RequestException as e:
+                logger.warning(
+                    f"Download of {file_id} interrupted at attempt {attempt}: {str(e)}"
+                )
+                if attempt == max_attempts:
+                    raise
 
-                file_content = json.dumps(response, indent=2)
-                write_mode = "w"
-            else:
-                raise ValueError(f"Unexpected response type: {type(response)}")
+        actual_size = part_path.stat().st_size
+        if expected_size is not None and actual_size != expected_size:
+            raise ValueError(
+                f"Size mismatch for {file_id}: {actual_size} != {expected_size}"
+            )
+        if expected_md5 and self._file_md5(part_path) != expected_md5:
+            raise ValueError(f"Checksum mismatch for {file_id}")
+
+    def _file_md5(self, path: Path) -> str:
+        digest = hashlib.md5()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(self.DOWNLOAD_CHUNK_SIZE), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def _open_download(
+        self, bucket_id: str, file_id: str, offset: int = 0
+    ) -> requests.Response:
+        """Open a streaming download response for a file, raising AppwriteException on errors"""
+        self._raise_if_known_missing(bucket_id, file_id)
+        try:
+            return self.storage.open_download(bucket_id, file_id, offset)
+        except AppwriteException as e:
+            if self._is_not_found(e):
+                self.negative_cache.record_miss(bucket_id, file_id)
+            raise
 
-            with open(save_path, write_mode) as f:
-                if write_mode == "wb":
-                    f.write(file_content)
+    def download_to_buffer(
+        self, bucket_id: str, youtube_id: str, extension: str
+    ) -> Optional[BinaryIO]:
+        """
+        Download a file into a buffer using encoded ID if necessary.
+        Files up to SPOOL_MAX_MEMORY are read into memory chunk by chunk and
+        never touch disk, larger ones go to an anonymous temp file.
+        Returns the buffer rewound to the start, or None if the download failed.
+        """
+        file_id = self.get_file_id_with_extension(youtube_id, extension)
+        buffer = None
+        try:
+            file_id = self.resolve_file_id(bucket_id, file_id)
+            with self._open_download(bucket_id, file_id) as response:
+                size = int(response.headers.get("content-length") or 0)
+                if 0 < size <= self.SPOOL_MAX_MEMORY:
+                    buffer = io.BytesIO()
                 else:
-                    f.write(file_content)
+                    buffer = tempfile.TemporaryFile()
 
-            return True
+                for chunk in response.iter_content(self.DOWNLOAD_CHUNK_SIZE):
+                    buffer.write(chunk)
+
+            buffer.seek(0)
+            return buffer
         except Exception as e:
-            print(f"Error downloading file: {str(e)}")
-            return False
+            if buffer:
+                buffer.close()
+            print(f"Error downloading file to buffer: {str(e)}")
+            return None
 
     # def find_youtube_subtitle(
     #     self, video_id: str, media_dir: Path = Path("media")
@@ -251,8 +513,17 @@ class AppwriteService:
             media_dir = self.media_dir
 
         logger.debug(f"Looking for subtitles in: {media_dir}")
-        logger.debug(f"Directory exists: {media_dir.exists()}")
-        logger.debug(f"Directory contents: {list(media_dir.glob('*'))}")
+
+        # The media directory is cataloged, no need to touch the disk
+        if media_dir.resolve() == self.media_dir.resolve():
+            self.media_cache.log_diagnostics("find_youtube_subtitle")
+            found = self.media_cache.find(video_id, self.SUPPORTED_SUBTITLE_FORMATS)
+            if found:
+                ext, subtitle_path = found
+                logger.debug(f"Found subtitle at: {subtitle_path}")
+                return SubtitleFile(exists=True, path=subtitle_path, extension=ext)
+            logger.debug("No subtitles found")
+            return SubtitleFile(exists=False, path=None, extension=None)
 
         for ext in self.SUPPORTED_SUBTITLE_FORMATS:
             subtitle_path = media_dir / f"{video_id}{ext}"
@@ -284,10 +555,7 @@ class AppwriteService:
             return True
 
         try:
-            input_file = InputFile.from_path(str(srt_path))
-            self.storage.create_file(
-                bucket_id=self.lyrics_bucket_id, file_id=file_id, file=input_file
-            )
+            self._store(self.lyrics_bucket_id, file_id, srt_path)
             print(f"Successfully uploaded SRT file: {file_id}")
             return True
         except Exception as e:
@@ -319,10 +587,7 @@ class AppwriteService:
                 print(f"Audio file already exists in storage: {file_id}")
                 return True
 
-            input_file = InputFile.from_path(str(audio_file))
-            self.storage.create_file(
-                bucket_id=self.songs_bucket_id, file_id=file_id, file=input_file
-            )
+            self._store(self.songs_bucket_id, file_id, audio_file)
             print(f"Successfully uploaded audio file: {file_id}")
             return True
         except AppwriteException as e:
@@ -392,18 +657,22 @@ class AppwriteService:
         song_file = media_dir / f"{video_id}.m4a"
         metadata_file = media_dir / f"{video_id}.info.json"
 
+        # Serve from the local media cache before going to storage
+        if self.media_cache.has(video_id, [".m4a", ".info.json"]):
+            logger.debug(f"Media cache hit for {video_id}")
+            return True, ""
+
         try:
             # Use encoded IDs for storage operations
             appwrite_id = self.create_appwrite_id(video_id)
 
-            # Check if both files exist in storage
-            song_exists = self.file_exists_in_songs_bucket(appwrite_id, ".m4a")
-            metadata_exists = self.file_exists_in_songs_bucket(
-                appwrite_id, ".info.json"
+            # Check if both files exist in storage with one metadata query
+            existing = self.files_exist_in_bucket(
+                self.songs_bucket_id, appwrite_id, [".m4a", ".info.json"]
             )
 
             # If either file is missing in storage, return False
-            if not (song_exists and metadata_exists):
+            if not all(existing.values()):
                 return False, "Files not found in storage"
 
             # Download both files using encoded IDs
@@ -421,19 +690,48 @@ class AppwriteService:
 
             # Query for subtitle files
             try:
-                # Create individual contains queries for each format
-                subtitle_queries = [
-                    Query.contains("name", [f"{appwrite_id}{ext}"])
-                    for ext in self.SUPPORTED_SUBTITLE_FORMATS
+                subtitle_ids = [
+                    f"{appwrite_id}{ext}" for ext in self.SUPPORTED_SUBTITLE_FORMATS
                 ]
+                listed = self.stored_formats(self.lyrics_bucket_id, video_id)
+                if any(ext in listed for ext in self.SUPPORTED_SUBTITLE_FORMATS):
+                    subtitle_files = {
+                        "files": [
+                            {"$id": f"{appwrite_id}{ext}"}
+                            for ext in self.SUPPORTED_SUBTITLE_FORMATS
+                            if ext in listed
+                        ]
+                    }
+                elif all(
+                    self.negative_cache.is_missing(self.lyrics_bucket_id, file_id)
+                    for file_id in subtitle_ids
+                ):
+                    subtitle_files = {"files": []}
+                else:
+                    # Create individual contains queries for each format
+                    subtitle_queries = [
+                        Query.contains("name", [file_id]) for file_id in subtitle_ids
+                    ]
 
-                # Combine queries with OR
-                query = [Query.or_queries(subtitle_queries)]
+                    # Combine queries with OR
+                    query = [Query.or_queries(subtitle_queries)]
 
-                # List files with the combined query
-                subtitle_files = self.storage.list_files(
-                    bucket_id=self.lyrics_bucket_id, queries=query
-                )
+                    # List files with the combined query
+                    subtitle_files = self.storage.list_files(
+                        bucket_id=self.lyrics_bucket_id, queries=query
+                    )
+                    found = {
+                        file.get("$id"): file.get("name")
+                        for file in subtitle_files.get("files", [])
+                    }
+                    for file_id in set(subtitle_ids) - set(found):
+                        self.negative_cache.record_miss(self.lyrics_bucket_id, file_id)
+                    for file_id, name in found.items():
+                        self.manifest.add(
+                            self.lyrics_bucket_id,
+                            file_id,
+                            target=ContentStore.pointer_target(name),
+                        )
                 logger.debug(f"[NEW] Subtitle Files List: {subtitle_files}")
 
                 # Download any found subtitle files
@@ -441,7 +739,8 @@ class AppwriteService:
                     file_name = file.get("$id")
                     logger.debug(f"[NEW] Subtitle File name: {file_name}")
 
-                    if file_name:
+                    # The name query also matches lyric bundles, skip those
+                    if file_name in subtitle_ids:
                         # Extract the extension from the file name
                         _, ext = os.path.splitext(file_name)
                         subtitle_path = media_dir / f"{file_name}"
@@ -473,6 +772,7 @@ class AppwriteService:
             if not metadata_file.exists() or metadata_file.stat().st_size == 0:
                 return False, "Downloaded metadata file is empty or missing"
 
+            self.media_cache.record(video_id)
             return True, ""
 
         except Exception as e:
@@ -481,65 +781,147 @@ class AppwriteService:
     def upload_song_with_metadata(
         self, video_id: str, media_dir: Path = Path("media")
     ) -> tuple[bool, bool]:
-        """Upload both song and metadata files as a pair"""
+        """Upload both song and metadata files as a pair, concurrently"""
         try:
-            # Handle song file
-            audio_file = None
-            for ext in self.SUPPORTED_AUDIO_FORMATS:
-                potential_path = media_dir / f"{video_id}{ext}"
-                if potential_path.exists():
-                    audio_file = potential_path
-                    break
-
-            if not audio_file:
-                print(f"No audio file found for video ID: {video_id}")
+            artifacts = self.song_artifacts(video_id, media_dir)
+            if not artifacts:
                 return False, False
 
-            # Get encoded IDs for storage
-            song_file_id = self.get_file_id_with_extension(video_id, audio_file.suffix)
-            metadata_file_id = self.get_file_id_with_extension(video_id, ".info.json")
+            batch = self.upload_coordinator.submit(artifacts)
+            results = {result.artifact: result for result in batch.as_completed()}
+            # A video without a metadata file has nothing to upload for it
+            metadata = results.get("metadata")
+            return results["song"].success, metadata.success if metadata else True
 
-            print(f"Encoded song file ID: {song_file_id}")
-            print(f"Encoded metadata file ID: {metadata_file_id}")
+        except Exception as e:
+            print(f"Unexpected error in upload_song_with_metadata: {str(e)}")
+            return False, False
 
-            # Upload song
-            song_success = False
-            try:
-                if not self.file_exists_in_songs_bucket(video_id, audio_file.suffix):
-                    input_file = InputFile.from_path(str(audio_file))
-                    self.storage.create_file(
-                        bucket_id=self.songs_bucket_id,
-                        file_id=song_file_id,
-                        file=input_file,
-                    )
-                    print(f"Successfully uploaded song: {song_file_id}")
-                song_success = True
-            except Exception as e:
-                print(f"Error uploading audio file {song_file_id}: {str(e)}")
+    def song_artifacts(
+        self, video_id: str, media_dir: Path = Path("media")
+    ) -> list[Artifact]:
+        """Song and metadata uploads for a downloaded video, empty if there's no audio"""
+        audio_file = None
+        for ext in self.SUPPORTED_AUDIO_FORMATS:
+            potential_path = media_dir / f"{video_id}{ext}"
+            if potential_path.exists():
+                audio_file = potential_path
+                break
 
-            # Upload metadata
-            metadata_success = False
-            try:
-                metadata_path = media_dir / f"{video_id}.info.json"
-                if metadata_path.exists() and not self.file_exists_in_songs_bucket(
-                    video_id, ".info.json"
-                ):
-                    input_file = InputFile.from_path(str(metadata_path))
-                    self.storage.create_file(
-                        bucket_id=self.songs_bucket_id,
-                        file_id=metadata_file_id,
-                        file=input_file,
-                    )
-                    print(f"Successfully uploaded metadata: {metadata_file_id}")
-                metadata_success = True
-            except Exception as e:
-                print(f"Error uploading metadata file {metadata_file_id}: {str(e)}")
+        if not audio_file:
+            print(f"No audio file found for video ID: {video_id}")
+            return []
+
+        artifacts = [
+            Artifact(
+                name="song",
+                bucket_id=self.songs_bucket_id,
+                file_id=self.get_file_id_with_extension(video_id, audio_file.suffix),
+                path=audio_file,
+                parallel_chunks=self.UPLOAD_PARALLEL_CHUNKS,
+                dedup=self.STORAGE_DEDUP,
+            )
+        ]
+        metadata_path = media_dir / f"{video_id}.info.json"
+        if metadata_path.exists():
+            artifacts.append(
+                Artifact(
+                    name="metadata",
+                    bucket_id=self.songs_bucket_id,
+                    file_id=self.get_file_id_with_extension(video_id, ".info.json"),
+                    path=metadata_path,
+                )
+            )
+        return artifacts
+
+    def subtitle_artifact(self, video_id: str, subtitle: SubtitleFile) -> Artifact:
+        """Upload of a YouTube subtitle file found for the video"""
+        return Artifact(
+            name="subtitle",
+            bucket_id=self.lyrics_bucket_id,
+            file_id=self.get_file_id_with_extension(video_id, subtitle.extension),
+            path=subtitle.path,
+            dedup=self.STORAGE_DEDUP,
+        )
 
-            return song_success, metadata_success
+    def upload_file(
+        self,
+        bucket_id: str,
+        file_id: str,
+        path: Path,
+        parallel_chunks: bool = False,
+        dedup: bool = False,
+    ) -> bool:
+        """
+        Upload a local file under file_id unless the bucket already has it.
+        With dedup the content is stored through the ContentStore and only
+        transferred if no identical content is stored yet.
+        Returns True if the file was transferred, False if it already existed.
+        Raises on failure.
+        """
+        if not path.exists():
+            raise FileNotFoundError(f"No file to upload at {path}")
 
-        except Exception as e:
-            print(f"Unexpected error in upload_song_with_metadata: {str(e)}")
-            return False, False
+        if self.file_exists_in_bucket(bucket_id, file_id):
+            print(f"File already exists in storage: {file_id}")
+            return False
+
+        if dedup:
+            return self.content_store.store(
+                bucket_id, file_id, path, parallel_chunks=parallel_chunks
+            )
+
+        if parallel_chunks and path.stat().st_size > self.UPLOAD_CHUNK_SIZE:
+            self._create_file_in_parallel_chunks(bucket_id, file_id, path)
+            self.mark_stored(bucket_id, file_id)
+        else:
+            self._create_file(bucket_id, file_id, path)
+        print(f"Successfully uploaded: {file_id}")
+        return True
+
+    def _create_file(self, bucket_id: str, file_id: str, path: Path) -> None:
+        """Store a local file and update the lookup caches"""
+        self.storage.create_file(
+            bucket_id=bucket_id, file_id=file_id, file=InputFile.from_path(str(path))
+        )
+        self.mark_stored(bucket_id, file_id)
+
+    def _store(self, bucket_id: str, file_id: str, path: Path) -> None:
+        """Store a local file, through its content blob if deduplication is on"""
+        if self.STORAGE_DEDUP:
+            self.content_store.store(bucket_id, file_id, path)
+        else:
+            self._create_file(bucket_id, file_id, path)
+
+    def mark_stored(
+        self, bucket_id: str, file_id: str, target: Optional[str] = None
+    ) -> None:
+        """Update the lookup caches after a file was written to storage"""
+        self.negative_cache.invalidate(bucket_id, file_id)
+        self.manifest.add(bucket_id, file_id, target=target)
+
+    def _create_file_in_parallel_chunks(
+        self, bucket_id: str, file_id: str, path: Path, max_parallel: int = 4
+    ) -> None:
+        """
+        Chunked upload like the SDK's, but only the first chunk (which creates
+        the file) is sent on its own, the rest are sent concurrently.
+        """
+        size = path.stat().st_size
+
+        def send_chunk(offset: int) -> None:
+            with open(path, "rb") as f:
+                f.seek(offset)
+                chunk = f.read(self.UPLOAD_CHUNK_SIZE)
+            self.storage.upload_chunk(
+                bucket_id, file_id, path.name, chunk, offset, size
+            )
+
+        send_chunk(0)
+        offsets = range(self.UPLOAD_CHUNK_SIZE, size, self.UPLOAD_CHUNK_SIZE)
+        with ThreadPoolExecutor(max_workers=max_parallel) as executor:
+            # Consume results so the first failed chunk raises here
+            list(executor.map(send_chunk, offsets))
 
     def download_lyrics(self, file_id: str, save_path: Path) -> bool:
         """
@@ -565,6 +947,168 @@ class AppwriteService:
         base_name, extension = os.path.splitext(file_id)
         return self.download_file(self.songs_bucket_id, base_name, extension, save_path)
 
+    def download_song_buffer(self, file_id: str) -> Optional[BinaryIO]:
+        """
+        Download a song file from the songs bucket into memory-backed buffer
+        Args:
+            file_id: The original file ID (e.g., "video_id.m4a")
+        """
+        base_name, extension = os.path.splitext(file_id)
+        return self.download_to_buffer(self.songs_bucket_id, base_name, extension)
+
+    @staticmethod
+    def lyric_bundle_extension(subtitle_ext: str, version: int) -> str:
+        """e.g. ".ja.vtt.v1.json.gz", the parser version is part of the ID"""
+        return f"{subtitle_ext}.v{version}.json.gz"
+
+    def download_lyric_bundle(
+        self, video_id: str, subtitle_ext: str, version: int
+    ) -> Optional[bytes]:
+        """
+        Download the parsed lyric bundle stored for a video's subtitle file,
+        None if there isn't one for this parser version.
+        """
+        extension = self.lyric_bundle_extension(subtitle_ext, version)
+        file_id = self.get_file_id_with_extension(video_id, extension)
+        if not self.manifest.contains(
+            self.lyrics_bucket_id, file_id
+        ) and self.negative_cache.is_missing(self.lyrics_bucket_id, file_id):
+            return None
+
+        buffer = self.download_to_buffer(self.lyrics_bucket_id, video_id, extension)
+        if not buffer:
+            return None
+        with buffer:
+            return buffer.read()
+
+    def upload_lyric_bundle(
+        self, video_id: str, subtitle_ext: str, version: int, data: bytes
+    ) -> bool:
+        """Store the parsed lyric bundle for a video's subtitle file"""
+        file_id = self.get_file_id_with_extension(
+            video_id, self.lyric_bundle_extension(subtitle_ext, version)
+        )
+        try:
+            if self.file_exists_in_bucket(self.lyrics_bucket_id, file_id):
+                return True
+            self.storage.create_file(
+                bucket_id=self.lyrics_bucket_id,
+                file_id=file_id,
+                file=InputFile.from_bytes(
+                    data, filename=file_id, mime_type="application/gzip"
+                ),
+            )
+            self.mark_stored(self.lyrics_bucket_id, file_id)
+            print(f"Successfully uploaded lyric bundle: {file_id}")
+            return True
+        except Exception as e:
+            print(f"Error uploading lyric bundle {file_id}: {str(e)}")
+            return False
+
+    @staticmethod
+    def result_extension(version: int, slot: str) -> str:
+        """e.g. ".result.v1.a.json.gz", the result format version is part of the ID"""
+        return f".result.v{version}.{slot}.json.gz"
+
+    def _stored_results(self, video_id: str, version: int) -> tuple[list, dict]:
+        """
+        (extensions of the stored results, newest first; extension -> file
+        ID of every slot). A result is written to the slot not in use and
+        the older one deleted after, so there's always one to read.
+        """
+        file_ids = {
+            self.result_extension(version, slot): self.get_file_id_with_extension(
+                video_id, self.result_extension(version, slot)
+            )
+            for slot in self.RESULT_SLOTS
+        }
+        if not any(
+            self.manifest.contains(self.lyrics_bucket_id, file_id)
+            for file_id in file_ids.values()
+        ) and all(
+            self.negative_cache.is_missing(self.lyrics_bucket_id, file_id)
+            for file_id in file_ids.values()
+        ):
+            return [], file_ids
+
+        response = self.storage.list_files(
+            self.lyrics_bucket_id,
+            queries=[
+                Query.equal("$id", list(file_ids.values())),
+                Query.limit(len(file_ids)),
+            ],
+        )
+        created = {
+            file.get("$id"): file.get("$createdAt") or ""
+            for file in response.get("files", [])
+        }
+        for file_id in file_ids.values():
+            if file_id in created:
+                self.manifest.add(self.lyrics_bucket_id, file_id)
+            else:
+                self.negative_cache.record_miss(self.lyrics_bucket_id, file_id)
+        stored = [
+            extension for extension, file_id in file_ids.items() if file_id in created
+        ]
+        stored.sort(key=lambda extension: created[file_ids[extension]], reverse=True)
+        return stored, file_ids
+
+    def download_result(self, video_id: str, version: int) -> Optional[bytes]:
+        """Download the stored pipeline result for a video, None if there isn't one"""
+        try:
+            stored, _ = self._stored_results(video_id, version)
+        except Exception as e:
+            print(f"Error looking up the result of {video_id}: {str(e)}")
+            return None
+
+        # The older slot is still there if a newer result is being written
+        # and was removed in between, fall back to it
+        for extension in stored:
+            buffer = self.download_to_buffer(self.lyrics_bucket_id, video_id, extension)
+            if buffer:
+                with buffer:
+                    return buffer.read()
+        return None
+
+    def upload_result(self, video_id: str, version: int, data: bytes) -> bool:
+        """
+        Store the pipeline result for a video, replacing an older one. The
+        new result is created before the old one is deleted, readers never
+        find neither and a failed upload leaves the old result in place.
+        """
+        try:
+            stored, file_ids = self._stored_results(video_id, version)
+            current = stored[0] if stored else None
+            extension = next(ext for ext in file_ids if ext != current)
+            file_id = file_ids[extension]
+
+            # Left behind by an upload whose cleanup failed, older than current
+            if extension in stored:
+                self.storage.delete_file(self.lyrics_bucket_id, file_id)
+            self.storage.create_file(
+                bucket_id=self.lyrics_bucket_id,
+                file_id=file_id,
+                file=InputFile.from_bytes(
+                    data, filename=file_id, mime_type="application/gzip"
+                ),
+            )
+            self.mark_stored(self.lyrics_bucket_id, file_id)
+            print(f"Successfully uploaded result: {file_id}")
+        except Exception as e:
+            print(f"Error uploading result for {video_id}: {str(e)}")
+            return False
+
+        if current:
+            try:
+                self.storage.delete_file(self.lyrics_bucket_id, file_ids[current])
+                self.negative_cache.record_miss(
+                    self.lyrics_bucket_id, file_ids[current]
+                )
+            except Exception as e:
+                # The new result is newer and read first, this is only clutter
+                print(f"Error deleting old result {file_ids[current]}: {str(e)}")
+        return True
+
     def download_metadata(self, file_id: str, save_path: Path) -> bool:
         """
         Download a metadata file from the songs bucket
@@ -590,10 +1134,7 @@ class AppwriteService:
                 print(f"Metadata file already exists in storage: {file_id}")
                 return True
 
-            input_file = InputFile.from_path(str(metadata_path))
-            self.storage.create_file(
-                bucket_id=self.songs_bucket_id, file_id=file_id, file=input_file
-            )
+            self._create_file(self.songs_bucket_id, file_id, metadata_path)
             print(f"Successfully uploaded metadata file: {file_id}")
             return True
         except Exception as e:
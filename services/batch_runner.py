@@ -0,0 +1,225 @@
+import logging
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Generator, Iterable, Optional
+
+from services.job_runner import JobRunner
+from services.job_store import Job
+from services.result_store import ResultStore
+from services.stage_limiter import StageBusy
+from utils import stream_encoder, utils
+
+logger = logging.getLogger(__name__)
+
+
+class BatchRunner:
+    """
+    Runs the whole pipeline for many videos, e.g. to pre-warm a playlist
+    overnight. Each video is a "process" job on the shared JobRunner, so
+    items use the same caches, clients and stage limits as interactive
+    requests and join jobs already running for the same video. At most
+    `max_parallel` items are in flight; how many downloads, transcriptions
+    and model calls run at once is still up to the stage limits.
+
+    `submit` runs a batch as a "batch" job of its own: it carries on when
+    the client disconnects and is followed like any job, from its event
+    log. Batches run on threads of their own, at most MAX_BATCHES at once,
+    so a long batch never holds a job worker its items need.
+    """
+
+    # Seconds between checks of the in-flight jobs' event logs
+    POLL_INTERVAL = 0.25
+    # Longest wait before retrying an item a full stage turned away
+    MAX_BACKOFF = 60
+    # Batches running at once in this process, more are turned away
+    MAX_BATCHES = 2
+    # Seconds a turned away batch is told to wait before retrying
+    RETRY_AFTER = 60
+
+    def __init__(
+        self,
+        job_runner: JobRunner,
+        result_store: Optional[ResultStore] = None,
+        max_parallel: int = 2,
+    ):
+        self.job_runner = job_runner
+        self.result_store = result_store
+        self.max_parallel = max_parallel
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._executor_pid = None
+        self._lock = threading.Lock()
+        self._active = 0
+
+    @staticmethod
+    def playlist_video_ids(playlist_id: str) -> list[str]:
+        """Video IDs of a YouTube playlist, raises ValueError if it can't be listed"""
+        # pytube is only needed for playlists
+        from services.pytube_service import PyTubeService
+
+        return PyTubeService().get_playlist_video_ids(playlist_id)
+
+    def submit(
+        self,
+        video_ids: Iterable[str],
+        params: Optional[dict] = None,
+        max_parallel: Optional[int] = None,
+        skip_processed: bool = True,
+    ) -> Job:
+        """
+        Start a batch in the background, its messages (see run) go to the
+        returned job's event log. Raises StageBusy if MAX_BATCHES are running.
+        """
+        video_ids = list(dict.fromkeys(video_ids))
+        with self._lock:
+            if self._active >= self.MAX_BATCHES:
+                raise StageBusy("batch", self.RETRY_AFTER)
+            self._active += 1
+        try:
+            job = self.job_runner.store.create(
+                "batch",
+                {
+                    "ids": video_ids,
+                    "params": params or {},
+                    "parallel": max_parallel,
+                    "skip_processed": skip_processed,
+                },
+            )
+            self._ensure_executor().submit(
+                self._run_job,
+                job,
+                self.run(video_ids, params, max_parallel, skip_processed),
+            )
+        except BaseException:
+            with self._lock:
+                self._active -= 1
+            raise
+        logger.info(f"Started batch job {job.id} with {len(video_ids)} videos")
+        return job
+
+    def run(
+        self,
+        video_ids: Iterable[str],
+        params: Optional[dict] = None,
+        max_parallel: Optional[int] = None,
+        skip_processed: bool = True,
+    ) -> Generator[bytes, None, None]:
+        """
+        Process the videos and stream every item's events wrapped in
+        item_update messages, an item_done message with the outcome of each
+        item and a batch_done summary. params are passed to every item's job,
+        max_parallel can lower the instance's limit but not raise it.
+        """
+        params = params or {}
+        max_parallel = max(
+            1, min(int(max_parallel or self.max_parallel), self.max_parallel)
+        )
+        # Keep the order, drop duplicates
+        pending = deque(dict.fromkeys(video_ids))
+        outcomes = {"done": [], "failed": [], "cached": []}
+        # job_id -> [video_id, events read so far]
+        active: dict[str, list] = {}
+        idle_since = time.monotonic()
+
+        yield utils.stream_message("batch_start", {"count": len(pending)})
+        while pending or active:
+            while pending and len(active) < max_parallel:
+                video_id = pending[0]
+                if skip_processed and self._processed(video_id):
+                    pending.popleft()
+                    outcomes["cached"].append(video_id)
+                    yield self._item_done(video_id, None, "cached")
+                    continue
+                try:
+                    job = self.job_runner.submit("process", {**params, "id": video_id})
+                except StageBusy as e:
+                    if active:
+                        # An item in flight will free up capacity
+                        break
+                    backoff = min(e.retry_after, self.MAX_BACKOFF)
+                    yield utils.stream_message(
+                        "update",
+                        f"{e.stage} is busy, retrying {video_id} in {backoff}s",
+                    )
+                    time.sleep(backoff)
+                    continue
+                pending.popleft()
+                active[job.id] = [video_id, 0]
+                logger.info(f"Batch item {video_id} is job {job.id}")
+                yield utils.stream_message(
+                    "item_start", {"id": video_id, "job_id": job.id}
+                )
+
+            progressed = False
+            for job_id, item in list(active.items()):
+                video_id, offset = item
+                # Status first: if the job had finished, the read gets every event
+                job = self.job_runner.store.get(job_id)
+                events = self.job_runner.store.read(job_id, offset)
+                item[1] += len(events)
+                for event in events:
+                    message = stream_encoder.loads(event)
+                    if message.get("type") == "heartbeat":
+                        continue
+                    progressed = True
+                    yield utils.stream_message(
+                        "item_update",
+                        {"id": video_id, "job_id": job_id, "event": message},
+                    )
+                if not job or job.finished:
+                    status = job.status if job else "failed"
+                    outcomes["failed" if status == "failed" else "done"].append(
+                        video_id
+                    )
+                    del active[job_id]
+                    progressed = True
+                    yield self._item_done(video_id, job_id, status)
+
+            now = time.monotonic()
+            if progressed:
+                idle_since = now
+            elif active:
+                if now - idle_since >= self.job_runner.WAIT_TIMEOUT:
+                    idle_since = now
+                    yield utils.stream_message(
+                        "heartbeat", {"active": [item[0] for item in active.values()]}
+                    )
+                time.sleep(self.POLL_INTERVAL)
+
+        yield utils.stream_message("batch_done", outcomes)
+
+    def _run_job(self, job: Job, messages: Iterable[bytes]) -> None:
+        try:
+            self.job_runner.record(job, messages)
+        finally:
+            with self._lock:
+                self._active -= 1
+
+    def _ensure_executor(self) -> ThreadPoolExecutor:
+        """Created on first use in each process, see JobRunner._ensure_executor"""
+        if self._executor_pid != os.getpid():
+            with self._lock:
+                if self._executor_pid != os.getpid():
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=self.MAX_BATCHES, thread_name_prefix="batch"
+                    )
+                    self._executor_pid = os.getpid()
+        return self._executor
+
+    def _processed(self, video_id: str) -> bool:
+        """Whether a complete result is already stored for the video"""
+        if not self.result_store:
+            return False
+        try:
+            return self.result_store.get(video_id) is not None
+        except Exception as e:
+            logger.error(f"Couldn't look up the result of {video_id}: {str(e)}")
+            return False
+
+    @staticmethod
+    def _item_done(video_id: str, job_id: Optional[str], status: str) -> bytes:
+        return utils.stream_message(
+            "item_done", {"id": video_id, "job_id": job_id, "status": status}
+        )
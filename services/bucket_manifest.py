@@ -0,0 +1,188 @@
+import logging
+import os
+import threading
+import time
+from typing import Iterable, Optional
+
+from appwrite.query import Query
+
+from services.content_store import ContentStore
+
+logger = logging.getLogger(__name__)
+
+
+class BucketManifest:
+    """
+    In-process index of the file IDs stored in a set of buckets, so "does
+    this file exist and in which formats" is a dict lookup instead of a
+    remote call per file and extension.
+
+    Each bucket is listed in full with paged list_files calls in a
+    background thread, every `refresh_interval` seconds. Files uploaded by
+    this process are added as soon as they're stored. The manifest can lag
+    behind uploads made elsewhere, so a file missing from it isn't proof
+    the file is missing from storage: callers should fall back to a remote
+    check and `add` what they find. For deduplicated files the manifest
+    also knows which content blob each pointer refers to.
+    """
+
+    def __init__(
+        self,
+        storage,
+        bucket_ids: Iterable[str],
+        refresh_interval: float = 300.0,
+        page_size: int = 100,
+    ):
+        self.storage = storage
+        self.bucket_ids = list(bucket_ids)
+        self.refresh_interval = refresh_interval
+        self.page_size = page_size
+
+        # bucket_id -> {base_id: {extension, ...}}
+        self._index: dict[str, dict[str, set[str]]] = {
+            bucket_id: {} for bucket_id in self.bucket_ids
+        }
+        # bucket_id -> {file_id: blob_id} for deduplicated files
+        self._targets: dict[str, dict[str, str]] = {
+            bucket_id: {} for bucket_id in self.bucket_ids
+        }
+        self._refreshed_at: dict[str, float] = {}
+        self._hits = 0
+        self._misses = 0
+        self._lock = threading.Lock()
+        self._refresher_pid = None
+
+    @staticmethod
+    def split_file_id(file_id: str) -> tuple[str, str]:
+        """("abc", ".info.json") for "abc.info.json", IDs never contain dots"""
+        base_id, dot, extension = file_id.partition(".")
+        return base_id, f"{dot}{extension}"
+
+    def contains(self, bucket_id: str, file_id: str) -> bool:
+        """Whether the file is listed, False means "not known", not "missing" """
+        self._ensure_refresher()
+        base_id, extension = self.split_file_id(file_id)
+        with self._lock:
+            found = extension in self._index.get(bucket_id, {}).get(base_id, ())
+            if found:
+                self._hits += 1
+            else:
+                self._misses += 1
+            return found
+
+    def formats(self, bucket_id: str, base_id: str) -> set[str]:
+        """Extensions listed for a base ID, e.g. {".m4a", ".info.json"}"""
+        self._ensure_refresher()
+        with self._lock:
+            return set(self._index.get(bucket_id, {}).get(base_id, ()))
+
+    def target(self, bucket_id: str, file_id: str) -> Optional[str]:
+        """Content blob a listed file points to, None for ordinary files"""
+        with self._lock:
+            return self._targets.get(bucket_id, {}).get(file_id)
+
+    def is_ready(self, bucket_id: str) -> bool:
+        """Whether the bucket has been listed in full at least once"""
+        with self._lock:
+            return bucket_id in self._refreshed_at
+
+    def add(self, bucket_id: str, file_id: str, target: Optional[str] = None) -> None:
+        base_id, extension = self.split_file_id(file_id)
+        with self._lock:
+            self._index.setdefault(bucket_id, {}).setdefault(base_id, set()).add(
+                extension
+            )
+            if target:
+                self._targets.setdefault(bucket_id, {})[file_id] = target
+
+    def refresh(self, bucket_id: str) -> int:
+        """List the whole bucket and swap in the new index, returns the file count"""
+        index: dict[str, set[str]] = {}
+        targets: dict[str, str] = {}
+        count = 0
+        cursor: Optional[str] = None
+        # Files added by this process while listing, so the swap doesn't drop them
+        started = time.monotonic()
+        with self._lock:
+            before = {k: set(v) for k, v in self._index.get(bucket_id, {}).items()}
+
+        while True:
+            queries = [Query.limit(self.page_size)]
+            if cursor:
+                queries.append(Query.cursor_after(cursor))
+            page = self.storage.list_files(bucket_id, queries=queries).get("files", [])
+
+            for file in page:
+                base_id, extension = self.split_file_id(file["$id"])
+                index.setdefault(base_id, set()).add(extension)
+                target = ContentStore.pointer_target(file.get("name"))
+                if target:
+                    targets[file["$id"]] = target
+            count += len(page)
+
+            if len(page) < self.page_size:
+                break
+            cursor = page[-1]["$id"]
+
+        with self._lock:
+            current = self._index.get(bucket_id, {})
+            for base_id, extensions in current.items():
+                added = extensions - before.get(base_id, set())
+                if added:
+                    index.setdefault(base_id, set()).update(added)
+            self._index[bucket_id] = index
+            # Pointers are never rewritten, keep any we learned about meanwhile
+            self._targets[bucket_id] = {**self._targets.get(bucket_id, {}), **targets}
+            self._refreshed_at[bucket_id] = time.monotonic()
+
+        logger.info(
+            f"Manifest for bucket {bucket_id} refreshed: {count} files "
+            f"in {time.monotonic() - started:.1f}s"
+        )
+        return count
+
+    def stats(self) -> dict:
+        with self._lock:
+            now = time.monotonic()
+            return {
+                "buckets": {
+                    bucket_id: {
+                        "files": sum(len(exts) for exts in index.values()),
+                        "age": (
+                            round(now - self._refreshed_at[bucket_id], 1)
+                            if bucket_id in self._refreshed_at
+                            else None
+                        ),
+                    }
+                    for bucket_id, index in self._index.items()
+                },
+                "hits": self._hits,
+                "misses": self._misses,
+            }
+
+    def _ensure_refresher(self) -> None:
+        """
+        Start the refresh thread on first use in this process. gunicorn
+        preloads the app and forks, and threads started before the fork
+        don't survive it.
+        """
+        if self.refresh_interval <= 0 or self._refresher_pid == os.getpid():
+            return
+        with self._lock:
+            if self._refresher_pid == os.getpid():
+                return
+            self._refresher_pid = os.getpid()
+        threading.Thread(
+            target=self._refresh_loop, name="bucket-manifest", daemon=True
+        ).start()
+
+    def _refresh_loop(self) -> None:
+        while True:
+            for bucket_id in self.bucket_ids:
+                try:
+                    self.refresh(bucket_id)
+                except Exception as e:
+                    logger.warning(
+                        f"Manifest refresh of bucket {bucket_id} failed: {str(e)}"
+                    )
+            time.sleep(self.refresh_interval)
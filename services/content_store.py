@@ -0,0 +1,92 @@
+import hashlib
+import json
+import logging
+from pathlib import Path
+from typing import Optional
+
+from appwrite.input_file import InputFile
+
+logger = logging.getLogger(__name__)
+
+
+class ContentStore:
+    """
+    Content-addressed layer over a bucket, so identical audio or subtitle
+    bytes reached through different video IDs are stored once.
+
+    The bytes go to a blob whose ID is derived from their SHA-256
+    ("cas_" + 32 hex characters, the longest ID Appwrite allows). The
+    usual "{appwrite_id}{ext}" ID then holds a small JSON pointer record
+    instead of the content. The pointer's file name is
+    "{blob_id}@{file_id}", so file metadata and list_files results are
+    enough to resolve it without downloading the record, and the name
+    keeps the artifact's extension for buckets that restrict extensions.
+    """
+
+    BLOB_PREFIX = "cas_"
+    SEPARATOR = "@"
+    HASH_CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, appwrite_service):
+        self.appwrite_service = appwrite_service
+
+    @classmethod
+    def hash_file(cls, path: Path) -> str:
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(cls.HASH_CHUNK_SIZE), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    @classmethod
+    def blob_id(cls, sha256: str) -> str:
+        return f"{cls.BLOB_PREFIX}{sha256[:32]}"
+
+    @classmethod
+    def pointer_name(cls, blob_id: str, file_id: str) -> str:
+        return f"{blob_id}{cls.SEPARATOR}{file_id}"
+
+    @classmethod
+    def pointer_target(cls, name: Optional[str]) -> Optional[str]:
+        """Blob ID a stored file's name points to, None for ordinary files"""
+        if not name or not name.startswith(cls.BLOB_PREFIX):
+            return None
+        blob_id, separator, _ = name.partition(cls.SEPARATOR)
+        return blob_id if separator else None
+
+    def store(
+        self, bucket_id: str, file_id: str, path: Path, parallel_chunks: bool = False
+    ) -> bool:
+        """
+        Store a local file under file_id through its content blob. The
+        content is only transferred if no file with the same hash is in
+        the bucket yet. Returns True if content was transferred. Raises on
+        failure.
+        """
+        service = self.appwrite_service
+        sha256 = self.hash_file(path)
+        blob_id = self.blob_id(sha256)
+        size = path.stat().st_size
+
+        transferred = False
+        if service.file_exists_in_bucket(bucket_id, blob_id):
+            logger.info(f"Content of {file_id} already stored as {blob_id}")
+        else:
+            service.upload_file(
+                bucket_id, blob_id, path, parallel_chunks=parallel_chunks
+            )
+            transferred = True
+
+        if not service.file_exists_in_bucket(bucket_id, file_id):
+            record = json.dumps({"blob": blob_id, "sha256": sha256, "size": size})
+            service.storage.create_file(
+                bucket_id=bucket_id,
+                file_id=file_id,
+                file=InputFile.from_bytes(
+                    record.encode("utf-8"),
+                    filename=self.pointer_name(blob_id, file_id),
+                    mime_type="application/json",
+                ),
+            )
+            service.mark_stored(bucket_id, file_id, target=blob_id)
+        return transferred
@@ -0,0 +1,339 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from pathlib import Path
+from typing import AsyncGenerator, Generator, Iterable, Optional
+
+from services.job_store import Job
+from services.stage_limiter import StageBusy
+from utils import stream_encoder, utils
+from utils.file_lock import file_lock
+
+logger = logging.getLogger(__name__)
+
+
+class JobRunner:
+    """
+    Runs pipeline stages as background jobs on a worker pool. Every message
+    a stage yields is appended to the job's event log in the store, so the
+    work carries on when the client disconnects and any client can follow
+    the job again from an offset.
+
+    With `coalesce` on, submitting a stage for a video that already has the
+    same stage in flight with the same options returns the running job
+    instead of starting another one, so concurrent requests for a new song
+    share one download, upload and set of model calls and all see the same
+    events. Across worker processes this needs a store they share
+    (SQLiteJobStore) and a `lock_path`, which makes the lookup and the
+    creation of the job atomic.
+
+    Readers wait up to `linger` seconds after an event for the ones right
+    behind it, and write the batch to the response as one chunk, so bursts
+    of small updates don't cost a write and a flush each.
+
+    Jobs beyond `max_workers` wait for a worker and get their queue position
+    logged as queue messages whenever it changes. Once `max_queue` jobs are
+    waiting, new ones are turned away with StageBusy.
+    """
+
+    # How long a reader blocks for new events before sending a keep-alive
+    WAIT_TIMEOUT = 15.0
+    # In-flight jobs without progress for this long aren't joined anymore
+    STALE_AFTER = 300.0
+    # Assumed run time of a job until jobs have completed
+    DEFAULT_RUN_SECONDS = 60.0
+
+    def __init__(
+        self,
+        store,
+        pipeline,
+        max_workers: int = 4,
+        coalesce: bool = True,
+        lock_path: Optional[Path] = None,
+        linger: float = 0.005,
+        max_queue: int = 16,
+    ):
+        self.store = store
+        self.pipeline = pipeline
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.coalesce = coalesce
+        self.lock_path = lock_path
+        self.linger = linger
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._executor_pid = None
+        self._lock = threading.Lock()
+        self._submit_lock = threading.Lock()
+        self._coalesced = 0
+        self._rejected = 0
+        # IDs of the jobs submitted in this process that haven't started yet
+        self._queued: deque[str] = deque()
+        self._running = 0
+        self._run_seconds = deque(maxlen=100)
+        # job_id -> (event loop, asyncio.Event) of each async reader
+        self._async_waiters: dict[str, set[tuple]] = {}
+
+    @staticmethod
+    def coalesce_key(kind: str, params: dict) -> Optional[str]:
+        """(stage, video ID, other parameters) as a string, None without an ID"""
+        video_id = params.get("id")
+        if not video_id:
+            return None
+        options = {name: value for name, value in params.items() if name != "id"}
+        digest = hashlib.sha256(
+            json.dumps(options, sort_keys=True, default=str).encode("utf-8")
+        ).hexdigest()
+        return f"{kind}:{video_id}:{digest[:16]}"
+
+    def submit(self, kind: str, params: dict) -> Job:
+        """
+        Queue a job for a pipeline stage, or return the in-flight job for
+        the same work. Raises ValueError for unknown kinds and StageBusy if
+        the job queue or a stage the job needs is full; joining an in-flight
+        job always works.
+        """
+        if kind not in self.pipeline.STAGES:
+            raise ValueError(f"Unknown job kind: {kind}")
+        key = self.coalesce_key(kind, params) if self.coalesce else None
+        if not key:
+            self.pipeline.admit(kind)
+            return self._start(kind, params)
+
+        lock = file_lock(self.lock_path) if self.lock_path else nullcontext()
+        with self._submit_lock, lock:
+            job = self.store.find_active(key, self.STALE_AFTER)
+            if job:
+                self._coalesced += 1
+                logger.info(f"Joining in-flight {kind} job {job.id} for {key}")
+                return job
+            self.pipeline.admit(kind)
+            return self._start(kind, params, key)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                **self.store.stats(),
+                "coalesced": self._coalesced,
+                "max_workers": self.max_workers,
+                "max_queue": self.max_queue,
+                "running": self._running,
+                "waiting": max(0, len(self._queued) - self._idle_workers()),
+                "rejected": self._rejected,
+            }
+
+    def stream(self, job_id: str, offset: int = 0) -> Generator[bytes, None, None]:
+        """
+        The job's events from offset on, then each new one as it's stored,
+        until the job has finished. While nothing happens a heartbeat is sent
+        so proxies keep the connection open; heartbeats aren't part of the
+        log and don't count towards offsets. A job without progress for
+        STALE_AFTER ends the stream with an error.
+        """
+        while True:
+            events = self.store.wait(job_id, offset, self.WAIT_TIMEOUT)
+            if events and self.linger:
+                time.sleep(self.linger)
+                events += self.store.read(job_id, offset + len(events))
+            yield from stream_encoder.pack(events)
+            offset += len(events)
+            if events:
+                continue
+
+            job = self.store.get(job_id)
+            if not job or job.finished:
+                return
+            if self._stalled(job):
+                yield self._stalled_message(job_id)
+                return
+            yield self._heartbeat(job_id, offset)
+
+    async def astream(
+        self, job_id: str, offset: int = 0
+    ) -> AsyncGenerator[bytes, None]:
+        """
+        Same as stream, for ASGI servers: waiting for events doesn't hold a
+        thread. Readers are woken up by jobs run in this process and poll
+        the store for jobs run by other processes.
+        """
+        loop = asyncio.get_running_loop()
+        waiter = (loop, asyncio.Event())
+        poll_interval = getattr(self.store, "POLL_INTERVAL", self.WAIT_TIMEOUT)
+        with self._lock:
+            self._async_waiters.setdefault(job_id, set()).add(waiter)
+        try:
+            idle = 0.0
+            while True:
+                waiter[1].clear()
+                # Status first: if the job had finished, the read gets every event
+                job = self.store.get(job_id)
+                events = self.store.read(job_id, offset)
+                if events and self.linger and job and not job.finished:
+                    await asyncio.sleep(self.linger)
+                    job = self.store.get(job_id)
+                    events += self.store.read(job_id, offset + len(events))
+                for chunk in stream_encoder.pack(events):
+                    yield chunk
+                offset += len(events)
+                if not job or job.finished:
+                    return
+                if events:
+                    idle = 0.0
+                    continue
+
+                timeout = min(poll_interval, self.WAIT_TIMEOUT - idle)
+                try:
+                    await asyncio.wait_for(waiter[1].wait(), timeout)
+                    idle = 0.0
+                except asyncio.TimeoutError:
+                    idle += timeout
+                    if idle >= self.WAIT_TIMEOUT:
+                        idle = 0.0
+                        if self._stalled(job):
+                            yield self._stalled_message(job_id)
+                            return
+                        yield self._heartbeat(job_id, offset)
+        finally:
+            with self._lock:
+                waiters = self._async_waiters.get(job_id, set())
+                waiters.discard(waiter)
+                if not waiters:
+                    self._async_waiters.pop(job_id, None)
+
+    @staticmethod
+    def _heartbeat(job_id: str, offset: int) -> bytes:
+        return utils.stream_message("heartbeat", {"job_id": job_id, "offset": offset})
+
+    def _stalled(self, job: Job) -> bool:
+        """
+        Whether an unfinished job stopped making progress, e.g. because the
+        worker process running it died. Jobs waiting for a worker here
+        aren't stalled, their log only changes when the queue moves.
+        """
+        with self._lock:
+            if job.id in self._queued:
+                return False
+        return time.time() - job.updated_at > self.STALE_AFTER
+
+    @staticmethod
+    def _stalled_message(job_id: str) -> bytes:
+        logger.error(f"Job {job_id} stopped making progress")
+        return utils.stream_message("error", "Job stopped making progress")
+
+    def _notify(self, job_id: str) -> None:
+        """Wake up the async readers of a job after it changed"""
+        with self._lock:
+            waiters = list(self._async_waiters.get(job_id, ()))
+        for loop, event in waiters:
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:
+                # The reader's event loop has been closed
+                pass
+
+    def _start(self, kind: str, params: dict, key: Optional[str] = None) -> Job:
+        with self._lock:
+            if len(self._queued) - self._idle_workers() >= self.max_queue:
+                self._rejected += 1
+                raise StageBusy("jobs", self._retry_after())
+        job = self.store.create(kind, params, key=key)
+        with self._lock:
+            self._queued.append(job.id)
+        self._ensure_executor().submit(self._run, job)
+        self._log_positions([job.id])
+        logger.info(f"Queued {kind} job {job.id}")
+        return job
+
+    def _run(self, job: Job) -> None:
+        with self._lock:
+            self._queued.remove(job.id)
+            self._running += 1
+            behind = list(self._queued)
+        # Everyone still waiting moved up a place
+        self._log_positions(behind)
+
+        started = time.monotonic()
+        try:
+            self.record(job, self.pipeline.run(job.kind, job.params))
+        finally:
+            with self._lock:
+                self._running -= 1
+                self._run_seconds.append(time.monotonic() - started)
+
+    def record(self, job: Job, messages: Iterable[bytes]) -> None:
+        """
+        Append the messages to the job's event log as they come and set its
+        final status. Work that runs on threads of its own instead of the
+        job pool, such as batches, calls this directly.
+        """
+        self.store.set_status(job.id, "running")
+        status = "done"
+        try:
+            for message in messages:
+                self.store.append(job.id, message)
+                self._notify(job.id)
+                if stream_encoder.loads(message).get("type") == "error":
+                    status = "failed"
+        except Exception as e:
+            logger.error(f"Job {job.id} ({job.kind}) failed: {str(e)}")
+            self.store.append(
+                job.id, utils.stream_message("error", f"Job failed: {str(e)}")
+            )
+            status = "failed"
+        finally:
+            self.store.set_status(job.id, status)
+            self._notify(job.id)
+            logger.info(f"Job {job.id} ({job.kind}) {status}")
+
+    def _log_positions(self, job_ids: list[str]) -> None:
+        """Append a queue message to each of the jobs that has to wait for a worker"""
+        with self._lock:
+            idle = self._idle_workers()
+            run_seconds = self._average_run_seconds()
+            positions = {
+                job_id: self._queued.index(job_id) + 1 - idle
+                for job_id in job_ids
+                if job_id in self._queued
+            }
+        for job_id, position in positions.items():
+            if position < 1:
+                continue
+            # Same message as the stage limiters' queue updates
+            eta = round(run_seconds * position / self.max_workers, 1)
+            self.store.append(
+                job_id,
+                utils.stream_message("queue", {"position": position, "eta": eta}),
+            )
+            self._notify(job_id)
+
+    def _idle_workers(self) -> int:
+        return max(0, self.max_workers - self._running)
+
+    def _average_run_seconds(self) -> float:
+        if not self._run_seconds:
+            return self.DEFAULT_RUN_SECONDS
+        return sum(self._run_seconds) / len(self._run_seconds)
+
+    def _retry_after(self) -> int:
+        waves = len(self._queued) / self.max_workers
+        return max(1, round(self._average_run_seconds() * max(waves, 1)))
+
+    def _ensure_executor(self) -> ThreadPoolExecutor:
+        """
+        Create the pool on first use in this process. gunicorn preloads the
+        app and forks, and threads started before the fork don't survive it.
+        """
+        if self._executor_pid != os.getpid():
+            with self._lock:
+                if self._executor_pid != os.getpid():
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=self.max_workers, thread_name_prefix="job"
+                    )
+                    self._executor_pid = os.getpid()
+        return self._executor
@@ -0,0 +1,366 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Optional
+
+from utils import utils
+
+
+@dataclass
+class Job:
+    id: str
+    kind: str
+    params: dict = field(repr=False)
+    status: str = "queued"  # queued, running, done or failed
+    created_at: float = 0.0
+    updated_at: float = 0.0
+    events: int = 0
+    # Jobs with the same key compute the same result, see JobRunner.coalesce_key
+    key: Optional[str] = None
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("done", "failed")
+
+    def to_dict(self) -> dict:
+        info = asdict(self)
+        del info["params"]
+        return info
+
+
+class MemoryJobStore:
+    """
+    Jobs and their append-only event logs, kept in this process. Events are
+    the NDJSON lines a stage yields, a reader resumes from the number of
+    lines it already has. Finished jobs are dropped after `ttl` seconds.
+    """
+
+    def __init__(self, ttl: float = 3600.0):
+        self.ttl = ttl
+        self._jobs: dict[str, Job] = {}
+        self._events: dict[str, list[bytes]] = {}
+        self._condition = threading.Condition()
+
+    def create(self, kind: str, params: dict, key: Optional[str] = None) -> Job:
+        now = time.time()
+        job = Job(
+            id=uuid.uuid4().hex,
+            kind=kind,
+            params=params,
+            created_at=now,
+            updated_at=now,
+            key=key,
+        )
+        with self._condition:
+            self._purge_expired(now)
+            self._jobs[job.id] = job
+            self._events[job.id] = []
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._condition:
+            return self._jobs.get(job_id)
+
+    def find_active(self, key: str, stale_after: float) -> Optional[Job]:
+        """
+        Unfinished job with this key that made progress in the last
+        stale_after seconds, so jobs whose worker died aren't joined.
+        """
+        now = time.time()
+        with self._condition:
+            return next(
+                (
+                    job
+                    for job in self._jobs.values()
+                    if job.key == key
+                    and not job.finished
+                    and now - job.updated_at < stale_after
+                ),
+                None,
+            )
+
+    def append(self, job_id: str, event: bytes) -> int:
+        """Add an event to the job's log, returns its offset"""
+        with self._condition:
+            events = self._events[job_id]
+            events.append(event)
+            job = self._jobs[job_id]
+            job.events = len(events)
+            job.updated_at = time.time()
+            self._condition.notify_all()
+            return len(events) - 1
+
+    def set_status(self, job_id: str, status: str) -> None:
+        with self._condition:
+            job = self._jobs[job_id]
+            job.status = status
+            job.updated_at = time.time()
+            self._condition.notify_all()
+
+    def read(self, job_id: str, offset: int = 0) -> list[bytes]:
+        with self._condition:
+            return self._events.get(job_id, [])[offset:]
+
+    def wait(self, job_id: str, offset: int, timeout: float) -> list[bytes]:
+        """
+        Events from offset on, blocking up to timeout seconds until there is
+        at least one or the job has finished.
+        """
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while True:
+                job = self._jobs.get(job_id)
+                events = self._events.get(job_id, [])[offset:]
+                remaining = deadline - time.monotonic()
+                if events or not job or job.finished or remaining <= 0:
+                    return events
+                self._condition.wait(remaining)
+
+    def stats(self) -> dict:
+        with self._condition:
+            statuses = [job.status for job in self._jobs.values()]
+            return {status: statuses.count(status) for status in set(statuses)}
+
+    def _purge_expired(self, now: float) -> None:
+        for job_id in [
+            job.id
+            for job in self._jobs.values()
+            if job.finished and now - job.updated_at > self.ttl
+        ]:
+            del self._jobs[job_id]
+            del self._events[job_id]
+
+
+class SQLiteJobStore:
+    """
+    Same as MemoryJobStore but persisted in a SQLite file, so jobs and
+    their logs survive restarts and can be read from any worker process.
+    Readers in other processes see new events by polling.
+
+    Every job records the pid of the process running it. Unfinished jobs
+    whose process is gone (a crash, a restart or a recycled gunicorn
+    worker) are marked failed when the store is opened and before
+    in-flight jobs are looked up for joining.
+    """
+
+    POLL_INTERVAL = 0.25
+    JOB_COLUMNS = "id, kind, params, status, created_at, updated_at, events, key"
+
+    def __init__(self, path: Path, ttl: float = 24 * 3600.0):
+        self.path = Path(path)
+        self.ttl = ttl
+        self._local = threading.local()
+        # Wakes up readers in this process as soon as an event is written
+        self._condition = threading.Condition()
+
+        with self._connection() as db:
+            db.executescript("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    kind TEXT NOT NULL,
+                    params TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL,
+                    events INTEGER NOT NULL DEFAULT 0,
+                    key TEXT
+                );
+                CREATE TABLE IF NOT EXISTS job_events (
+                    job_id TEXT NOT NULL,
+                    seq INTEGER NOT NULL,
+                    data BLOB NOT NULL,
+                    PRIMARY KEY (job_id, seq)
+                );
+                """)
+            columns = [row[1] for row in db.execute("PRAGMA table_info(jobs)")]
+            if "key" not in columns:
+                db.execute("ALTER TABLE jobs ADD COLUMN key TEXT")
+            if "owner" not in columns:
+                db.execute("ALTER TABLE jobs ADD COLUMN owner INTEGER")
+            db.execute("CREATE INDEX IF NOT EXISTS jobs_key ON jobs (key)")
+        # Nothing runs in this process yet, its pid can't own live jobs
+        self.fail_orphaned(include_own=True)
+
+    def create(self, kind: str, params: dict, key: Optional[str] = None) -> Job:
+        now = time.time()
+        job = Job(
+            id=uuid.uuid4().hex,
+            kind=kind,
+            params=params,
+            created_at=now,
+            updated_at=now,
+            key=key,
+        )
+        with self._connection() as db:
+            self._purge_expired(db, now)
+            db.execute(
+                "INSERT INTO jobs"
+                " (id, kind, params, status, created_at, updated_at, key, owner)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    job.id,
+                    kind,
+                    json.dumps(params),
+                    job.status,
+                    now,
+                    now,
+                    key,
+                    os.getpid(),
+                ),
+            )
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        row = (
+            self._connection()
+            .execute(f"SELECT {self.JOB_COLUMNS} FROM jobs WHERE id = ?", (job_id,))
+            .fetchone()
+        )
+        return self._job(row) if row else None
+
+    def find_active(self, key: str, stale_after: float) -> Optional[Job]:
+        self.fail_orphaned()
+        row = (
+            self._connection()
+            .execute(
+                f"SELECT {self.JOB_COLUMNS} FROM jobs WHERE key = ?"
+                " AND status IN ('queued', 'running') AND updated_at > ?"
+                " ORDER BY created_at LIMIT 1",
+                (key, time.time() - stale_after),
+            )
+            .fetchone()
+        )
+        return self._job(row) if row else None
+
+    def append(self, job_id: str, event: bytes) -> int:
+        with self._connection() as db:
+            seq = db.execute(
+                "SELECT events FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()[0]
+            db.execute(
+                "INSERT INTO job_events (job_id, seq, data) VALUES (?, ?, ?)",
+                (job_id, seq, event),
+            )
+            db.execute(
+                "UPDATE jobs SET events = ?, updated_at = ? WHERE id = ?",
+                (seq + 1, time.time(), job_id),
+            )
+        with self._condition:
+            self._condition.notify_all()
+        return seq
+
+    def set_status(self, job_id: str, status: str) -> None:
+        with self._connection() as db:
+            db.execute(
+                "UPDATE jobs SET status = ?, updated_at = ? WHERE id = ?",
+                (status, time.time(), job_id),
+            )
+        with self._condition:
+            self._condition.notify_all()
+
+    def read(self, job_id: str, offset: int = 0) -> list[bytes]:
+        rows = (
+            self._connection()
+            .execute(
+                "SELECT data FROM job_events WHERE job_id = ? AND seq >= ?"
+                " ORDER BY seq",
+                (job_id, offset),
+            )
+            .fetchall()
+        )
+        # Logs written before events were bytes come back as str
+        return [row[0] for row in rows]
+
+    def wait(self, job_id: str, offset: int, timeout: float) -> list[bytes]:
+        deadline = time.monotonic() + timeout
+        while True:
+            # Status first: if the job had finished, the read gets every event
+            job = self.get(job_id)
+            events = self.read(job_id, offset)
+            remaining = deadline - time.monotonic()
+            if events or not job or job.finished or remaining <= 0:
+                return events
+            with self._condition:
+                self._condition.wait(min(remaining, self.POLL_INTERVAL))
+
+    def fail_orphaned(self, include_own: bool = False) -> list[str]:
+        """Mark unfinished jobs of processes that no longer run as failed, returns their IDs"""
+        rows = (
+            self._connection()
+            .execute("SELECT id, owner FROM jobs WHERE status IN ('queued', 'running')")
+            .fetchall()
+        )
+        orphaned = [
+            job_id
+            for job_id, owner in rows
+            if owner is None
+            or (include_own and owner == os.getpid())
+            or not self._process_alive(owner)
+        ]
+        for job_id in orphaned:
+            self.append(
+                job_id,
+                utils.stream_message(
+                    "error", "Job failed: the worker running it has stopped"
+                ),
+            )
+            self.set_status(job_id, "failed")
+        return orphaned
+
+    def stats(self) -> dict:
+        rows = (
+            self._connection()
+            .execute("SELECT status, COUNT(*) FROM jobs GROUP BY status")
+            .fetchall()
+        )
+        return dict(rows)
+
+    @staticmethod
+    def _job(row: tuple) -> Job:
+        return Job(
+            id=row[0],
+            kind=row[1],
+            params=json.loads(row[2]),
+            status=row[3],
+            created_at=row[4],
+            updated_at=row[5],
+            events=row[6],
+            key=row[7],
+        )
+
+    @staticmethod
+    def _process_alive(pid: int) -> bool:
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            # Exists, owned by another user
+            return True
+        return True
+
+    def _connection(self) -> sqlite3.Connection:
+        """One connection per thread, sqlite3 connections can't be shared"""
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30)
+            db.execute("PRAGMA journal_mode=WAL")
+            self._local.db = db
+        return db
+
+    def _purge_expired(self, db: sqlite3.Connection, now: float) -> None:
+        expired = (
+            "SELECT id FROM jobs WHERE status IN ('done', 'failed') AND updated_at < ?"
+        )
+        db.execute(
+            f"DELETE FROM job_events WHERE job_id IN ({expired})", (now - self.ttl,)
+        )
+        db.execute(
+            "DELETE FROM jobs WHERE status IN ('done', 'failed') AND updated_at < ?",
+            (now - self.ttl,),
+        )
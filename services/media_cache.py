@@ -0,0 +1,201 @@
+import logging
+import threading
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterable, Iterator, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class MediaCache:
+    """
+    Size-capped LRU cache and catalog of the local media directory.
+
+    Files are indexed by video ID and artifact extension ("{video_id}.m4a",
+    "{video_id}.info.json", "{video_id}.ja.vtt", ...) so finding a video's
+    files never lists the directory. The directory is scanned once at
+    startup, after that the catalog is kept current by `record` and
+    `remove`. A whole video is evicted at once, least recently used first,
+    when the directory grows past max_bytes. Videos pinned by an in-flight
+    request are never evicted.
+    """
+
+    # Everything yt-dlp, storage downloads and transcription write for a video
+    KNOWN_EXTENSIONS = (
+        ".m4a",
+        ".mp4",
+        ".info.json",
+        ".srt",
+        ".ja.vtt",
+        ".ja.srt",
+        ".ja.ass",
+        ".ja.ssa",
+    )
+
+    def __init__(self, media_dir: Path, max_bytes: int, diagnostics: bool = False):
+        self.media_dir = media_dir
+        self.max_bytes = max_bytes
+        # Directory listings in debug logs, off by default since they cost O(files)
+        self.diagnostics = diagnostics
+
+        # video_id -> {extension: (path, size)}, oldest first
+        self._entries: "OrderedDict[str, dict[str, tuple[Path, int]]]" = OrderedDict()
+        self._pins = Counter()
+        self._total_bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._lock = threading.RLock()
+
+        self._scan()
+
+    @staticmethod
+    def split_name(path: Path) -> tuple[str, str]:
+        """YouTube IDs never contain dots, so the ID is everything before the first one"""
+        video_id, dot, extension = path.name.partition(".")
+        return video_id, f"{dot}{extension}"
+
+    @classmethod
+    def video_id_for(cls, path: Path) -> str:
+        return cls.split_name(path)[0]
+
+    def has(self, video_id: str, extensions: Iterable[str]) -> bool:
+        """Whether every given extension is cached for the video, marking it as used"""
+        with self._lock:
+            files = self._entries.get(video_id, {})
+            hit = all(ext in files for ext in extensions)
+            if hit:
+                self._entries.move_to_end(video_id)
+                self._hits += 1
+            else:
+                self._misses += 1
+            return hit
+
+    def path(self, video_id: str, extension: str) -> Optional[Path]:
+        """Path of one artifact of a video, or None if it isn't on disk"""
+        with self._lock:
+            entry = self._entries.get(video_id, {}).get(extension)
+            return entry[0] if entry else None
+
+    def find(
+        self, video_id: str, extensions: Iterable[str]
+    ) -> Optional[tuple[str, Path]]:
+        """First of the given extensions on disk for the video, as (extension, path)"""
+        with self._lock:
+            files = self._entries.get(video_id, {})
+            for ext in extensions:
+                if ext in files:
+                    return ext, files[ext][0]
+            return None
+
+    def files(self, video_id: str) -> dict[str, Path]:
+        """All cataloged artifacts of a video, by extension"""
+        with self._lock:
+            return {
+                ext: path for ext, (path, _) in self._entries.get(video_id, {}).items()
+            }
+
+    def record(self, video_id: str, paths: Optional[Iterable[Path]] = None) -> None:
+        """
+        Register files written for a video (any of KNOWN_EXTENSIONS present
+        when paths isn't given), mark the video as most recently used and
+        evict older videos if the cache is over its size limit.
+        """
+        if paths is None:
+            paths = [
+                self.media_dir / f"{video_id}{ext}" for ext in self.KNOWN_EXTENSIONS
+            ]
+
+        with self._lock:
+            files = self._entries.setdefault(video_id, {})
+            for path in paths:
+                try:
+                    size = path.stat().st_size
+                except OSError:
+                    continue
+                _, extension = self.split_name(path)
+                previous = files.get(extension)
+                self._total_bytes += size - (previous[1] if previous else 0)
+                files[extension] = (path, size)
+            if not files:
+                del self._entries[video_id]
+                return
+            self._entries.move_to_end(video_id)
+            self._evict()
+
+    def remove(self, video_id: str, extensions: Optional[Iterable[str]] = None) -> None:
+        """Delete a video's files (only the given extensions if any) and uncatalog them"""
+        with self._lock:
+            files = self._entries.get(video_id)
+            if not files:
+                return
+            for ext in list(extensions if extensions is not None else files):
+                entry = files.pop(ext, None)
+                if entry:
+                    entry[0].unlink(missing_ok=True)
+                    self._total_bytes -= entry[1]
+            if not files:
+                del self._entries[video_id]
+
+    @contextmanager
+    def pin(self, video_id: str) -> Iterator[None]:
+        """Keep a video's files from being evicted while the block runs"""
+        with self._lock:
+            self._pins[video_id] += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._pins[video_id] -= 1
+                if self._pins[video_id] <= 0:
+                    del self._pins[video_id]
+                self._evict()
+
+    def log_diagnostics(self, context: str) -> None:
+        """Log the real directory listing next to the catalog, only when enabled"""
+        if not self.diagnostics:
+            return
+        logger.debug(f"[{context}] Media directory: {self.media_dir}")
+        logger.debug(f"[{context}] Media dir exists: {self.media_dir.exists()}")
+        logger.debug(
+            f"[{context}] Media dir contents: {list(self.media_dir.glob('*'))}"
+        )
+        logger.debug(f"[{context}] Media catalog: {self.stats()}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "videos": len(self._entries),
+                "bytes": self._total_bytes,
+                "max_bytes": self.max_bytes,
+                "pinned": len(self._pins),
+                "hits": self._hits,
+                "misses": self._misses,
+                "evictions": self._evictions,
+            }
+
+    def _scan(self) -> None:
+        """Index files already on disk, oldest access first"""
+        if not self.media_dir.exists():
+            return
+        files = [path for path in self.media_dir.iterdir() if path.is_file()]
+        for path in sorted(files, key=lambda p: p.stat().st_atime):
+            video_id, extension = self.split_name(path)
+            size = path.stat().st_size
+            self._entries.setdefault(video_id, {})[extension] = (path, size)
+            self._total_bytes += size
+            self._entries.move_to_end(video_id)
+
+    def _evict(self) -> None:
+        for video_id in list(self._entries):
+            if self._total_bytes <= self.max_bytes:
+                return
+            if self._pins[video_id] > 0:
+                continue
+
+            for path, size in self._entries.pop(video_id).values():
+                path.unlink(missing_ok=True)
+                self._total_bytes -= size
+            self._evictions += 1
+            logger.info(f"Evicted {video_id} from media cache")
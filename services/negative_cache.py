@@ -0,0 +1,62 @@
+import threading
+import time
+
+
+class NegativeCache:
+    """
+    Short-lived memory of files storage told us don't exist, keyed by
+    (bucket_id, file_id). A cold video asks storage for the same missing
+    files several times per request and again on every retry; within the
+    TTL those lookups are answered locally. Uploads made by this process
+    invalidate their key, so only files written elsewhere can be missed
+    for at most `ttl` seconds.
+    """
+
+    def __init__(self, ttl: float = 30.0):
+        self.ttl = ttl
+        # (bucket_id, file_id) -> monotonic expiry time
+        self._misses: dict[tuple[str, str], float] = {}
+        self._hits = 0
+        self._lookups = 0
+        self._lock = threading.Lock()
+
+    def is_missing(self, bucket_id: str, file_id: str) -> bool:
+        """Whether storage reported the file missing within the last ttl seconds"""
+        key = (bucket_id, file_id)
+        with self._lock:
+            self._lookups += 1
+            expires_at = self._misses.get(key)
+            if expires_at is None:
+                return False
+            if expires_at <= time.monotonic():
+                del self._misses[key]
+                return False
+            self._hits += 1
+            return True
+
+    def record_miss(self, bucket_id: str, file_id: str) -> None:
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            self._misses[(bucket_id, file_id)] = time.monotonic() + self.ttl
+            if len(self._misses) > 10_000:
+                self._purge_expired()
+
+    def invalidate(self, bucket_id: str, file_id: str) -> None:
+        with self._lock:
+            self._misses.pop((bucket_id, file_id), None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            self._purge_expired()
+            return {
+                "entries": len(self._misses),
+                "ttl": self.ttl,
+                "lookups": self._lookups,
+                "hits": self._hits,
+            }
+
+    def _purge_expired(self) -> None:
+        now = time.monotonic()
+        for key in [key for key, expires in self._misses.items() if expires <= now]:
+            del self._misses[key]
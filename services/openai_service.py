@@ -1,11 +1,13 @@
 import os
 import json
-import time
-from openai import OpenAI
-from openai import OpenAIError
 from pathlib import Path
-import yt_dlp
+from typing import BinaryIO, Optional, Tuple, Union
 from utils import utils
+from utils.openai_client import get_client
+from utils.audio import cut_audio_segment
+from utils.progress import run_with_heartbeat
+from utils.workspace import Workspace
+from services.stage_limiter import StageLimits
 import logging
 
 from config import (
@@ -24,7 +26,7 @@ kanji_annotation_system_message = KANJI_ANNOTATION_SYSTEM_MESSAGE
 romaji_annotation_system_message = ROMAJI_ANNOTATION_SYSTEM_MESSAGE
 whisper_prompt = WHISPER_PROMPT
 
-logging.basicConfig(level=logging.DEBUG)
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "DEBUG").upper())
 logger = logging.getLogger(__name__)
 
 
@@ -48,7 +50,9 @@ class OpenAIService:
     #     self.MODEL = "gpt-4o"
     #     self.appwrite_service = appwrite_service
     #     Path("media").mkdir(exist_ok=True)
-    def __init__(self, api_key, organization, project, appwrite_service=None):
+    def __init__(
+        self, api_key, organization, project, appwrite_service=None, stage_limits=None
+    ):
         if not all([api_key, organization, project]):
             raise ValueError("Missing required OpenAI credentials")
 
@@ -58,24 +62,33 @@ class OpenAIService:
         self.media_dir = self.PROJECT_ROOT / "media"
         self.media_dir.mkdir(exist_ok=True, parents=True)
 
-        self.client = OpenAI(
-            api_key=api_key,
-            organization=organization,
-            project=project,
-        )
+        # openai is imported and the client built on first use
+        self._credentials = (api_key, organization, project)
         self.MODEL = "gpt-4o"
         self.appwrite_service = appwrite_service
+        # Caps concurrent yt-dlp downloads and GPT-4o calls, unlimited if unset
+        self.stage_limits = stage_limits or StageLimits()
+
+    @property
+    def client(self):
+        return get_client(*self._credentials)
 
     def validate_video(self, video_id):
+        # Keep this video's media files from being evicted while we work on them
+        if self.appwrite_service:
+            with self.appwrite_service.media_cache.pin(video_id):
+                yield from self._validate_video(video_id)
+        else:
+            yield from self._validate_video(video_id)
+
+    def _validate_video(self, video_id):
         logger.debug(f"Project root: {self.PROJECT_ROOT}")
-        logger.debug(f"Media directory: {self.media_dir}")
-        logger.debug(f"Media dir exists: {self.media_dir.exists()}")
-        logger.debug(f"Media dir contents: {list(self.media_dir.glob('*'))}")
         # Check if appwrite service is available when needed
         if not self.appwrite_service:
             logger.error("Storage service not configured")
             yield utils.stream_message("error", "Storage service not configured")
             return
+        self.appwrite_service.media_cache.log_diagnostics("validate")
 
         result = {
             "passed": False,
@@ -88,13 +101,14 @@ class OpenAIService:
 
         media_dir = Path("media")
         media_dir.mkdir(exist_ok=True)
+        uploads = None
 
         try:
             # First, try to get files from storage
             logger.info("Querying databases...")
             yield utils.stream_message("update", "Querying databases...")
-            files_exist, error = self.appwrite_service.get_or_download_video_files(
-                video_id
+            files_exist, error = yield from run_with_heartbeat(
+                "storage", self.appwrite_service.get_or_download_video_files, video_id
             )
 
             logger.debug(f"[NEW] Subtitle Files Exist ? -- {files_exist}")
@@ -105,29 +119,15 @@ class OpenAIService:
                 logger.info("Files don't exist, downloading...")
                 yield utils.stream_message("update", "Retrieving audio...")
 
-                ydl_opts = {
-                    "match_filter": self.longer_than_eight_mins,
-                    "format": "m4a/bestaudio/best",
-                    "writesubtitles": True,
-                    "subtitlesformat": "vtt/srt/ass/ssa",
-                    "subtitleslangs": ["ja.*"],
-                    "break_on_reject": True,
-                    "writeinfojson": True,
-                    "postprocessors": [
-                        {
-                            "key": "FFmpegExtractAudio",
-                            "preferredcodec": "m4a",
-                        }
-                    ],
-                    # "outtmpl": "./media/%(id)s.%(ext)s",
-                    # "subtitlesoutopt": "./media/%(id)s.%(ext)s",
-                    "outtmpl": str(self.media_dir / "%(id)s.%(ext)s"),
-                    "subtitlesoutopt": str(self.media_dir / "%(id)s.%(ext)s"),
-                }
-
-                with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                    error_code = ydl.download(
-                        [f"https://www.youtube.com/watch?v={video_id}"]
+                # yt-dlp writes into a private directory, only finished files
+                # are moved to the shared media directory
+                with Workspace(f"download_{video_id}") as workspace:
+                    error_code = yield from self.stage_limits.run(
+                        "download",
+                        "download",
+                        self.download_audio,
+                        video_id,
+                        workspace.path,
                     )
                     if error_code:
                         result["error_msg"] = "Failed to receive audio"
@@ -135,19 +135,19 @@ class OpenAIService:
                         print("Yielded error msg from dlp")
                         print(result["error_msg"][:200])
                         return
+                    workspace.promote_all(media_dir)
+                self.appwrite_service.media_cache.record(video_id)
 
-                # Upload both files to storage as a pair
+                # Upload audio, metadata and subtitles together in the
+                # background while the video info is validated below
                 yield utils.stream_message("update", "Saving audio...")
-                song_success, metadata_success = (
-                    self.appwrite_service.upload_song_with_metadata(video_id)
-                )
-
-                if not (song_success and metadata_success):
-                    result["error_msg"] = "Failed to save audio"
-                    yield utils.stream_message("error", result["error_msg"])
-                    return
-
-                yield utils.stream_message("update", "Files saved successfully")
+                artifacts = self.appwrite_service.song_artifacts(video_id, media_dir)
+                subtitle = self.appwrite_service.find_youtube_subtitle(video_id)
+                if subtitle.exists:
+                    artifacts.append(
+                        self.appwrite_service.subtitle_artifact(video_id, subtitle)
+                    )
+                uploads = self.appwrite_service.upload_coordinator.submit(artifacts)
 
             # Process video info from the metadata file
             info_file_path = media_dir / f"{video_id}.info.json"
@@ -206,9 +206,14 @@ class OpenAIService:
                 "Music" in result["vid_info_for_validation"]["categories"]
             )
 
-            result["passed"] = (
-                is_japanese and has_music_category
-            ) or self.validate_youtube_video(result["vid_info_for_validation"])
+            result["passed"] = is_japanese and has_music_category
+            if not result["passed"]:
+                result["passed"] = yield from self.stage_limits.run(
+                    "llm",
+                    "validation",
+                    self.validate_youtube_video,
+                    result["vid_info_for_validation"],
+                )
 
             if not result["passed"]:
                 result["error_msg"] = (
@@ -217,6 +222,26 @@ class OpenAIService:
                 yield utils.stream_message("error", result["error_msg"])
                 return
 
+            if uploads:
+                upload_results = yield from run_with_heartbeat(
+                    "upload", lambda: list(uploads.as_completed())
+                )
+                upload_results = {r.artifact: r for r in upload_results}
+                logger.info(f"Upload results: {upload_results}")
+
+                song_result = upload_results.get("song")
+                metadata_result = upload_results.get("metadata")
+                if not (
+                    song_result
+                    and song_result.success
+                    and (metadata_result is None or metadata_result.success)
+                ):
+                    result["error_msg"] = "Failed to save audio"
+                    yield utils.stream_message("error", result["error_msg"])
+                    return
+
+                yield utils.stream_message("update", "Files saved successfully")
+
             logger.info("Before SELF APPWRITE SERVICE...")
 
             # Handle subtitles if they exist
@@ -234,11 +259,19 @@ class OpenAIService:
                     logger.info(str(result["subtitle_info"]))
 
                     yield utils.stream_message("update", "Saving existing lyrics...")
-                    if not self.appwrite_service.file_exists_in_lyrics_bucket(
+                    if uploads and "subtitle" in uploads.futures:
+                        # Already uploaded alongside the audio
+                        if uploads.result("subtitle").success:
+                            yield utils.stream_message(
+                                "update", "Lyrics saved successfully."
+                            )
+                    elif not self.appwrite_service.file_exists_in_lyrics_bucket(
                         f"{video_id}{subtitle.extension}"
                     ):
-                        subtitle_upload_success = (
-                            self.appwrite_service.upload_youtube_subtitle(video_id)
+                        subtitle_upload_success = yield from run_with_heartbeat(
+                            "upload",
+                            self.appwrite_service.upload_youtube_subtitle,
+                            video_id,
                         )
                         if subtitle_upload_success:
                             yield utils.stream_message(
@@ -262,7 +295,6 @@ class OpenAIService:
                 logger.error(f"Error yielding vid_info message: {str(e)}")
                 raise
 
-            time.sleep(1)
             yield utils.stream_message("update", "Validation completed.")
 
         except Exception as e:
@@ -280,85 +312,237 @@ class OpenAIService:
             yield utils.stream_message("error", result["error_msg"])
             return
 
-    def get_transcription(self, video_id: str, audio_file_path: Path) -> str:
+    def get_transcription_segments(
+        self, video_id: str, audio: Union[Path, Tuple[str, BinaryIO]]
+    ) -> dict:
         """
-        Get transcription for an audio file with comprehensive error checking.
+        Transcribe an audio file with verbose_json output and build the
+        timestamped lyrics in memory, without parsing an SRT round trip.
+        The SRT is only serialized for storage, see upload_transcription.
 
         Args:
             video_id: Unique identifier for the video
-            audio_file_path: Path to the audio file
+            audio: Path to the audio file, or a (file name, buffer) pair
+                   streamed straight from storage without touching disk
 
         Returns:
-            str: Path to the saved SRT file
+            dict: duration (seconds), segments (raw Whisper segments with
+                  no_speech_prob/avg_logprob/compression_ratio) and
+                  timestamped_lyrics (unfiltered entries)
         """
-        # Create paths relative to project root
-        media_dir = self.PROJECT_ROOT / "media"
-        srt_save_path = media_dir / f"{video_id}.srt"
-
         # Basic validation
-        if not video_id or not audio_file_path:
-            raise TranscriptionValidationError(
-                "video_id and audio_file_path cannot be empty"
-            )
-
-        # Convert relative path to absolute if necessary
-        if not audio_file_path.is_absolute():
-            audio_file_path = self.PROJECT_ROOT / audio_file_path
-
-        if not audio_file_path.exists():
-            raise TranscriptionValidationError(
-                f"Audio file not found: {audio_file_path}"
-            )
+        if not video_id or not audio:
+            raise TranscriptionValidationError("video_id and audio cannot be empty")
+
+        if isinstance(audio, tuple):
+            buffer = audio[1]
+            buffer.seek(0, os.SEEK_END)
+            file_size = buffer.tell()
+            buffer.seek(0)
+        else:
+            # Convert relative path to absolute if necessary
+            if not audio.is_absolute():
+                audio = self.PROJECT_ROOT / audio
+
+            if not audio.exists():
+                raise TranscriptionValidationError(f"Audio file not found: {audio}")
+            file_size = audio.stat().st_size
 
         # Check file size (OpenAI limit is 25MB)
-        file_size = audio_file_path.stat().st_size
         if file_size > 25 * 1024 * 1024:
             raise TranscriptionValidationError("Audio file exceeds 25MB limit")
 
+        segments, duration = self._transcribe_verbose(
+            audio, whisper_prompt, temperature=0.72
+        )
+        if not segments:
+            raise TranscriptionValidationError("Empty transcription received")
+
+        timestamped_lyrics = utils.segments_to_cues(segments)
+
+        # SRT is kept for storage only. Concurrent jobs for the video write
+        # their own copy and swap it into the media directory whole
+        srt_name = f"{video_id}.srt"
+        with Workspace(f"srt_{video_id}") as workspace:
+            with open(workspace.path / srt_name, "w", encoding="utf-8") as output_file:
+                output_file.write(utils.cues_to_srt(timestamped_lyrics))
+            srt_save_path = workspace.promote(srt_name, self.media_dir)
+        self.appwrite_service.media_cache.record(video_id, [srt_save_path])
+
+        return {
+            "duration": duration,
+            "segments": segments,
+            "timestamped_lyrics": timestamped_lyrics,
+        }
+
+    def upload_transcription(self, video_id: str) -> None:
+        """
+        Store the SRT get_transcription_segments wrote. Kept apart from the
+        transcription so the upload doesn't hold a Whisper slot.
+        """
         try:
-            # Ensure the output directory exists
-            os.makedirs(media_dir, exist_ok=True)
+            self.appwrite_service.upload_srt_subtitle(video_id, self.media_dir)
+        except Exception as upload_error:
+            raise TranscriptionValidationError(
+                f"Failed to upload to cloud storage: {str(upload_error)}"
+            )
+
+    def _transcribe_verbose(
+        self,
+        audio: Union[Path, Tuple[str, BinaryIO]],
+        prompt: str,
+        temperature: float,
+    ) -> tuple[list, float]:
+        """Call Whisper with verbose_json, returns (segment dicts, audio duration)"""
+        from openai import OpenAIError
+
+        # Buffers are handed to the multipart upload as-is and read in chunks
+        audio_file = audio if isinstance(audio, tuple) else open(audio, "rb")
+        try:
+            transcription = self.client.audio.transcriptions.create(
+                model="whisper-1",
+                file=audio_file,
+                language="ja",
+                prompt=prompt,
+                response_format="verbose_json",
+                timestamp_granularities=["segment"],
+                temperature=temperature,
+            )
+        except OpenAIError as api_error:
+            raise TranscriptionValidationError(f"OpenAI API error: {str(api_error)}")
+        finally:
+            if not isinstance(audio, tuple):
+                audio_file.close()
+
+        segments = [
+            segment.model_dump() if hasattr(segment, "model_dump") else dict(segment)
+            for segment in (transcription.segments or [])
+        ]
+        return segments, transcription.duration
+
+    def repair_transcription(
+        self,
+        video_id: str,
+        audio_file_path: Path,
+        timestamped_lyrics: list,
+        suspect_ranges: list,
+    ) -> list:
+        """
+        Re-transcribe only the suspect time ranges of a transcription and
+        splice the results back into the timestamped lyrics.
 
-            time.sleep(3)
+        Args:
+            video_id: Unique identifier for the video
+            audio_file_path: Path to the full audio file
+            timestamped_lyrics: Unfiltered timestamped lyric entries
+            suspect_ranges: (start, end) ranges from utils.find_suspect_ranges
 
-            # Open and transcribe the audio file
-            with open(audio_file_path, "rb") as audio_file:
+        Returns:
+            list: Timestamped lyrics with the repaired ranges spliced in
+        """
+        replacements = {}
+
+        # Cut segments live in a private workspace like the stage's other
+        # scratch files, removed however the repair ends
+        with Workspace(f"repair_{video_id}") as workspace:
+            # One range at a time: the caller holds a single transcription
+            # slot, parallel calls here would get around the Whisper cap
+            for i, time_range in enumerate(suspect_ranges):
+                # Lines sung just before the range give Whisper some context
+                context = [
+                    cue["lyric"]
+                    for cue in timestamped_lyrics
+                    if cue["end_time"] <= time_range[0]
+                ][-2:]
                 try:
-                    transcription = self.client.audio.transcriptions.create(
-                        model="whisper-1",
-                        file=audio_file,
-                        language="ja",
-                        prompt=whisper_prompt,
-                        response_format="srt",
-                        timestamp_granularities=["segment"],
-                        temperature=0.72,
+                    cues = self._retranscribe_range(
+                        audio_file_path,
+                        time_range,
+                        workspace.path / f"{video_id}_{i}.m4a",
+                        " ".join(context),
                     )
-                except OpenAIError as api_error:
-                    raise TranscriptionValidationError(
-                        f"OpenAI API error: {str(api_error)}"
-                    )
-
-            # Validate transcription result
-            if not transcription:
-                raise TranscriptionValidationError("Empty transcription received")
+                except Exception as e:
+                    logger.error(f"Failed to repair range {time_range}: {str(e)}")
+                    cues = None
+                # Without a clean retry the original lines stay in place
+                if cues is not None:
+                    replacements[time_range] = cues
+
+        logger.info(f"Repaired {len(replacements)}/{len(suspect_ranges)} ranges")
+        return utils.splice_cues(timestamped_lyrics, replacements)
+
+    def _retranscribe_range(
+        self, audio_file_path: Path, time_range: tuple, segment_path: Path, context: str
+    ) -> Optional[list]:
+        """
+        Transcribe one cut-out range, retrying with a different temperature
+        if it still looks wrong. None if no attempt passed the checks.
+        """
+        REPAIR_TEMPERATURES = [0.2, 0.5]
+        start, end = time_range
 
-            # Save transcription
-            with open(srt_save_path, "w", encoding="utf-8") as output_file:
-                output_file.write(transcription)
+        cut_audio_segment(audio_file_path, start, end, segment_path)
 
-            # Upload to cloud storage
+        for temperature in REPAIR_TEMPERATURES:
             try:
-                self.appwrite_service.upload_srt_subtitle(video_id)
-            except Exception as upload_error:
-                raise TranscriptionValidationError(
-                    f"Failed to upload to cloud storage: {str(upload_error)}"
+                segments, _ = self._transcribe_verbose(
+                    segment_path, context or whisper_prompt, temperature
                 )
+            except TranscriptionValidationError as api_error:
+                logger.warning(f"Repair transcription failed: {str(api_error)}")
+                continue
 
-            return str(srt_save_path)
+            cues = utils.segments_to_cues(segments)
 
-        except Exception as e:
-            print(f"Error during transcription process: {str(e)}")
-            return f"Failed to get transcription: {str(e)}"
+            # Gaps are expected inside a short range, only reject repetition
+            if utils.find_suspect_ranges(
+                cues,
+                max_gap=float("inf"),
+                extra_ranges=utils.find_low_confidence_ranges(segments),
+            ):
+                continue
+
+            return [
+                {
+                    "start_time": round(cue["start_time"] + start, 3),
+                    "end_time": round(cue["end_time"] + start, 3),
+                    "duration": cue["duration"],
+                    "lyric": cue["lyric"],
+                }
+                for cue in cues
+            ]
+
+        logger.warning(f"No clean transcription for range {time_range}")
+        return None
+
+    def download_audio(self, video_id: str, output_dir: Optional[Path] = None) -> int:
+        """Download audio, metadata and Japanese subtitles with yt-dlp, returns yt-dlp's error code"""
+        output_dir = output_dir or self.media_dir
+        ydl_opts = {
+            "match_filter": self.longer_than_eight_mins,
+            "format": "m4a/bestaudio/best",
+            "writesubtitles": True,
+            "subtitlesformat": "vtt/srt/ass/ssa",
+            "subtitleslangs": ["ja.*"],
+            "break_on_reject": True,
+            "writeinfojson": True,
+            "postprocessors": [
+                {
+                    "key": "FFmpegExtractAudio",
+                    "preferredcodec": "m4a",
+                }
+            ],
+            # "outtmpl": "./media/%(id)s.%(ext)s",
+            # "subtitlesoutopt": "./media/%(id)s.%(ext)s",
+            "outtmpl": str(output_dir / "%(id)s.%(ext)s"),
+            "subtitlesoutopt": str(output_dir / "%(id)s.%(ext)s"),
+        }
+
+        # yt-dlp takes a while to import and most requests never download
+        import yt_dlp
+
+        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+            return ydl.download([f"https://www.youtube.com/watch?v={video_id}"])
 
     #! Helper Function - check video length
     def longer_than_eight_mins(self, info):
@@ -0,0 +1,604 @@
+import json
+import logging
+import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, Generator, Iterator, Optional
+
+from services.appwrite_service import AppwriteService
+from services.openai_service import OpenAIService
+from services.result_store import ResultStore
+from services.stage_limiter import StageLimits
+from services.romaji_annotator import RomajiAnnotator
+from services.transcription_scheduler import TranscriptionScheduler
+from utils import progress, stream_encoder, utils
+from utils.progress import run_with_heartbeat
+from utils.workspace import Workspace
+
+logger = logging.getLogger(__name__)
+
+
+class Pipeline:
+    """
+    The processing stages behind the API endpoints, as generators of
+    NDJSON progress messages. They only depend on their parameters, not on
+    the HTTP request, so they can run as background jobs.
+    """
+
+    MEDIA_DIR = "media"
+    # Job kind -> method name, for running stages by name
+    STAGES = {
+        "validate": "validate",
+        "transcribe": "transcribe",
+        "translate-annotate": "translate_annotate",
+        "process": "process",
+    }
+    # Job kind -> limited stages it uses, checked before a job is accepted
+    STAGE_RESOURCES = {
+        "validate": ("download", "llm"),
+        "transcribe": ("transcription",),
+        "translate-annotate": ("llm",),
+        "process": ("download", "transcription", "llm"),
+    }
+    # Threads for annotation calls requested ahead of time. They wait for
+    # an llm slot, so they can't use the shared progress pool: waiting
+    # there would hold the threads that the running calls need
+    PREFETCH_WORKERS = 8
+
+    def __init__(
+        self,
+        appwrite_service: AppwriteService,
+        openai_service: OpenAIService,
+        romaji_annotator: RomajiAnnotator,
+        transcription_scheduler: TranscriptionScheduler,
+        result_store: Optional[ResultStore] = None,
+        stage_limits: Optional[StageLimits] = None,
+    ):
+        self.appwrite_service = appwrite_service
+        self.openai_service = openai_service
+        self.romaji_annotator = romaji_annotator
+        self.transcription_scheduler = transcription_scheduler
+        self.result_store = result_store
+        self.stage_limits = stage_limits or StageLimits()
+        self._prefetch_executor: Optional[ThreadPoolExecutor] = None
+        self._prefetch_executor_pid = None
+        self._prefetch_lock = threading.Lock()
+
+    def run(self, kind: str, data: dict) -> Generator[bytes, None, None]:
+        """Run the stage for a job kind with the request body it was submitted with"""
+        if kind not in self.STAGES:
+            raise ValueError(f"Unknown pipeline stage: {kind}")
+        return getattr(self, self.STAGES[kind])(data)
+
+    def admit(self, kind: str) -> None:
+        """Raise StageBusy if a stage the job needs is turning callers away"""
+        self.stage_limits.check(self.STAGE_RESOURCES.get(kind, ()))
+
+    #! Step 1
+    def validate(self, data: dict) -> Generator[bytes, None, None]:
+
+        yield utils.stream_message("update", "Initializing...")
+
+        try:
+            video_id = data.get("id")
+            if not video_id:
+                raise ValueError("Invalid or missing video ID in request.")
+
+            yield utils.stream_message("update", f"Received request for ID {video_id}")
+
+            yield utils.stream_message("update", "Gathering video metadata...")
+
+            # Stream validation updates (now includes upload)
+            for update in self.openai_service.validate_video(video_id):
+                if isinstance(update, bytes) and b"vid_info" in update:
+                    try:
+                        vid_info = json.loads(update)
+                        if "data" in vid_info:
+                            subtitle_info = vid_info["data"].get("subtitle_info", {})
+                            logger.info("Subtitle Info Details:")
+                            logger.info(f"Exists: {subtitle_info.get('exist', False)}")
+                            logger.info(f"Path: {subtitle_info.get('path', 'N/A')}")
+                            logger.info(f"Extension: {subtitle_info.get('ext', 'N/A')}")
+                            logger.info("-" * 50)
+                    except json.JSONDecodeError:
+                        logger.error("Failed to parse vid_info JSON")
+                    except Exception as e:
+                        logger.error(f"Error processing vid_info: {str(e)}")
+                logger.debug(f"Yielding update: {update[:200]}...")
+                yield update
+
+        except ValueError as ve:
+            yield utils.stream_message("error", f"Validation Error: {str(ve)}")
+        except Exception as e:
+            print("VALIDATION ERROR ")
+            yield utils.stream_message(
+                "error", f"An unexpected error occurred: {str(e)}"
+            )
+
+    #! Step 2
+    def transcribe(self, data: dict) -> Generator[bytes, None, None]:
+        # Intermediate files go to a private directory that is removed
+        # however the stage ends, concurrent requests can't touch them
+        with Workspace(f"transcribe_{data.get('id')}") as workspace:
+            yield from self._transcribe(data, workspace.path)
+
+    def _transcribe(self, data: dict, temp_dir: Path) -> Generator[bytes, None, None]:
+        video_id = data.get("id")
+        subtitle_info = data.get("subtitle_info")
+        force_ai_transcription = data.get("force_ai_transcription", False)
+        subtitle_exist = subtitle_info["exist"] and not force_ai_transcription
+
+        try:
+            # Parsed subtitles to store for the next request, if any
+            new_bundle = None
+            yield utils.stream_message("update", "Initializing transcription...")
+            if subtitle_exist:
+                yield utils.stream_message("update", "Retrieving saved subtitles...")
+
+                subtitle_ext = subtitle_info["ext"]
+                subtitle_file_path = temp_dir / f"{video_id}{subtitle_ext}"
+
+                # Lyrics parsed on an earlier request skip download and parsing
+                bundle = yield from run_with_heartbeat(
+                    "subtitles",
+                    self.appwrite_service.download_lyric_bundle,
+                    video_id,
+                    subtitle_ext,
+                    utils.SUBTITLE_PARSER_VERSION,
+                )
+                transcription_result = (
+                    utils.decode_lyric_bundle(bundle) if bundle else None
+                )
+                if transcription_result:
+                    ai_generated = False
+                    yield utils.stream_message(
+                        "update",
+                        "Subtitles retrieved and processed successfully.",
+                    )
+                else:
+                    lyrics_downloaded = yield from run_with_heartbeat(
+                        "subtitles",
+                        self.appwrite_service.download_lyrics,
+                        f"{video_id}{subtitle_ext}",
+                        subtitle_file_path,
+                    )
+                    if lyrics_downloaded and subtitle_file_path.stat().st_size > 0:
+                        processed_srt_path = temp_dir / f"{video_id}.srt"
+                        transcription_result = utils.process_subtitle_file(
+                            str(subtitle_file_path),
+                            subtitle_ext.lstrip(".").split(".")[-1],
+                            apply_error_checks=False,
+                        )
+                        new_bundle = utils.encode_lyric_bundle(
+                            transcription_result, subtitle_ext
+                        )
+
+                        # Extract the filtered_srt content
+                        srt_content = transcription_result["filtered_srt"]
+
+                        # Debug logging
+                        print(f"SRT content type: {type(srt_content)}")
+                        print(
+                            f"SRT content preview: {srt_content[:200]}..."
+                        )  # First 200 chars
+
+                        with open(processed_srt_path, "w", encoding="utf-8") as f:
+                            f.write(srt_content)
+
+                        # self.appwrite_service.upload_srt_subtitle(video_id, temp_dir)
+
+                        ai_generated = False
+                        yield utils.stream_message(
+                            "update",
+                            "Subtitles retrieved and processed successfully.",
+                        )
+                    else:
+                        subtitle_exist = False
+
+            if not subtitle_exist:
+                yield utils.stream_message("update", "Transcription in progress...")
+                # Stream the song from storage straight into the Whisper upload
+                audio_buffer = None
+                # Try the formats storage is known to have first
+                stored = self.appwrite_service.stored_formats(
+                    self.appwrite_service.songs_bucket_id, video_id
+                )
+                for audio_ext in sorted(
+                    AppwriteService.SUPPORTED_AUDIO_FORMATS,
+                    key=lambda ext: ext not in stored,
+                ):
+                    audio_name = f"{video_id}{audio_ext}"
+                    audio_buffer = yield from run_with_heartbeat(
+                        "download",
+                        self.appwrite_service.download_song_buffer,
+                        audio_name,
+                    )
+                    if audio_buffer:
+                        break
+                if not audio_buffer:
+                    raise Exception("Failed to download audio file")
+
+                # Shorter songs are scheduled first, position/ETA is streamed
+                song_duration = utils.read_video_duration(
+                    os.path.join(self.MEDIA_DIR, f"{video_id}.info.json")
+                )
+
+                with audio_buffer:
+                    transcription = yield from self.transcription_scheduler.run(
+                        "transcription",
+                        song_duration,
+                        self.openai_service.get_transcription_segments,
+                        video_id,
+                        (audio_name, audio_buffer),
+                    )
+                    yield from run_with_heartbeat(
+                        "upload", self.openai_service.upload_transcription, video_id
+                    )
+                    raw_cues = transcription["timestamped_lyrics"]
+
+                    # Re-transcribe only the hallucinated parts instead of failing
+                    suspect_ranges = utils.find_suspect_ranges(
+                        raw_cues,
+                        transcription["duration"],
+                        extra_ranges=utils.find_low_confidence_ranges(
+                            transcription["segments"]
+                        ),
+                    )
+                    if suspect_ranges:
+                        yield utils.stream_message(
+                            "update",
+                            f"Fixing {len(suspect_ranges)} section(s) of the transcription...",
+                        )
+                        # ffmpeg needs a seekable file, only write one out here
+                        audio_path = temp_dir / audio_name
+                        audio_buffer.seek(0)
+                        with open(audio_path, "wb") as f:
+                            shutil.copyfileobj(audio_buffer, f)
+                        raw_cues = yield from self.transcription_scheduler.run(
+                            "repair",
+                            sum(end - start for start, end in suspect_ranges),
+                            self.openai_service.repair_transcription,
+                            video_id,
+                            audio_path,
+                            raw_cues,
+                            suspect_ranges,
+                            calibrate=False,
+                        )
+
+                transcription_result = utils.process_subtitle_cues(
+                    raw_cues, apply_error_checks=True
+                )
+
+                # Extract the filtered_srt content
+                srt_content = transcription_result["filtered_srt"]
+
+                processed_srt_path = temp_dir / f"{video_id}.srt"
+                with open(processed_srt_path, "w", encoding="utf-8") as f:
+                    f.write(srt_content)
+
+                ai_generated = True
+                yield utils.stream_message(
+                    "update", "Transcription generated successfully."
+                )
+
+            yield utils.stream_message("ai_generated", ai_generated)
+            yield utils.stream_message(
+                "transcription",
+                {
+                    "lyrics": transcription_result["lyrics"],
+                    "timestamped_lyrics": transcription_result["timestamped_lyrics"],
+                },
+            )
+
+            # The client already has everything, store the bundle last
+            if new_bundle:
+                self.appwrite_service.upload_lyric_bundle(
+                    video_id,
+                    subtitle_ext,
+                    utils.SUBTITLE_PARSER_VERSION,
+                    new_bundle,
+                )
+
+        except Exception as e:
+            error_message = f"An error occurred during transcription: {str(e)}"
+            print(error_message)
+            yield utils.stream_message("error", error_message)
+            return
+
+    #! Step 3
+    def translate_annotate(
+        self, data: dict, overlap: bool = False, save: bool = False
+    ) -> Generator[bytes, None, None]:
+        """
+        With overlap on, the romaji and kanji annotations are requested
+        while the translations are generated; the messages are the same
+        and come in the same order.
+
+        With save on, the result is stored as the video's public result.
+        Only callers that produced the lyrics themselves may set it, the
+        endpoint's lyrics come from the client.
+        """
+        yield utils.stream_message(
+            "update", "Starting translation and annotation process..."
+        )
+
+        # Prefetched calls that haven't started are dropped if the stream ends early
+        cancelled = threading.Event()
+        prefetched = {}
+        try:
+            video_id = data.get("id")
+            lyrics_arr = data.get("lyrics")
+            timestamped_lyrics = data.get("timestamped_lyrics")
+            # Everything the client receives, saved once all steps succeed
+            result = {
+                "models": {
+                    "translation": self.openai_service.MODEL,
+                    "romaji": self.romaji_annotator.MODEL,
+                    "kanji": self.openai_service.MODEL,
+                },
+            }
+
+            # Process lyrics while preserving timestamp relationships
+            try:
+                cleaned_lyrics, cleaned_timestamped = (
+                    utils.process_lyrics_for_translation(lyrics_arr, timestamped_lyrics)
+                )
+
+                # Verify timing preservation
+                if len(cleaned_lyrics) != len(cleaned_timestamped):
+                    raise ValueError(
+                        f"Timing mismatch after processing. Lyrics: {len(cleaned_lyrics)}, "
+                        f"Timestamps: {len(cleaned_timestamped)}"
+                    )
+
+                # Log processing results for debugging
+                print(f"Original lyrics count: {len(lyrics_arr)}")
+                print(f"Processed lyrics count: {len(cleaned_lyrics)}")
+
+                # Verify timestamp preservation
+                for i, (orig, processed) in enumerate(
+                    zip(timestamped_lyrics, cleaned_timestamped)
+                ):
+                    if orig["start_time"] != processed["start_time"]:
+                        print(f"Timestamp mismatch at index {i}")
+                        print(f"Original: {orig}")
+                        print(f"Processed: {processed}")
+
+            except ValueError as e:
+                yield utils.stream_message(
+                    "error", f"Error processing lyrics: {str(e)}"
+                )
+                return
+
+            # Translations and annotations line up with the processed lyrics
+            result["lyrics"] = cleaned_lyrics
+            result["timestamped_lyrics"] = cleaned_timestamped
+
+            # Neither annotation depends on the translations
+            def get_romaji():
+                return list(
+                    self.romaji_annotator.get_romaji_lyrics(cleaned_lyrics, video_id)
+                )
+
+            def get_kanji():
+                return list(
+                    self.openai_service.get_kanji_annotations(cleaned_lyrics, video_id)
+                )
+
+            if overlap:
+                for stage_name, func in (("romaji", get_romaji), ("kanji", get_kanji)):
+                    prefetched[stage_name] = self._prefetch_pool().submit(
+                        self.stage_limits.call, "llm", func, cancelled=cancelled
+                    )
+
+            # Translation step
+            yield utils.stream_message("task_update", "translation")
+            yield utils.stream_message("update", "Generating translations...")
+
+            MAX_RETRIES = 3
+            retry_count = 0
+            translations_completed = False
+
+            while retry_count < MAX_RETRIES and not translations_completed:
+                try:
+                    translations = yield from self.stage_limits.run(
+                        "llm",
+                        "translation",
+                        lambda: list(
+                            self.openai_service.get_translations(
+                                cleaned_lyrics, video_id, retry_count
+                            )
+                        ),
+                    )
+                    for translation_type, translation in translations:
+                        result[translation_type] = translation
+                        yield utils.stream_message(translation_type, translation)
+
+                    translations_completed = True
+                    yield utils.stream_message(
+                        "update", "Lyrics translated successfully!"
+                    )
+                except ValueError as e:
+                    print(e)
+                    retry_count += 1
+                    if retry_count == MAX_RETRIES:
+                        yield utils.stream_message(
+                            "error",
+                            "We failed to translate the given lyrics, please try again :(",
+                        )
+                        return
+                    else:
+                        match retry_count:
+                            case 1:
+                                yield utils.stream_message(
+                                    "update",
+                                    "Retrying translations with an AI who's more creative...",
+                                )
+                            case 2:
+                                yield utils.stream_message(
+                                    "update",
+                                    "Retrying translations with an AI who's more serious...",
+                                )
+                            case 3:
+                                yield utils.stream_message(
+                                    "update",
+                                    "Final attempt: Unleashing maximum AI creativity for the task!",
+                                )
+
+            # Romaji annotation step
+            yield utils.stream_message("task_update", "romaji")
+            yield utils.stream_message("update", "Generating romaji lyrics...")
+
+            try:
+                romaji_results = yield from self._annotation(
+                    prefetched, "romaji", get_romaji
+                )
+                for message_type, message_content in romaji_results:
+                    if message_type == "romaji_lyrics":
+                        result[message_type] = message_content
+                        yield utils.stream_message(message_type, message_content)
+                        yield utils.stream_message(
+                            "update", "Romaji annotated successfully!"
+                        )
+                        yield utils.stream_message("task_update", "kanji")
+                    elif message_type == "error":
+                        yield utils.stream_message(
+                            "error",
+                            f"Romaji generation failed: {message_content}",
+                        )
+            except ValueError:
+                yield utils.stream_message(
+                    "error",
+                    "We failed to generate romaji for the given lyrics, please try again :(",
+                )
+
+            # Kanji annotation step
+            yield utils.stream_message("task_update", "kanji")
+            yield utils.stream_message("update", "Generating kanji annotations...")
+
+            try:
+                kanji_results = yield from self._annotation(
+                    prefetched, "kanji", get_kanji
+                )
+                for kanji_type, kanji_annotations in kanji_results:
+                    result[kanji_type] = kanji_annotations
+                    yield utils.stream_message(kanji_type, kanji_annotations)
+                    yield utils.stream_message(
+                        "update", "Kanji annotated successfully!"
+                    )
+            except ValueError as e:
+                yield utils.stream_message(
+                    "error", f"Kanji annotation failed: {str(e)}"
+                )
+                return
+
+            yield utils.stream_message("task_update", "completion")
+            yield utils.stream_message("update", "All processes completed!")
+
+            # The client already has everything, store the result last
+            complete = all(
+                step in result
+                for step in (
+                    "eng_translation",
+                    "chi_translation",
+                    "romaji_lyrics",
+                    "kanji_annotations",
+                )
+            )
+            if save and self.result_store and video_id and complete:
+                self.result_store.save(video_id, result)
+
+        except Exception as e:
+            yield utils.stream_message("error", str(e))
+        finally:
+            cancelled.set()
+            for future in prefetched.values():
+                future.cancel()
+            if prefetched:
+                self.stage_limits.wake("llm")
+
+    #! All steps
+    def process(self, data: dict) -> Generator[bytes, None, None]:
+        """
+        Validation, transcription and translation/annotation in one stream.
+        Each step gets the previous one's output in memory instead of the
+        client sending it back, the messages are the same as the separate
+        endpoints' plus a task_update when a step starts.
+        """
+        video_id = data.get("id")
+
+        yield utils.stream_message("task_update", "validation")
+        vid_info = yield from self._forward(self.validate({"id": video_id}), "vid_info")
+        if not vid_info:
+            return
+
+        yield utils.stream_message("task_update", "transcription")
+        transcription = yield from self._forward(
+            self.transcribe(
+                {
+                    "id": video_id,
+                    "subtitle_info": vid_info["subtitle_info"],
+                    "force_ai_transcription": data.get("force_ai_transcription", False),
+                }
+            ),
+            "transcription",
+        )
+        if not transcription:
+            return
+
+        yield from self.translate_annotate(
+            {
+                "id": video_id,
+                "lyrics": transcription["lyrics"],
+                "timestamped_lyrics": transcription["timestamped_lyrics"],
+            },
+            overlap=True,
+            save=True,
+        )
+
+    @staticmethod
+    def _forward(
+        messages: Iterator[bytes], wanted: str
+    ) -> Generator[bytes, None, Optional[Any]]:
+        """
+        Pass a step's messages on and return the data of its `wanted`
+        message, None if the step failed or didn't send one
+        """
+        found = None
+        try:
+            for message in messages:
+                yield message
+                event = stream_encoder.loads(message)
+                if event.get("type") == "error":
+                    return None
+                if event.get("type") == wanted:
+                    found = event.get("data")
+        finally:
+            messages.close()
+        return found
+
+    def _prefetch_pool(self) -> ThreadPoolExecutor:
+        """Created on first use in each process, see JobRunner._ensure_executor"""
+        if self._prefetch_executor_pid != os.getpid():
+            with self._prefetch_lock:
+                if self._prefetch_executor_pid != os.getpid():
+                    self._prefetch_executor = ThreadPoolExecutor(
+                        max_workers=self.PREFETCH_WORKERS,
+                        thread_name_prefix="prefetch",
+                    )
+                    self._prefetch_executor_pid = os.getpid()
+        return self._prefetch_executor
+
+    def _annotation(
+        self, prefetched: dict, stage_name: str, func: Callable[[], Any]
+    ) -> Generator[bytes, None, Any]:
+        """The result of a prefetched call, or of making the call now"""
+        if stage_name in prefetched:
+            return (
+                yield from progress.wait_with_heartbeat(
+                    stage_name, prefetched[stage_name]
+                )
+            )
+        return (yield from self.stage_limits.run("llm", stage_name, func))
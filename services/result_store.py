@@ -0,0 +1,96 @@
+import gzip
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+class ResultStore:
+    """
+    Final output of the pipeline per video: lyrics and timestamps with
+    their translations, romaji and kanji annotations and the models that
+    produced them. Saved when translate-annotate completes, so clients can
+    fetch a processed song with one request instead of running the stages.
+
+    Results are stored gzipped in the lyrics bucket and the most recently
+    used ones are kept in memory for `ttl` seconds (another worker may
+    replace a result) as the exact JSON bytes served, with an ETag derived
+    from them.
+    """
+
+    # Bump when the result layout changes, older results are then ignored
+    VERSION = 1
+
+    def __init__(self, appwrite_service, max_entries: int = 256, ttl: float = 300.0):
+        self.appwrite_service = appwrite_service
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # video_id -> (JSON bytes, ETag, expiry time)
+        self._entries: OrderedDict[str, tuple[bytes, str, float]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    @staticmethod
+    def etag(body: bytes) -> str:
+        return hashlib.sha256(body).hexdigest()[:32]
+
+    def get(self, video_id: str) -> Optional[tuple[bytes, str]]:
+        """The result's JSON bytes and ETag, None if the video wasn't processed"""
+        with self._lock:
+            entry = self._entries.get(video_id)
+            if entry and entry[2] > time.monotonic():
+                self._entries.move_to_end(video_id)
+                self._hits += 1
+                return entry[:2]
+            self._misses += 1
+
+        data = self.appwrite_service.download_result(video_id, self.VERSION)
+        if not data:
+            return None
+        try:
+            body = gzip.decompress(data)
+            json.loads(body)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Stored result for {video_id} is unreadable: {str(e)}")
+            return None
+        return self._remember(video_id, body)
+
+    def save(self, video_id: str, result: dict) -> bool:
+        """Store a completed result, replacing the previous one for the video"""
+        result = {
+            **result,
+            "id": video_id,
+            "version": self.VERSION,
+            "completed_at": int(time.time()),
+        }
+        body = json.dumps(result, ensure_ascii=False, separators=(",", ":")).encode(
+            "utf-8"
+        )
+        self._remember(video_id, body)
+        # mtime=0 so the same result always compresses to the same bytes
+        return self.appwrite_service.upload_result(
+            video_id, self.VERSION, gzip.compress(body, mtime=0)
+        )
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "hits": self._hits,
+                "misses": self._misses,
+            }
+
+    def _remember(self, video_id: str, body: bytes) -> tuple[bytes, str]:
+        etag = self.etag(body)
+        with self._lock:
+            self._entries[video_id] = (body, etag, time.monotonic() + self.ttl)
+            self._entries.move_to_end(video_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return body, etag
@@ -1,22 +1,23 @@
 import json
 import time
 import re
-from openai import OpenAI
+from utils.openai_client import get_client
 from config import TOOLS, ROMAJI_ANNOTATION_SYSTEM_MESSAGE
 import unicodedata
 
 
 class RomajiAnnotator:
     def __init__(self, api_key, organization, project):
-        self.client = OpenAI(
-            api_key=api_key,
-            organization=organization,
-            project=project,
-        )
+        # openai is imported and the client built on first use
+        self._credentials = (api_key, organization, project)
         self.MODEL = "gpt-4o"
         self.MAX_RETRIES = 3
         self.RETRY_DELAY = 2
 
+    @property
+    def client(self):
+        return get_client(*self._credentials)
+
     def sanitize_text(self, text):
         """
         Enhanced sanitization for VTT content handling
@@ -0,0 +1,297 @@
+import itertools
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import CancelledError
+from typing import Any, Callable, Generator, Iterable, Optional
+
+from utils import progress
+from utils.progress import run_with_heartbeat
+from utils.utils import stream_message
+
+
+class StageBusy(Exception):
+    """A stage's wait queue is full, the request should be retried later"""
+
+    def __init__(self, stage: str, retry_after: int):
+        super().__init__(
+            f"Too many requests are waiting for {stage}, please try again shortly"
+        )
+        self.stage = stage
+        self.retry_after = retry_after
+
+
+class StageLimiter:
+    """
+    Caps how many calls of one kind (yt-dlp downloads, GPT-4o requests...)
+    run at once in this process. Callers beyond the cap wait in FIFO order
+    and get their queue position streamed; once `max_queue` callers are
+    waiting, new ones are turned away with StageBusy instead of piling up.
+    """
+
+    HEARTBEAT_INTERVAL = 5.0
+    POLL_INTERVAL = 1.0
+    # Assumed run time until calls have completed
+    DEFAULT_RUN_SECONDS = 10.0
+
+    def __init__(self, stage: str, max_concurrent: int, max_queue: int):
+        if max_concurrent < 1:
+            raise ValueError("max_concurrent must be at least 1")
+
+        self.stage = stage
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+
+        self._condition = threading.Condition()
+        self._running = 0
+        self._waiting: deque[int] = deque()
+        self._tickets = itertools.count()
+        self._admitted = 0
+        self._rejected = 0
+        self._busy_seconds = 0.0
+        self._run_seconds = deque(maxlen=100)
+        self._created_at = time.monotonic()
+
+    def is_full(self) -> bool:
+        """Whether a new caller would be rejected right now"""
+        with self._condition:
+            return self._is_full()
+
+    def retry_after(self) -> int:
+        """Rough seconds until a queue slot frees up"""
+        with self._condition:
+            return self._retry_after()
+
+    def run(
+        self, stage_name: str, func: Callable[..., Any], *args
+    ) -> Generator[bytes, None, Any]:
+        """
+        Wait for a slot, streaming the queue position as queue messages, then run
+        the call with heartbeats. Use with `yield from` to get the result.
+        Raises StageBusy without waiting if the queue is full.
+        """
+        ticket = self._enqueue()
+        try:
+            yield from self._wait_turn(ticket)
+        except BaseException:
+            self._leave_queue(ticket)
+            raise
+
+        started = time.monotonic()
+        try:
+            future = progress.submit(func, *args)
+        except BaseException:
+            self._release(started)
+            raise
+        # The call keeps running if the stream is closed, so the slot is
+        # only freed once the call itself has finished
+        future.add_done_callback(lambda _: self._release(started))
+        return (yield from progress.wait_with_heartbeat(stage_name, future))
+
+    def call(
+        self,
+        func: Callable[..., Any],
+        *args,
+        cancelled: Optional[threading.Event] = None,
+    ) -> Any:
+        """
+        Wait for a slot and run the call in this thread, for work that is
+        already on a pool of its own. Raises CancelledError instead of
+        starting the call if `cancelled` is set while waiting (call wake
+        after setting it), StageBusy if the queue is full.
+        """
+        ticket = self._enqueue()
+        try:
+            for _ in self._wait_turn(ticket, cancelled):
+                pass
+        except BaseException:
+            self._leave_queue(ticket)
+            raise
+
+        started = time.monotonic()
+        try:
+            if cancelled and cancelled.is_set():
+                raise CancelledError()
+            return func(*args)
+        finally:
+            self._release(started)
+
+    def wake(self) -> None:
+        """Wake up the waiting callers, so cancelled ones leave the queue now"""
+        with self._condition:
+            self._condition.notify_all()
+
+    def stats(self) -> dict:
+        with self._condition:
+            uptime = time.monotonic() - self._created_at
+            return {
+                "max_concurrent": self.max_concurrent,
+                "max_queue": self.max_queue,
+                "running": self._running,
+                "queued": len(self._waiting),
+                "admitted": self._admitted,
+                "rejected": self._rejected,
+                # Share of the slots' time spent running calls since startup
+                "utilization": round(
+                    self._busy_seconds / (uptime * self.max_concurrent), 3
+                ),
+            }
+
+    def _enqueue(self) -> int:
+        with self._condition:
+            if self._is_full():
+                self._rejected += 1
+                raise StageBusy(self.stage, self._retry_after())
+            ticket = next(self._tickets)
+            self._waiting.append(ticket)
+            return ticket
+
+    def _leave_queue(self, ticket: int) -> None:
+        with self._condition:
+            if ticket in self._waiting:
+                self._waiting.remove(ticket)
+                self._condition.notify_all()
+
+    def _release(self, started: float) -> None:
+        with self._condition:
+            elapsed = time.monotonic() - started
+            self._running -= 1
+            self._busy_seconds += elapsed
+            self._run_seconds.append(elapsed)
+            self._condition.notify_all()
+
+    def _wait_turn(
+        self, ticket: int, cancelled: Optional[threading.Event] = None
+    ) -> Generator[bytes, None, None]:
+        last_position = None
+        last_message = time.monotonic()
+
+        def is_cancelled() -> bool:
+            return cancelled is not None and cancelled.is_set()
+
+        while True:
+            with self._condition:
+                self._condition.wait_for(
+                    lambda: is_cancelled() or self._can_start(ticket),
+                    timeout=self.POLL_INTERVAL,
+                )
+                if is_cancelled():
+                    raise CancelledError()
+                if self._can_start(ticket):
+                    self._waiting.remove(ticket)
+                    self._running += 1
+                    self._admitted += 1
+                    return
+                position = self._waiting.index(ticket) + 1
+                eta = round(
+                    self._average_run_seconds() * position / self.max_concurrent, 1
+                )
+
+            # Same message as the TranscriptionScheduler's queue updates
+            now = time.monotonic()
+            if (
+                position != last_position
+                or now - last_message >= self.HEARTBEAT_INTERVAL
+            ):
+                yield stream_message("queue", {"position": position, "eta": eta})
+                last_position = position
+                last_message = now
+
+    def _can_start(self, ticket: int) -> bool:
+        return self._running < self.max_concurrent and self._waiting[0] == ticket
+
+    def _is_full(self) -> bool:
+        return (
+            self._running >= self.max_concurrent
+            and len(self._waiting) >= self.max_queue
+        )
+
+    def _average_run_seconds(self) -> float:
+        if not self._run_seconds:
+            return self.DEFAULT_RUN_SECONDS
+        return sum(self._run_seconds) / len(self._run_seconds)
+
+    def _retry_after(self) -> int:
+        run_seconds = self._average_run_seconds()
+        waves = len(self._waiting) / self.max_concurrent
+        return max(1, round(run_seconds * max(waves, 1)))
+
+
+class StageLimits:
+    """
+    The limiters of a worker by stage name, configured with
+    STAGE_<NAME>_CONCURRENCY and STAGE_<NAME>_QUEUE. Stages without a
+    limiter run unrestricted. Anything with is_full, retry_after and stats
+    (such as the TranscriptionScheduler) can be added to take part in
+    admission checks.
+    """
+
+    # stage -> (max_concurrent, max_queue)
+    DEFAULTS = {
+        # yt-dlp plus its ffmpeg postprocessing, CPU bound
+        "download": (2, 8),
+        # GPT-4o requests, bounded by the OpenAI rate limits
+        "llm": (4, 32),
+    }
+
+    def __init__(self):
+        self._limiters: dict[str, Any] = {}
+
+    @classmethod
+    def from_env(cls) -> "StageLimits":
+        limits = cls()
+        for stage, (max_concurrent, max_queue) in cls.DEFAULTS.items():
+            prefix = f"STAGE_{stage.upper()}"
+            limits.add(
+                stage,
+                StageLimiter(
+                    stage,
+                    int(os.getenv(f"{prefix}_CONCURRENCY", max_concurrent)),
+                    int(os.getenv(f"{prefix}_QUEUE", max_queue)),
+                ),
+            )
+        return limits
+
+    def add(self, stage: str, limiter) -> None:
+        self._limiters[stage] = limiter
+
+    def run(
+        self, stage: str, stage_name: str, func: Callable[..., Any], *args
+    ) -> Generator[bytes, None, Any]:
+        """Run a call under the stage's limiter, stage_name labels its heartbeats"""
+        limiter = self._limiters.get(stage)
+        if not isinstance(limiter, StageLimiter):
+            return (yield from run_with_heartbeat(stage_name, func, *args))
+        return (yield from limiter.run(stage_name, func, *args))
+
+    def call(
+        self,
+        stage: str,
+        func: Callable[..., Any],
+        *args,
+        cancelled: Optional[threading.Event] = None,
+    ) -> Any:
+        """Blocking version of run, see StageLimiter.call"""
+        limiter = self._limiters.get(stage)
+        if not isinstance(limiter, StageLimiter):
+            if cancelled and cancelled.is_set():
+                raise CancelledError()
+            return func(*args)
+        return limiter.call(func, *args, cancelled=cancelled)
+
+    def wake(self, stage: str) -> None:
+        """Let the stage's waiting calls notice a cancellation, see StageLimiter.call"""
+        limiter = self._limiters.get(stage)
+        if isinstance(limiter, StageLimiter):
+            limiter.wake()
+
+    def check(self, stages: Iterable[str]) -> None:
+        """Raise StageBusy if any of the stages would turn a new caller away"""
+        for stage in stages:
+            limiter = self._limiters.get(stage)
+            if limiter and limiter.is_full():
+                raise StageBusy(stage, limiter.retry_after())
+
+    def stats(self) -> dict:
+        return {stage: limiter.stats() for stage, limiter in self._limiters.items()}
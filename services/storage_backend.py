@@ -0,0 +1,321 @@
+import hashlib
+import json
+import logging
+import mimetypes
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Iterator, Optional
+
+import requests
+from appwrite.exception import AppwriteException
+from appwrite.input_file import InputFile
+from appwrite.services.storage import Storage
+
+logger = logging.getLogger(__name__)
+
+
+class AppwriteStorage(Storage):
+    """
+    The SDK's Storage service plus the two calls it can't do: ranged,
+    streaming downloads and sending a single chunk of a chunked upload.
+    Both go through a pooled requests session.
+    """
+
+    def __init__(self, client, endpoint: str, http: requests.Session):
+        super().__init__(client)
+        self.endpoint = endpoint
+        self.http = http
+
+    def open_download(self, bucket_id: str, file_id: str, offset: int = 0):
+        """Open a streaming download response, raising AppwriteException on errors"""
+        url = f"{self.endpoint}/storage/buckets/{bucket_id}/files/{file_id}/download"
+        headers = {"range": f"bytes={offset}-"} if offset else {}
+        response = self.http.get(url, headers=headers, stream=True, timeout=(10, 60))
+        if response.status_code >= 400:
+            response.close()
+            raise AppwriteException(response.text, response.status_code)
+        return response
+
+    def upload_chunk(
+        self,
+        bucket_id: str,
+        file_id: str,
+        filename: str,
+        chunk: bytes,
+        offset: int,
+        size: int,
+    ) -> None:
+        """Send bytes [offset, offset + len(chunk)) of a chunked upload"""
+        response = self.http.post(
+            f"{self.endpoint}/storage/buckets/{bucket_id}/files",
+            data={"fileId": file_id},
+            files={"file": (filename, chunk)},
+            headers={
+                "content-range": f"bytes {offset}-{offset + len(chunk) - 1}/{size}",
+                "x-appwrite-id": file_id,
+            },
+            timeout=(10, 120),
+        )
+        if response.status_code >= 400:
+            raise AppwriteException(response.text, response.status_code)
+
+
+class LocalDownload:
+    """Enough of a streaming requests.Response for our download code"""
+
+    def __init__(
+        self,
+        path: Path,
+        offset: int,
+        bandwidth: Optional[float],
+        cut_at: Optional[int],
+    ):
+        self.status_code = 206 if offset else 200
+        self.headers = {"content-length": str(path.stat().st_size - offset)}
+        self._file = open(path, "rb")
+        self._file.seek(offset)
+        self._bandwidth = bandwidth
+        self._cut_at = cut_at
+
+    def iter_content(self, chunk_size: int) -> Iterator[bytes]:
+        sent = 0
+        while True:
+            chunk = self._file.read(chunk_size)
+            if not chunk:
+                return
+            if self._cut_at is not None and sent + len(chunk) > self._cut_at:
+                raise requests.ConnectionError("Injected connection drop")
+            if self._bandwidth:
+                time.sleep(len(chunk) / self._bandwidth)
+            sent += len(chunk)
+            yield chunk
+
+    def close(self) -> None:
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class LocalStorage:
+    """
+    Filesystem stand-in for AppwriteStorage, for running and benchmarking
+    the storage paths offline. Implements the calls AppwriteService makes:
+    list_files (with the queries we use), create_file, get_file,
+    get_file_view, get_file_download, delete_file, open_download and
+    upload_chunk.
+
+    Every call first sleeps `latency` seconds (plus up to `jitter`) and
+    fails with probability `error_rate`. Downloads are throttled to
+    `bandwidth` bytes per second and, with probability `error_rate`, drop
+    the connection part way through. Pass a `seed` for reproducible runs.
+
+    Layout: {root}/{bucket_id}/files/{file_id} holds the content and
+    {root}/{bucket_id}/meta/{file_id}.json the file document.
+    """
+
+    def __init__(
+        self,
+        root: Path,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        bandwidth: Optional[float] = None,
+        error_rate: float = 0.0,
+        seed: Optional[int] = None,
+    ):
+        self.root = Path(root)
+        self.latency = latency
+        self.jitter = jitter
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.calls = 0
+
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        # file_id -> bytes received so far, for uploads sent in chunks
+        self._chunked: dict[tuple[str, str], int] = {}
+
+    def list_files(self, bucket_id: str, queries=None, search=None) -> dict:
+        self._simulate_call()
+        parsed = [json.loads(query) for query in queries or []]
+        filters = [q for q in parsed if q["method"] not in ("limit", "offset")]
+        limit = next((q["values"][0] for q in parsed if q["method"] == "limit"), 25)
+        offset = next((q["values"][0] for q in parsed if q["method"] == "offset"), 0)
+
+        files = []
+        meta_dir = self.root / bucket_id / "meta"
+        if meta_dir.exists():
+            for meta_path in meta_dir.iterdir():
+                document = json.loads(meta_path.read_text(encoding="utf-8"))
+                if all(self._matches(document, query) for query in filters):
+                    files.append(document)
+        files.sort(key=lambda file: file["$id"])
+
+        cursor = next(
+            (q["values"][0] for q in parsed if q["method"] == "cursorAfter"), None
+        )
+        if cursor is not None:
+            files = [file for file in files if file["$id"] > cursor]
+
+        return {"total": len(files), "files": files[offset : offset + limit]}
+
+    def create_file(
+        self, bucket_id: str, file_id: str, file: InputFile, permissions=None
+    ) -> dict:
+        self._simulate_call()
+        data = (
+            file.data if file.source_type == "bytes" else Path(file.path).read_bytes()
+        )
+        with self._lock:
+            if self._meta_path(bucket_id, file_id).exists():
+                raise AppwriteException(
+                    "A storage file with the requested ID already exists.",
+                    409,
+                    "storage_file_already_exists",
+                )
+            content_path = self._content_path(bucket_id, file_id)
+            content_path.parent.mkdir(parents=True, exist_ok=True)
+            content_path.write_bytes(data)
+            return self._write_document(bucket_id, file_id, file.filename)
+
+    def get_file(self, bucket_id: str, file_id: str) -> dict:
+        self._simulate_call()
+        return self._read_document(bucket_id, file_id)
+
+    def get_file_view(self, bucket_id: str, file_id: str) -> bytes:
+        self._simulate_call()
+        self._read_document(bucket_id, file_id)
+        return self._transfer(self._content_path(bucket_id, file_id).read_bytes())
+
+    def get_file_download(self, bucket_id: str, file_id: str) -> bytes:
+        return self.get_file_view(bucket_id, file_id)
+
+    def delete_file(self, bucket_id: str, file_id: str) -> dict:
+        self._simulate_call()
+        self._read_document(bucket_id, file_id)
+        self._meta_path(bucket_id, file_id).unlink()
+        self._content_path(bucket_id, file_id).unlink(missing_ok=True)
+        return {}
+
+    def open_download(self, bucket_id: str, file_id: str, offset: int = 0):
+        self._simulate_call()
+        self._read_document(bucket_id, file_id)
+        path = self._content_path(bucket_id, file_id)
+
+        cut_at = None
+        remaining = path.stat().st_size - offset
+        if remaining > 0 and self._random.random() < self.error_rate:
+            cut_at = self._random.randrange(remaining)
+        return LocalDownload(path, offset, self.bandwidth, cut_at)
+
+    def upload_chunk(
+        self,
+        bucket_id: str,
+        file_id: str,
+        filename: str,
+        chunk: bytes,
+        offset: int,
+        size: int,
+    ) -> None:
+        self._simulate_call()
+        self._transfer(chunk)
+        key = (bucket_id, file_id)
+        content_path = self._content_path(bucket_id, file_id)
+        with self._lock:
+            if key not in self._chunked:
+                if self._meta_path(bucket_id, file_id).exists():
+                    raise AppwriteException(
+                        "A storage file with the requested ID already exists.",
+                        409,
+                        "storage_file_already_exists",
+                    )
+                content_path.parent.mkdir(parents=True, exist_ok=True)
+                with open(content_path, "wb") as f:
+                    f.truncate(size)
+                self._chunked[key] = 0
+
+            with open(content_path, "r+b") as f:
+                f.seek(offset)
+                f.write(chunk)
+            self._chunked[key] += len(chunk)
+
+            if self._chunked[key] >= size:
+                del self._chunked[key]
+                self._write_document(bucket_id, file_id, filename)
+
+    def _simulate_call(self) -> None:
+        with self._lock:
+            self.calls += 1
+            delay = self.latency + self._random.uniform(0, self.jitter)
+            fail = self._random.random() < self.error_rate
+        if delay:
+            time.sleep(delay)
+        if fail:
+            raise AppwriteException("Injected storage fault", 503, "general_unknown")
+
+    def _transfer(self, data: bytes) -> bytes:
+        if self.bandwidth:
+            time.sleep(len(data) / self.bandwidth)
+        return data
+
+    @staticmethod
+    def _matches(document: dict, query: dict) -> bool:
+        method = query["method"]
+        if method == "or":
+            return any(LocalStorage._matches(document, q) for q in query["values"])
+        if method == "and":
+            return all(LocalStorage._matches(document, q) for q in query["values"])
+
+        value = document.get(query.get("attribute"))
+        values = query.get("values", [])
+        if method == "equal":
+            return value in values
+        if method == "notEqual":
+            return value not in values
+        if method == "contains":
+            return any(v in (value or "") for v in values)
+        if method == "startsWith":
+            return str(value or "").startswith(values[0])
+        if method == "endsWith":
+            return str(value or "").endswith(values[0])
+        if method == "cursorAfter":
+            return True
+        raise ValueError(f"Query method not supported by LocalStorage: {method}")
+
+    def _content_path(self, bucket_id: str, file_id: str) -> Path:
+        return self.root / bucket_id / "files" / file_id
+
+    def _meta_path(self, bucket_id: str, file_id: str) -> Path:
+        return self.root / bucket_id / "meta" / f"{file_id}.json"
+
+    def _read_document(self, bucket_id: str, file_id: str) -> dict:
+        meta_path = self._meta_path(bucket_id, file_id)
+        if not meta_path.exists():
+            raise AppwriteException(
+                "The requested file could not be found.",
+                404,
+                "storage_file_not_found",
+            )
+        return json.loads(meta_path.read_text(encoding="utf-8"))
+
+    def _write_document(self, bucket_id: str, file_id: str, filename: str) -> dict:
+        content = self._content_path(bucket_id, file_id).read_bytes()
+        document = {
+            "$id": file_id,
+            "bucketId": bucket_id,
+            "$createdAt": datetime.now(timezone.utc).isoformat(),
+            "name": filename,
+            "signature": hashlib.md5(content).hexdigest(),
+            "mimeType": mimetypes.guess_type(filename)[0] or "application/octet-stream",
+            "sizeOriginal": len(content),
+        }
+        meta_path = self._meta_path(bucket_id, file_id)
+        meta_path.parent.mkdir(parents=True, exist_ok=True)
+        meta_path.write_text(json.dumps(document), encoding="utf-8")
+        return document
@@ -0,0 +1,284 @@
+import heapq
+import itertools
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from dataclasses import dataclass, field
+from typing import Any, Callable, Generator, Optional
+
+from services.stage_limiter import StageBusy
+from utils.utils import stream_message
+
+
+@dataclass(order=True)
+class TranscriptionJob:
+    """A queued Whisper call, ordered by its aged priority"""
+
+    priority: float
+    sequence: int
+    duration: float = field(compare=False)
+    func: Callable[..., Any] = field(compare=False, repr=False)
+    args: tuple = field(compare=False, repr=False)
+    kwargs: dict = field(compare=False, repr=False)
+    future: Future = field(compare=False, repr=False)
+    enqueued_at: float = field(compare=False)
+    started_at: Optional[float] = field(default=None, compare=False)
+    # Whether the run time is representative of Whisper's speed per audio second
+    calibrate: bool = field(default=True, compare=False)
+
+
+class TranscriptionScheduler:
+    """
+    Runs Whisper calls with a global concurrency cap, shortest audio first.
+
+    Waiting jobs age so long songs can't starve: a job's priority is its
+    audio duration minus `aging_rate` seconds for every second it has
+    waited. Because every queued job ages at the same rate this equals
+    ordering by `duration + aging_rate * enqueued_at`, so a plain heap works.
+
+    With `max_queue` set, calls submitted while that many are already
+    waiting are rejected with StageBusy.
+    """
+
+    DEFAULT_DURATION = 240.0
+    # Seconds of Whisper processing per second of audio, before we have data
+    DEFAULT_SECONDS_PER_AUDIO_SECOND = 0.1
+    HEARTBEAT_INTERVAL = 5.0
+    LATENCY_SAMPLES = 500
+
+    def __init__(
+        self,
+        max_concurrent: int = 2,
+        aging_rate: float = 1.0,
+        max_queue: Optional[int] = None,
+    ):
+        if max_concurrent < 1:
+            raise ValueError("max_concurrent must be at least 1")
+
+        self.max_concurrent = max_concurrent
+        self.aging_rate = aging_rate
+        self.max_queue = max_queue
+
+        self._queue: list[TranscriptionJob] = []
+        self._running: list[TranscriptionJob] = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+
+        self._seconds_per_audio_second = self.DEFAULT_SECONDS_PER_AUDIO_SECOND
+        self._latencies = deque(maxlen=self.LATENCY_SAMPLES)
+        self._waits = deque(maxlen=self.LATENCY_SAMPLES)
+        self._completed_at = deque()
+        self._completed = 0
+        self._failed = 0
+        self._rejected = 0
+        self._workers_pid = None
+
+    def submit(
+        self,
+        duration: Optional[float],
+        func: Callable[..., Any],
+        *args,
+        calibrate: bool = True,
+        **kwargs,
+    ) -> TranscriptionJob:
+        """
+        Queue a call, its result is available through the job's future.
+        Calls whose run time isn't one Whisper pass over `duration` seconds
+        of audio (repairs cut and retry ranges) pass calibrate=False, so
+        they don't skew the speed estimate behind ETAs.
+        """
+        duration = float(duration or self.DEFAULT_DURATION)
+        now = time.monotonic()
+        job = TranscriptionJob(
+            priority=duration + self.aging_rate * now,
+            sequence=next(self._sequence),
+            duration=duration,
+            func=func,
+            args=args,
+            kwargs=kwargs,
+            future=Future(),
+            enqueued_at=now,
+            calibrate=calibrate,
+        )
+        with self._condition:
+            if self._is_full():
+                self._rejected += 1
+                raise StageBusy("transcription", self._retry_after())
+            self._ensure_workers()
+            heapq.heappush(self._queue, job)
+            self._condition.notify()
+        return job
+
+    def is_full(self) -> bool:
+        """Whether a new call would be rejected right now"""
+        with self._condition:
+            return self._is_full()
+
+    def retry_after(self) -> int:
+        """Rough seconds until a queue slot frees up"""
+        with self._condition:
+            return self._retry_after()
+
+    def run(
+        self,
+        stage_name: str,
+        duration: Optional[float],
+        func: Callable[..., Any],
+        *args,
+        calibrate: bool = True,
+        **kwargs,
+    ) -> Generator[bytes, None, Any]:
+        """
+        Queue a call and stream its queue position and ETA while it waits,
+        then heartbeats while it runs. Use with `yield from` to get the result.
+        """
+        job = self.submit(duration, func, *args, calibrate=calibrate, **kwargs)
+        last_position = None
+        last_message = time.monotonic()
+
+        while True:
+            with self._condition:
+                position = self._position(job)
+                eta = self._estimate_wait(job) if position else None
+
+            # Repeated while the position holds, so a long wait still
+            # shows up as progress on the job
+            now = time.monotonic()
+            if position and (
+                position != last_position
+                or now - last_message >= self.HEARTBEAT_INTERVAL
+            ):
+                yield stream_message("queue", {"position": position, "eta": eta})
+                last_position = position
+                last_message = now
+
+            try:
+                return job.future.result(
+                    timeout=1.0 if position else self.HEARTBEAT_INTERVAL
+                )
+            except FutureTimeoutError:
+                if not position:
+                    elapsed = round(time.monotonic() - job.started_at, 1)
+                    yield stream_message(
+                        "heartbeat", {"stage": stage_name, "elapsed": elapsed}
+                    )
+
+    def stats(self) -> dict:
+        """Queue depth, throughput over the last minute and latency percentiles"""
+        with self._condition:
+            now = time.monotonic()
+            recent = [t for t in self._completed_at if now - t <= 60]
+            return {
+                "max_concurrent": self.max_concurrent,
+                "running": len(self._running),
+                "queued": len(self._queue),
+                "completed": self._completed,
+                "failed": self._failed,
+                "rejected": self._rejected,
+                "throughput_per_min": len(recent),
+                "latency_p50": self._percentile(self._latencies, 50),
+                "latency_p95": self._percentile(self._latencies, 95),
+                "wait_p95": self._percentile(self._waits, 95),
+                "seconds_per_audio_second": round(self._seconds_per_audio_second, 3),
+            }
+
+    def _ensure_workers(self):
+        """
+        Start worker threads on first use in this process. gunicorn preloads
+        the app and forks, and threads started before the fork don't survive it.
+        """
+        if self._workers_pid == os.getpid():
+            return
+        self._workers_pid = os.getpid()
+        for i in range(self.max_concurrent):
+            threading.Thread(
+                target=self._worker, name=f"whisper-{i}", daemon=True
+            ).start()
+
+    def _worker(self):
+        while True:
+            with self._condition:
+                while not self._queue:
+                    self._condition.wait()
+                job = heapq.heappop(self._queue)
+                job.started_at = time.monotonic()
+                self._running.append(job)
+
+            if not job.future.set_running_or_notify_cancel():
+                with self._condition:
+                    self._running.remove(job)
+                continue
+
+            try:
+                result = job.func(*job.args, **job.kwargs)
+            except BaseException as e:
+                self._finish(job, succeeded=False)
+                job.future.set_exception(e)
+            else:
+                self._finish(job, succeeded=True)
+                job.future.set_result(result)
+
+    def _finish(self, job: TranscriptionJob, succeeded: bool):
+        finished_at = time.monotonic()
+        with self._condition:
+            self._running.remove(job)
+            self._completed_at.append(finished_at)
+            while finished_at - self._completed_at[0] > 60:
+                self._completed_at.popleft()
+            self._latencies.append(finished_at - job.enqueued_at)
+            self._waits.append(job.started_at - job.enqueued_at)
+
+            if succeeded:
+                self._completed += 1
+            else:
+                self._failed += 1
+
+            if succeeded and job.calibrate:
+                # Exponentially weighted so the ETA follows current API speed
+                ratio = (finished_at - job.started_at) / job.duration
+                self._seconds_per_audio_second = (
+                    0.8 * self._seconds_per_audio_second + 0.2 * ratio
+                )
+
+    def _position(self, job: TranscriptionJob) -> int:
+        """1-based position in the queue, 0 once the job has started"""
+        if job.started_at is not None:
+            return 0
+        return 1 + sum(1 for queued in self._queue if queued < job)
+
+    def _estimate_wait(self, job: TranscriptionJob) -> float:
+        """Seconds until the job is expected to start"""
+        now = time.monotonic()
+        running_left = sum(
+            max(0.0, self._expected_runtime(running) - (now - running.started_at))
+            for running in self._running
+        )
+        queued_ahead = sum(
+            self._expected_runtime(queued) for queued in self._queue if queued < job
+        )
+        return round((running_left + queued_ahead) / self.max_concurrent, 1)
+
+    def _is_full(self) -> bool:
+        return self.max_queue is not None and len(self._queue) >= self.max_queue
+
+    def _retry_after(self) -> int:
+        """Time for the running calls and the queue to drain, at least a second"""
+        now = time.monotonic()
+        remaining = sum(
+            max(0.0, self._expected_runtime(running) - (now - running.started_at))
+            for running in self._running
+        ) + sum(self._expected_runtime(queued) for queued in self._queue)
+        return max(1, round(remaining / self.max_concurrent))
+
+    def _expected_runtime(self, job: TranscriptionJob) -> float:
+        return job.duration * self._seconds_per_audio_second
+
+    @staticmethod
+    def _percentile(samples, percentile: int) -> Optional[float]:
+        if not samples:
+            return None
+        ordered = sorted(samples)
+        index = min(len(ordered) - 1, round(percentile / 100 * (len(ordered) - 1)))
+        return round(ordered[index], 3)
@@ -0,0 +1,103 @@
+import logging
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterator, Optional
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class UploadResult:
+    """Outcome of storing one artifact"""
+
+    artifact: str
+    file_id: str
+    success: bool
+    # True when the file was already in the bucket and nothing was transferred
+    skipped: bool = False
+    error: Optional[str] = None
+    seconds: float = 0.0
+
+
+@dataclass
+class Artifact:
+    """A local file to store under file_id in a bucket"""
+
+    name: str
+    bucket_id: str
+    file_id: str
+    path: Path
+    parallel_chunks: bool = False
+    # Store through the content-addressed layer
+    dedup: bool = False
+
+
+class UploadBatch:
+    """Handle on a set of uploads running concurrently"""
+
+    def __init__(self, futures: dict[str, Future]):
+        self.futures = futures
+
+    def result(self, artifact: str) -> UploadResult:
+        """Wait for one artifact only, the others keep uploading"""
+        return self.futures[artifact].result()
+
+    def as_completed(self) -> Iterator[UploadResult]:
+        """Yield results in the order the uploads finish"""
+        for future in as_completed(self.futures.values()):
+            yield future.result()
+
+    def done(self) -> bool:
+        return all(future.done() for future in self.futures.values())
+
+
+class UploadCoordinator:
+    """
+    Runs independent artifact uploads (audio, metadata, subtitles) at the
+    same time with bounded parallelism, instead of one round trip after another.
+    """
+
+    def __init__(self, appwrite_service, max_parallel: int = 3):
+        self.appwrite_service = appwrite_service
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_parallel, thread_name_prefix="upload"
+        )
+
+    def submit(self, artifacts: list[Artifact]) -> UploadBatch:
+        return UploadBatch(
+            {
+                artifact.name: self._executor.submit(self._upload, artifact)
+                for artifact in artifacts
+            }
+        )
+
+    def _upload(self, artifact: Artifact) -> UploadResult:
+        started = time.monotonic()
+        try:
+            transferred = self.appwrite_service.upload_file(
+                artifact.bucket_id,
+                artifact.file_id,
+                artifact.path,
+                parallel_chunks=artifact.parallel_chunks,
+                dedup=artifact.dedup,
+            )
+            return UploadResult(
+                artifact=artifact.name,
+                file_id=artifact.file_id,
+                success=True,
+                skipped=not transferred,
+                seconds=round(time.monotonic() - started, 3),
+            )
+        except Exception as e:
+            logger.error(
+                f"Error uploading {artifact.name} {artifact.file_id}: {str(e)}"
+            )
+            return UploadResult(
+                artifact=artifact.name,
+                file_id=artifact.file_id,
+                success=False,
+                error=str(e),
+                seconds=round(time.monotonic() - started, 3),
+            )
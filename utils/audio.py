@@ -0,0 +1,36 @@
+import subprocess
+from pathlib import Path
+
+
+def cut_audio_segment(
+    audio_path: Path, start: float, end: float, output_path: Path
+) -> Path:
+    """
+    Cut [start, end) seconds out of an audio file with ffmpeg.
+    The segment is re-encoded so the cut is sample accurate.
+    """
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    subprocess.run(
+        [
+            "ffmpeg",
+            "-v",
+            "error",
+            "-y",
+            "-ss",
+            f"{start:.3f}",
+            "-t",
+            f"{end - start:.3f}",
+            "-i",
+            str(audio_path),
+            "-vn",
+            "-c:a",
+            "aac",
+            "-b:a",
+            "128k",
+            str(output_path),
+        ],
+        capture_output=True,
+        check=True,
+        timeout=60,
+    )
+    return output_path
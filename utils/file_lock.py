@@ -0,0 +1,29 @@
+import fcntl
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator
+
+# flock locks are per open file, so threads of one process also need a mutex
+_thread_locks: dict[str, threading.Lock] = {}
+_thread_locks_guard = threading.Lock()
+
+
+@contextmanager
+def file_lock(path: Path) -> Iterator[None]:
+    """
+    Exclusive lock shared by every thread and process that uses the same
+    path. The lock file is created if needed and left in place.
+    """
+    path = Path(path)
+    with _thread_locks_guard:
+        thread_lock = _thread_locks.setdefault(str(path), threading.Lock())
+
+    with thread_lock:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
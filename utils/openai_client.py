@@ -0,0 +1,27 @@
+import threading
+
+# One client per set of credentials, so the services share its connection pool
+_clients = {}
+_lock = threading.Lock()
+
+
+def get_client(api_key: str, organization: str, project: str):
+    """
+    The OpenAI client for these credentials, created on first use. Importing
+    openai and loading the client's CA bundle take a good part of a second,
+    so neither happens until a request needs the API.
+    """
+    key = (api_key, organization, project)
+    client = _clients.get(key)
+    if client is None:
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                from openai import OpenAI
+
+                client = _clients[key] = OpenAI(
+                    api_key=api_key,
+                    organization=organization,
+                    project=project,
+                )
+    return client
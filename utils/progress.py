@@ -0,0 +1,59 @@
+import time
+from concurrent.futures import (
+    Future,
+    ThreadPoolExecutor,
+    TimeoutError as FutureTimeoutError,
+)
+from typing import Any, Callable, Generator
+
+from utils.utils import stream_message
+
+# Seconds between heartbeats while a long call is running
+HEARTBEAT_INTERVAL = 5.0
+
+# Shared pool for blocking calls that need heartbeats while they run
+_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="progress")
+
+
+def run_with_heartbeat(
+    stage_name: str,
+    func: Callable[..., Any],
+    *args,
+    interval: float = HEARTBEAT_INTERVAL,
+    **kwargs,
+) -> Generator[bytes, None, Any]:
+    """
+    Run a blocking call in a worker thread and yield heartbeat messages
+    until it finishes. Use with `yield from` to get the call's return value:
+
+        result = yield from run_with_heartbeat("whisper", func, arg)
+
+    Exceptions raised by the call are re-raised in the caller.
+    """
+    return (
+        yield from wait_with_heartbeat(
+            stage_name, submit(func, *args, **kwargs), interval=interval
+        )
+    )
+
+
+def submit(func: Callable[..., Any], *args, **kwargs) -> Future:
+    """Start a blocking call on the shared pool, to wait on with wait_with_heartbeat"""
+    return _executor.submit(func, *args, **kwargs)
+
+
+def wait_with_heartbeat(
+    stage_name: str, future: Future, interval: float = HEARTBEAT_INTERVAL
+) -> Generator[bytes, None, Any]:
+    """
+    Yield heartbeat messages until the future is done and return its result.
+    Closing the generator stops the heartbeats, not the call.
+    """
+    started = time.monotonic()
+
+    while True:
+        try:
+            return future.result(timeout=interval)
+        except FutureTimeoutError:
+            elapsed = round(time.monotonic() - started, 1)
+            yield stream_message("heartbeat", {"stage": stage_name, "elapsed": elapsed})
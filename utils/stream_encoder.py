@@ -0,0 +1,54 @@
+import json
+from typing import Any, Iterable, Iterator, Union
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+JSON_BACKEND = "orjson" if orjson else "json"
+
+# Largest chunk written to a response at once, bigger messages are split
+MAX_CHUNK_SIZE = 64 * 1024
+
+
+def dumps(obj: Any) -> bytes:
+    """
+    Compact UTF-8 JSON. Uses orjson when it's installed, the stdlib
+    fallback produces the same output for the types we send.
+    """
+    if orjson:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def loads(data: Union[str, bytes]) -> Any:
+    return orjson.loads(data) if orjson else json.loads(data)
+
+
+def pack(
+    messages: Iterable[Union[str, bytes]], max_chunk_size: int = MAX_CHUNK_SIZE
+) -> Iterator[bytes]:
+    """
+    Turn NDJSON lines into the chunks written to a response: consecutive
+    small lines are joined into one write, a line larger than
+    max_chunk_size is sent in max_chunk_size pieces.
+    """
+    pending = bytearray()
+    for message in messages:
+        data = message.encode("utf-8") if isinstance(message, str) else message
+        if len(pending) + len(data) <= max_chunk_size:
+            pending += data
+            continue
+
+        if pending:
+            yield bytes(pending)
+            pending.clear()
+        if len(data) <= max_chunk_size:
+            pending += data
+            continue
+        view = memoryview(data)
+        for start in range(0, len(data), max_chunk_size):
+            yield bytes(view[start : start + max_chunk_size])
+    if pending:
+        yield bytes(pending)
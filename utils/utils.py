@@ -1,14 +1,26 @@
 import json
 import re
 from urllib.parse import urlparse, parse_qs
-from typing import List, Dict, Any, Tuple
+from typing import List, Dict, Any, Optional, Tuple
 import os
 import glob
+import gzip
+import logging
 from config import TRANSCRIPTION_FILTER_SRT_ARRAY
+from utils import stream_encoder
 import unicodedata
 
 
 # ? General Utils
+def log_handlers():
+    """Console logging, plus LOG_FILE (app.log unless set, empty to turn it off)"""
+    handlers = [logging.StreamHandler()]
+    log_file = os.getenv("LOG_FILE", "app.log")
+    if log_file:
+        handlers.append(logging.FileHandler(log_file))
+    return handlers
+
+
 def concatenate_strings(string_array):
     # Using the join() method with '\n' as the separator
     string_array = [str(item) for item in string_array]  # Convert all items to strings
@@ -153,157 +165,438 @@ def clean_lyrics(content: str) -> Tuple[List[str], List[str]]:
     return cleaned_lines, removed_lines
 
 
-def process_subtitle_file(
-    file_path: str,
-    file_format: str,
+def parse_subtitle_time(time_str: str) -> float:
+    if "," in time_str:  # SRT format
+        time_str = time_str.replace(",", ".")
+    elif "." not in time_str:  # ASS/SSA format
+        time_str += ".000"
+    h, m, s = time_str.split(":")
+    return float(h) * 3600 + float(m) * 60 + float(s)
+
+
+def parse_subtitle_content(
+    content: str,
+    subtitle_format: str,
     exclude_strings: List[str] = TRANSCRIPTION_FILTER_SRT_ARRAY,
-    max_duration: float = 30,
+    apply_filters: bool = True,
     max_lyric_length: int = 50,
+) -> List[Dict[str, Any]]:
+    """
+    Parse SRT/VTT/ASS/SSA content into timestamped lyric entries.
+
+    Args:
+        content: Raw subtitle file content
+        subtitle_format: One of srt, vtt, ass, ssa (with or without leading dot)
+        exclude_strings: Lyrics containing any of these are dropped when filtering
+        apply_filters: Whether to drop lyrics matching exclude_strings
+        max_lyric_length: Longer lines are split on spaces with timing divided evenly
+
+    Returns:
+        List[Dict[str, Any]]: Entries with start_time, end_time, duration and lyric
+    """
+    timestamped_lyrics = []
+
+    if subtitle_format.lower() in ["srt", ".srt"]:
+        pattern = r"(\d+:\d+:\d+,\d+) --> (\d+:\d+:\d+,\d+)\n((?:.+\n?)+)"
+    elif subtitle_format.lower() in ["vtt", ".vtt"]:
+        pattern = r"(\d+:\d+:\d+\.\d+) --> (\d+:\d+:\d+\.\d+)\n((?:.+\n?)+)"
+    elif subtitle_format.lower() in ["ass", "ssa", ".ssa", ".ass"]:
+        pattern = r"Dialogue: [^,]*,(\d+:\d+:\d+\.\d+),(\d+:\d+:\d+\.\d+),[^,]*,[^,]*,[^,]*,[^,]*,[^,]*,[^,]*,(.*)"
+    else:
+        raise ValueError(f"Unsupported subtitle format: {subtitle_format}")
+
+    matches = list(re.finditer(pattern, content, re.MULTILINE))
+
+    for match in matches:
+        start_time = round(parse_subtitle_time(match.group(1)), 3)
+        end_time = round(parse_subtitle_time(match.group(2)), 3)
+        lyric_block = match.group(3).strip()
+
+        if not lyric_block:
+            continue
+
+        processed_lyric = process_japanese_subtitle(lyric_block)
+
+        # Skip excluded strings while maintaining timing relationship
+        if apply_filters and any(
+            exclude_str in processed_lyric for exclude_str in exclude_strings
+        ):
+            continue
+
+        timestamped_lyrics.extend(
+            split_long_lyric(start_time, end_time, processed_lyric, max_lyric_length)
+        )
+    # //
+    return timestamped_lyrics
+
+
+def split_long_lyric(
+    start_time: float, end_time: float, lyric: str, max_lyric_length: int = 50
+) -> List[Dict[str, Any]]:
+    """
+    Build timestamped entries for one lyric, splitting lines longer than
+    max_lyric_length on spaces and dividing the timing evenly between them.
+    """
+    entry = {
+        "start_time": start_time,
+        "end_time": end_time,
+        "duration": round(end_time - start_time, 3),
+        "lyric": lyric,
+    }
+
+    # Handle line length limits while preserving timing
+    if len(lyric) <= max_lyric_length or " " not in lyric:
+        return [entry]
+
+    words = lyric.split()
+    current_line = ""
+    lines = []
+
+    for word in words:
+        if len(current_line) + len(word) + 1 > max_lyric_length:
+            if current_line:
+                lines.append(current_line)
+            current_line = word
+        else:
+            current_line = f"{current_line} {word}".strip()
+
+    if current_line:
+        lines.append(current_line)
+
+    time_per_segment = entry["duration"] / len(lines)
+    split_entries = []
+    for i, line in enumerate(lines):
+        segment_start = entry["start_time"] + (i * time_per_segment)
+        segment_end = segment_start + time_per_segment
+        split_entries.append(
+            {
+                "start_time": round(segment_start, 3),
+                "end_time": round(segment_end, 3),
+                "duration": round(time_per_segment, 3),
+                "lyric": line,
+            }
+        )
+    return split_entries
+
+
+def segments_to_cues(
+    segments: List[Dict[str, Any]],
+    max_no_speech_prob: float = 0.6,
+    min_avg_logprob: float = -1.0,
+    max_lyric_length: int = 50,
+) -> List[Dict[str, Any]]:
+    """
+    Build timestamped lyric entries straight from Whisper verbose_json segments.
+
+    Segments Whisper itself considers silence (high no_speech_prob together
+    with a low avg_logprob) are dropped, those are where it hallucinates.
+
+    Args:
+        segments: Segment dicts with start, end, text, no_speech_prob, avg_logprob
+
+    Returns:
+        List[Dict[str, Any]]: Same entry shape as parse_subtitle_content
+    """
+    timestamped_lyrics = []
+
+    for segment in segments:
+        lyric = segment.get("text", "").strip()
+        if not lyric:
+            continue
+
+        if is_silent_segment(segment, max_no_speech_prob, min_avg_logprob):
+            continue
+
+        timestamped_lyrics.extend(
+            split_long_lyric(
+                round(segment["start"], 3),
+                round(segment["end"], 3),
+                process_japanese_subtitle(lyric),
+                max_lyric_length,
+            )
+        )
+
+    return timestamped_lyrics
+
+
+def is_silent_segment(
+    segment: Dict[str, Any],
+    max_no_speech_prob: float = 0.6,
+    min_avg_logprob: float = -1.0,
+) -> bool:
+    """Whether Whisper itself considers the segment silence, see segments_to_cues"""
+    return (
+        segment.get("no_speech_prob", 0) > max_no_speech_prob
+        and segment.get("avg_logprob", 0) < min_avg_logprob
+    )
+
+
+def find_low_confidence_ranges(
+    segments: List[Dict[str, Any]],
+    max_compression_ratio: float = 2.4,
+    min_avg_logprob: float = -1.0,
+) -> List[Tuple[float, float]]:
+    """
+    Time ranges of Whisper segments that are likely repetition loops or
+    guesses, based on the segment's own compression ratio and log probability.
+    Silent segments (instrumental intros, outros and breaks) are skipped:
+    segments_to_cues already drops them, and sending them back to Whisper
+    is what makes it hallucinate.
+    """
+    return [
+        (segment["start"], segment["end"])
+        for segment in segments
+        if segment.get("text", "").strip()
+        and not is_silent_segment(segment, min_avg_logprob=min_avg_logprob)
+        and (
+            segment.get("compression_ratio", 0) > max_compression_ratio
+            or segment.get("avg_logprob", 0) < min_avg_logprob
+        )
+    ]
+
+
+def check_repetition(timestamped_lyrics: List[Dict[str, Any]]) -> None:
+    """Raise ValueError if the lyrics are dominated by a single repeated line."""
+    content_count = {}
+    for item in timestamped_lyrics:
+        content = item["lyric"]
+        content_count[content] = content_count.get(content, 0) + 1
+
+    if content_count:
+        most_common_content = max(content_count, key=content_count.get)
+        most_common_count = content_count[most_common_content]
+        total_lines = len(content_count)
+
+        if most_common_count / total_lines >= 0.8:
+            raise ValueError(
+                "The transcription may have errored out, please try again later [high repetition]."
+            )
+
+
+def build_subtitle_result(timestamped_lyrics: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Build the lyrics list and filtered SRT from timestamped lyric entries."""
+    return {
+        "lyrics": [item["lyric"] for item in timestamped_lyrics],
+        "timestamped_lyrics": timestamped_lyrics,
+        "filtered_srt": cues_to_srt(timestamped_lyrics),
+    }
+
+
+def cues_to_srt(timestamped_lyrics: List[Dict[str, Any]]) -> str:
+    """Serialize timestamped lyric entries to SRT, maintaining original timing."""
+    srt_lines = []
+    for i, item in enumerate(timestamped_lyrics):
+        start_time_str = format_timestamp(item["start_time"])
+        end_time_str = format_timestamp(item["end_time"])
+        srt_lines.extend(
+            [str(i + 1), f"{start_time_str} --> {end_time_str}", item["lyric"], ""]
+        )
+
+    return "\n".join(srt_lines).strip()
+
+
+def process_subtitle_cues(
+    timestamped_lyrics: List[Dict[str, Any]],
+    exclude_strings: List[str] = TRANSCRIPTION_FILTER_SRT_ARRAY,
     apply_error_checks: bool = False,
 ) -> Dict[str, Any]:
-    def parse_time(time_str: str) -> float:
-        if "," in time_str:  # SRT format
-            time_str = time_str.replace(",", ".")
-        elif "." not in time_str:  # ASS/SSA format
-            time_str += ".000"
-        h, m, s = time_str.split(":")
-        return float(h) * 3600 + float(m) * 60 + float(s)
-
-    def process_subtitle(
-        content: str,
-        subtitle_format: str,
-        exclude_strings: List[str],
-        apply_filters: bool = True,
-    ) -> List[Dict[str, Any]]:
-        timestamped_lyrics = []
-
-        if subtitle_format.lower() in ["srt", ".srt"]:
-            pattern = r"(\d+:\d+:\d+,\d+) --> (\d+:\d+:\d+,\d+)\n((?:.+\n?)+)"
-        elif subtitle_format.lower() in ["vtt", ".vtt"]:
-            pattern = r"(\d+:\d+:\d+\.\d+) --> (\d+:\d+:\d+\.\d+)\n((?:.+\n?)+)"
-        elif subtitle_format.lower() in ["ass", "ssa", ".ssa", ".ass"]:
-            pattern = r"Dialogue: [^,]*,(\d+:\d+:\d+\.\d+),(\d+:\d+:\d+\.\d+),[^,]*,[^,]*,[^,]*,[^,]*,[^,]*,[^,]*,(.*)"
-        else:
-            raise ValueError(f"Unsupported subtitle format: {subtitle_format}")
+    """
+    Same as process_subtitle_file, but for entries that are already parsed
+    (e.g. unfiltered output of parse_subtitle_content after repair).
+    """
+    filtered = [
+        item
+        for item in timestamped_lyrics
+        if not any(exclude_str in item["lyric"] for exclude_str in exclude_strings)
+    ]
 
-        matches = list(re.finditer(pattern, content, re.MULTILINE))
+    # Only fall back to unfiltered entries if filtering removed everything
+    if not filtered:
+        filtered = list(timestamped_lyrics)
 
-        for match in matches:
-            start_time = round(parse_time(match.group(1)), 3)
-            end_time = round(parse_time(match.group(2)), 3)
-            lyric_block = match.group(3).strip()
+    if apply_error_checks and filtered:
+        check_repetition(filtered)
 
-            if not lyric_block:
-                continue
+    return build_subtitle_result(filtered)
 
-            processed_lyric = process_japanese_subtitle(lyric_block)
 
-            # Skip excluded strings while maintaining timing relationship
-            if apply_filters and any(
-                exclude_str in processed_lyric for exclude_str in exclude_strings
-            ):
-                continue
+# Bump whenever parsing or filtering of subtitle files changes output
+# (including TRANSCRIPTION_FILTER_SRT_ARRAY), stored lyric bundles made by an
+# older parser are then ignored and rebuilt from the raw subtitle file
+SUBTITLE_PARSER_VERSION = 1
 
-            # Store original timing with the lyric
-            entry = {
-                "start_time": start_time,
-                "end_time": end_time,
-                "duration": round(end_time - start_time, 3),
-                "lyric": lyric_block,
-            }
 
-            # Handle line length limits while preserving timing
-            if len(processed_lyric) > max_lyric_length and " " in processed_lyric:
-                words = processed_lyric.split()
-                current_line = ""
-                lines = []
-
-                for word in words:
-                    if len(current_line) + len(word) + 1 > max_lyric_length:
-                        if current_line:
-                            lines.append(current_line)
-                        current_line = word
-                    else:
-                        current_line = f"{current_line} {word}".strip()
-
-                if current_line:
-                    lines.append(current_line)
-
-                # Only split timing if we actually need to split the line
-                if lines:
-                    time_per_segment = entry["duration"] / len(lines)
-                    for i, line in enumerate(lines):
-                        segment_start = entry["start_time"] + (i * time_per_segment)
-                        segment_end = segment_start + time_per_segment
-                        timestamped_lyrics.append(
-                            {
-                                "start_time": round(segment_start, 3),
-                                "end_time": round(segment_end, 3),
-                                "duration": round(time_per_segment, 3),
-                                "lyric": line,
-                            }
-                        )
-            else:
-                entry["lyric"] = processed_lyric
-                timestamped_lyrics.append(entry)
-        # //
-        return timestamped_lyrics
+def encode_lyric_bundle(result: Dict[str, Any], source_format: str) -> bytes:
+    """Compress the parsed result of process_subtitle_file for storage."""
+    bundle = {
+        "version": SUBTITLE_PARSER_VERSION,
+        "source": source_format,
+        "lyrics": result["lyrics"],
+        "timestamped_lyrics": result["timestamped_lyrics"],
+    }
+    # mtime=0 so the same lyrics always compress to the same bytes
+    return gzip.compress(
+        json.dumps(bundle, ensure_ascii=False, separators=(",", ":")).encode("utf-8"),
+        mtime=0,
+    )
+
 
+def decode_lyric_bundle(data: bytes) -> Optional[Dict[str, Any]]:
+    """
+    Parsed lyrics from a stored bundle, or None if it's unreadable or was
+    made by a different parser version.
+    """
+    try:
+        bundle = json.loads(gzip.decompress(data).decode("utf-8"))
+    except (OSError, ValueError) as e:
+        print(f"Error decoding lyric bundle: {str(e)}")
+        return None
+
+    if bundle.get("version") != SUBTITLE_PARSER_VERSION:
+        return None
+    return {
+        "lyrics": bundle["lyrics"],
+        "timestamped_lyrics": bundle["timestamped_lyrics"],
+    }
+
+
+def process_subtitle_file(
+    file_path: str,
+    file_format: str,
+    exclude_strings: List[str] = TRANSCRIPTION_FILTER_SRT_ARRAY,
+    max_duration: float = 30,
+    max_lyric_length: int = 50,
+    apply_error_checks: bool = False,
+) -> Dict[str, Any]:
     # Read and process content
     with open(file_path, "r", encoding="utf-8") as file:
         content = file.read()
 
     # Process with filters first
-    timestamped_lyrics = process_subtitle(
-        content, file_format, exclude_strings, apply_filters=True
+    timestamped_lyrics = parse_subtitle_content(
+        content, file_format, exclude_strings, True, max_lyric_length
     )
 
     # Only try without filters if we got no results
     if not timestamped_lyrics:
-        timestamped_lyrics = process_subtitle(
-            content, file_format, exclude_strings, apply_filters=False
+        timestamped_lyrics = parse_subtitle_content(
+            content, file_format, exclude_strings, False, max_lyric_length
         )
 
     # Error checking for repeated content
     if apply_error_checks and timestamped_lyrics:
-        content_count = {}
-        for item in timestamped_lyrics:
-            content = item["lyric"]
-            content_count[content] = content_count.get(content, 0) + 1
-
-        if content_count:
-            most_common_content = max(content_count, key=content_count.get)
-            most_common_count = content_count[most_common_content]
-            total_lines = len(content_count)
-
-            if most_common_count / total_lines >= 0.8:
-                raise ValueError(
-                    "The transcription may have errored out, please try again later [high repetition]."
-                )
+        check_repetition(timestamped_lyrics)
 
-    # Generate outputs
-    lyrics = [item["lyric"] for item in timestamped_lyrics]
+    return build_subtitle_result(timestamped_lyrics)
 
-    # Generate SRT maintaining original timing
-    filtered_srt_lines = []
-    for i, item in enumerate(timestamped_lyrics):
-        start_time_str = format_timestamp(item["start_time"])
-        end_time_str = format_timestamp(item["end_time"])
-        filtered_srt_lines.extend(
-            [str(i + 1), f"{start_time_str} --> {end_time_str}", item["lyric"], ""]
-        )
 
-    filtered_srt = "\n".join(filtered_srt_lines).strip()
+def find_suspect_ranges(
+    timestamped_lyrics: List[Dict[str, Any]],
+    audio_duration: Optional[float] = None,
+    exclude_strings: List[str] = TRANSCRIPTION_FILTER_SRT_ARRAY,
+    max_repeats: int = 3,
+    max_gap: float = 20.0,
+    padding: float = 0.5,
+    extra_ranges: Optional[List[Tuple[float, float]]] = None,
+) -> List[Tuple[float, float]]:
+    """
+    Find time ranges of a Whisper transcription that look hallucinated.
 
-    return {
-        "lyrics": lyrics,
-        "timestamped_lyrics": timestamped_lyrics,
-        "filtered_srt": filtered_srt,
-    }
+    Flags runs of more than `max_repeats` identical consecutive lines and
+    lines containing filter-list strings. extra_ranges (e.g. from
+    find_low_confidence_ranges) are merged in as well. Gaps with no lyrics
+    longer than `max_gap` seconds (including the tail when audio_duration is
+    known) are only flagged next to one of those: most long gaps are
+    instrumental, and re-transcribing silence is what makes Whisper
+    hallucinate in the first place.
+
+    Returns:
+        List[Tuple[float, float]]: Sorted, merged (start, end) ranges in seconds
+    """
+    ranges = list(extra_ranges or [])
+    cues = sorted(timestamped_lyrics, key=lambda item: item["start_time"])
+
+    # Runs of the same line repeated back to back
+    run_start = 0
+    for i in range(1, len(cues) + 1):
+        if i < len(cues) and cues[i]["lyric"] == cues[run_start]["lyric"]:
+            continue
+        if i - run_start > max_repeats:
+            ranges.append((cues[run_start]["start_time"], cues[i - 1]["end_time"]))
+        run_start = i
+
+    # Known Whisper hallucinations from the filter list
+    for cue in cues:
+        if any(exclude_str in cue["lyric"] for exclude_str in exclude_strings):
+            ranges.append((cue["start_time"], cue["end_time"]))
+
+    # Long stretches with no lyrics at all
+    gaps = []
+    previous_end = 0.0
+    for cue in cues:
+        if cue["start_time"] - previous_end > max_gap:
+            gaps.append((previous_end, cue["start_time"]))
+        previous_end = max(previous_end, cue["end_time"])
+    if audio_duration and audio_duration - previous_end > max_gap:
+        gaps.append((previous_end, audio_duration))
+
+    # Only gaps bordering other evidence, e.g. lyrics lost around a loop
+    evidence = list(ranges)
+    for gap_start, gap_end in gaps:
+        if any(
+            start <= gap_end + padding and end >= gap_start - padding
+            for start, end in evidence
+        ):
+            ranges.append((gap_start, gap_end))
+
+    # Pad and merge overlapping ranges
+    merged = []
+    for start, end in sorted(ranges):
+        start = max(0.0, start - padding)
+        end = end + padding
+        if audio_duration:
+            end = min(end, audio_duration)
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+
+    return [(round(start, 3), round(end, 3)) for start, end in merged]
+
+
+def splice_cues(
+    timestamped_lyrics: List[Dict[str, Any]],
+    replacements: Dict[Tuple[float, float], List[Dict[str, Any]]],
+) -> List[Dict[str, Any]]:
+    """
+    Replace the cues inside each (start, end) range with the given cues.
+    A cue belongs to a range when its midpoint falls inside it, so padded
+    ranges don't remove neighbouring lines that were transcribed correctly.
+    Replacement cues are expected to already be offset to song time.
+    """
+
+    def in_any_range(cue: Dict[str, Any]) -> bool:
+        midpoint = (cue["start_time"] + cue["end_time"]) / 2
+        return any(start <= midpoint <= end for start, end in replacements)
+
+    spliced = [cue for cue in timestamped_lyrics if not in_any_range(cue)]
+    for cues in replacements.values():
+        spliced.extend(cues)
+
+    return sorted(spliced, key=lambda item: item["start_time"])
+
+
+def read_video_duration(info_file_path: str) -> Optional[float]:
+    """Read the video duration in seconds from a yt-dlp .info.json file, if present."""
+    try:
+        with open(info_file_path, "r", encoding="utf-8") as file:
+            return json.load(file).get("duration")
+    except (OSError, json.JSONDecodeError):
+        return None
 
 
-def stream_message(type: str, data: str):
-    return json.dumps({"type": type, "data": data}) + "\n"
+def stream_message(type: str, data: str) -> bytes:
+    return stream_encoder.dumps({"type": type, "data": data}) + b"\n"
 
 
 # ! NEW
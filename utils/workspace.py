@@ -0,0 +1,82 @@
+import os
+import shutil
+import tempfile
+import uuid
+from pathlib import Path
+from typing import Optional
+
+# tmpfs is used for workspaces when it has at least this much room
+TMPFS_MIN_FREE = 512 * 1024 * 1024
+
+# Files yt-dlp and our downloads leave while they're still being written
+PARTIAL_SUFFIXES = (".part", ".ytdl", ".tmp")
+
+
+def workspace_root() -> Path:
+    """
+    WORKSPACE_ROOT if set, else /dev/shm when it has room for a song and its
+    intermediate files, else the system temp directory.
+    """
+    configured = os.getenv("WORKSPACE_ROOT")
+    if configured:
+        return Path(configured)
+    try:
+        stats = os.statvfs("/dev/shm")
+        if stats.f_bavail * stats.f_frsize >= TMPFS_MIN_FREE and os.access(
+            "/dev/shm", os.W_OK
+        ):
+            return Path("/dev/shm")
+    except OSError:
+        pass
+    return Path(tempfile.gettempdir())
+
+
+class Workspace:
+    """
+    Private directory for one request's intermediate files, removed with
+    everything in it when the `with` block exits, including on errors and
+    when a stream is closed early. Files other requests can use are moved
+    to a shared directory with `promote`, so readers there never see a
+    partially written file.
+
+        with Workspace("transcribe") as workspace:
+            srt_path = workspace.path / f"{video_id}.srt"
+    """
+
+    def __init__(self, prefix: str, root: Optional[Path] = None):
+        self.prefix = prefix
+        self.root = Path(root) if root else workspace_root()
+        self.path: Optional[Path] = None
+
+    def __enter__(self) -> "Workspace":
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.path = Path(tempfile.mkdtemp(prefix=f"{self.prefix}_", dir=self.root))
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        if self.path:
+            shutil.rmtree(self.path, ignore_errors=True)
+            self.path = None
+
+    def promote(self, name: str, destination_dir: Path) -> Path:
+        """Move a finished file into destination_dir under the same name"""
+        destination_dir.mkdir(parents=True, exist_ok=True)
+        destination = destination_dir / name
+        # Copy next to the destination first, renames are only atomic within
+        # a filesystem and the workspace may be on tmpfs
+        staging = destination_dir / f".{name}.{uuid.uuid4().hex[:8]}.tmp"
+        try:
+            shutil.copyfile(self.path / name, staging)
+            os.replace(staging, destination)
+        finally:
+            staging.unlink(missing_ok=True)
+        (self.path / name).unlink(missing_ok=True)
+        return destination
+
+    def promote_all(self, destination_dir: Path) -> list[Path]:
+        """Promote every finished file in the workspace"""
+        return [
+            self.promote(path.name, destination_dir)
+            for path in sorted(self.path.iterdir())
+            if path.is_file() and not path.name.endswith(PARTIAL_SUFFIXES)
+        ]